@@ -0,0 +1,9 @@
+from distutils.core import setup, Extension
+
+fast_sha256_module = Extension('fast_sha256',
+                               sources = ['sha256module.c'])
+
+setup (name = 'fast_sha256',
+       version = '1.0',
+       description = 'SHA-256 compression function with midstate input and output for P2Pool',
+       ext_modules = [fast_sha256_module])
@@ -6,8 +6,21 @@ import random
 import p2pool
 from p2pool.util import math, pack
 
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+# hashes are handled as raw little-endian digests internally and as integers at API edges and in target comparisons
+
+def hash_to_int(raw_hash):
+    return int(raw_hash[::-1].encode('hex'), 16)
+
+def int_to_hash(x):
+    if not 0 <= x < 2**256:
+        raise ValueError('invalid hash value - %r' % (x,))
+    return ('%064x' % (x,)).decode('hex')[::-1]
+
 def hash256(data):
-    return pack.IntType(256).unpack(hashlib.sha256(hashlib.sha256(data).digest()).digest())
+    return hash_to_int(sha256d(data))
 
 def hash160(data):
     if data == '04ffd03de44a6e11b9917f3a29f9443283d9871c9d743ef30d5eddcd37094b64d1b3d8090496b53256786bf5c82932ec23c3b74d9f05a6f95a8b5529352656664b'.decode('hex'):
@@ -162,54 +175,138 @@ def make_auxpow_tree(chain_ids):
 
 # merkle trees
 
-merkle_record_type = pack.ComposedType([
-    ('left', pack.IntType(256)),
-    ('right', pack.IntType(256)),
-])
+def _merkle_pair(left, right):
+    return None if left is None or right is None else sha256d(left + right)
 
-def merkle_hash(hashes):
-    if not hashes:
-        return 0
-    hash_list = list(hashes)
-    while len(hash_list) > 1:
-        hash_list = [hash256(merkle_record_type.pack(dict(left=left, right=right)))
-            for left, right in zip(hash_list[::2], hash_list[1::2] + [hash_list[::2][-1]])]
-    return hash_list[0]
-
-def calculate_merkle_link(hashes, index):
-    # XXX optimize this
+class MerkleTree(object):
+    '''
+    Merkle tree over a list of integer hashes that keeps every level, so links
+    can be read off in O(log n) and leaves appended or replaced with O(log n)
+    rehashing. Leaves may be None (e.g. a gentx that isn't known yet) as long
+    as they aren't needed for the root or link that is asked for.
+    '''
+    
+    def __init__(self, hashes=[]):
+        self._levels = [[None if h is None else int_to_hash(h) for h in hashes]]
+        while len(self._levels[-1]) > 1:
+            level = self._levels[-1]
+            self._levels.append([_merkle_pair(level[i], level[i + 1] if i + 1 < len(level) else level[i])
+                for i in xrange(0, len(level), 2)])
     
-    hash_list = [(lambda _h=h: _h, i == index, []) for i, h in enumerate(hashes)]
+    def __len__(self):
+        return len(self._levels[0])
     
-    while len(hash_list) > 1:
-        hash_list = [
-            (
-                lambda _left=left, _right=right: hash256(merkle_record_type.pack(dict(left=_left(), right=_right()))),
-                left_f or right_f,
-                (left_l if left_f else right_l) + [dict(side=1, hash=right) if left_f else dict(side=0, hash=left)],
-            )
-            for (left, left_f, left_l), (right, right_f, right_l) in
-                zip(hash_list[::2], hash_list[1::2] + [hash_list[::2][-1]])
-        ]
+    def _rehash(self, pos):
+        depth = 0
+        while len(self._levels[depth]) > 1:
+            level = self._levels[depth]
+            pos -= pos % 2
+            h = _merkle_pair(level[pos], level[pos + 1] if pos + 1 < len(level) else level[pos])
+            if depth + 1 == len(self._levels):
+                self._levels.append([])
+            parent = self._levels[depth + 1]
+            if pos//2 == len(parent):
+                parent.append(h)
+            else:
+                parent[pos//2] = h
+            pos //= 2
+            depth += 1
     
-    res = [x['hash']() for x in hash_list[0][2]]
+    def append(self, leaf_hash):
+        self._levels[0].append(None if leaf_hash is None else int_to_hash(leaf_hash))
+        self._rehash(len(self) - 1)
+    
+    def __setitem__(self, index, leaf_hash):
+        if not 0 <= index < len(self):
+            raise IndexError('leaf index out of range')
+        self._levels[0][index] = None if leaf_hash is None else int_to_hash(leaf_hash)
+        self._rehash(index)
+    
+    def truncate(self, length):
+        if not 0 <= length <= len(self):
+            raise IndexError('length out of range')
+        size = length
+        for depth, level in enumerate(self._levels):
+            del level[size:]
+            if size <= 1:
+                del self._levels[depth + 1:]
+                break
+            size = (size + 1)//2
+        if length:
+            self._rehash(length - 1)
+    
+    def update(self, hashes):
+        # makes the leaves hashes, only rehashing above the ones that changed, or rebuilding if that would be cheaper
+        leaves = [None if h is None else int_to_hash(h) for h in hashes]
+        changed = [i for i, leaf in enumerate(leaves[:len(self)]) if leaf != self._levels[0][i]]
+        if (len(changed) + abs(len(leaves) - len(self)))*len(self._levels) > len(leaves):
+            self.__init__(hashes)
+            return
+        if len(leaves) < len(self):
+            self.truncate(len(leaves))
+        for i in changed:
+            self._levels[0][i] = leaves[i]
+            self._rehash(i)
+        for h in hashes[len(self):]:
+            self.append(h)
+    
+    def get_root(self):
+        if not len(self):
+            return 0
+        root = self._levels[-1][0]
+        if root is None:
+            raise ValueError('root depends on unknown hash')
+        return hash_to_int(root)
+    
+    def get_link(self, index, length=None):
+        # with length, the link is for the tree over only the first length leaves
+        if length is None:
+            length = len(self)
+        if not 0 <= index < length <= len(self):
+            raise IndexError('leaf index out of range')
+        branch = []
+        pos = index
+        size = length
+        last = self._levels[0][length - 1] # last node of each level, which differs from the stored one if its leaves were cut off
+        for level in self._levels:
+            if size <= 1:
+                break
+            sibling = pos ^ 1 if pos ^ 1 < size else pos
+            h = last if sibling == size - 1 else level[sibling]
+            if h is None:
+                raise ValueError('link depends on unknown hash')
+            branch.append(hash_to_int(h))
+            last = _merkle_pair(level[size - 2], last) if size % 2 == 0 else _merkle_pair(last, last)
+            pos //= 2
+            size = (size + 1)//2
+        return dict(branch=branch, index=index)
+
+def merkle_hash(hashes):
+    return MerkleTree(hashes).get_root()
+
+def calculate_merkle_link(hashes, index):
+    # builds a throwaway tree; keep a MerkleTree around when several links are needed
+    res = MerkleTree(hashes).get_link(index)
     
-    assert hash_list[0][1]
     if p2pool.DEBUG:
         new_hashes = [random.randrange(2**256) if x is None else x
             for x in hashes]
-        assert check_merkle_link(new_hashes[index], dict(branch=res, index=index)) == merkle_hash(new_hashes)
-    assert index == sum(k*2**i for i, k in enumerate([1-x['side'] for x in hash_list[0][2]]))
+        assert check_merkle_link(new_hashes[index], res) == merkle_hash(new_hashes)
     
-    return dict(branch=res, index=index)
+    return res
 
 def check_merkle_link(tip_hash, link):
-    if link['index'] >= 2**len(link['branch']):
+    return hash_to_int(check_merkle_link_raw(int_to_hash(tip_hash), link))
+
+def check_merkle_link_raw(raw_tip_hash, link):
+    # like check_merkle_link, but takes and returns raw hashes
+    index = link['index']
+    if index >= 2**len(link['branch']):
         raise ValueError('index too large')
-    return reduce(lambda c, (i, h): hash256(merkle_record_type.pack(
-        dict(left=h, right=c) if (link['index'] >> i) & 1 else
-        dict(left=c, right=h)
-    )), enumerate(link['branch']), tip_hash)
+    c = raw_tip_hash
+    for i, h in enumerate(link['branch']):
+        c = sha256d(int_to_hash(h) + c) if (index >> i) & 1 else sha256d(c + int_to_hash(h))
+    return c
 
 # targets
 
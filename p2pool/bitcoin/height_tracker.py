@@ -23,7 +23,7 @@ class HeightTracker(object):
         self._factory = factory
         self._backlog_needed = backlog_needed
         
-        self._tracker = forest.Tracker()
+        self._tracker = forest.Tracker(view_type=forest.ArrayTrackerView)
         
         self._watch1 = self._factory.new_headers.watch(self._heard_headers)
         self._watch2 = self._factory.new_block.watch(self._request)
@@ -14,26 +14,30 @@ k = [
     0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
 ]
 
-def process(state, chunk):
-    def rightrotate(x, n):
-        return (x >> n) | (x << 32 - n) % 2**32
-    
-    w = list(struct.unpack('>16I', chunk))
-    for i in xrange(16, 64):
-        s0 = rightrotate(w[i-15], 7) ^ rightrotate(w[i-15], 18) ^ (w[i-15] >> 3)
-        s1 = rightrotate(w[i-2], 17) ^ rightrotate(w[i-2], 19) ^ (w[i-2] >> 10)
-        w.append((w[i-16] + s0 + w[i-7] + s1) % 2**32)
-    
-    a, b, c, d, e, f, g, h = start_state = struct.unpack('>8I', state)
-    for k_i, w_i in zip(k, w):
-        t1 = (h + (rightrotate(e, 6) ^ rightrotate(e, 11) ^ rightrotate(e, 25)) + ((e & f) ^ (~e & g)) + k_i + w_i) % 2**32
+def python_process(state, data):
+    # rotations below leave garbage above bit 31, which is masked off wherever it would matter
+    for offset in xrange(0, len(data), 64):
+        w = list(struct.unpack_from('>16I', data, offset))
+        for i in xrange(16, 64):
+            x, y = w[i-15], w[i-2]
+            s0 = ((x >> 7) | (x << 25)) ^ ((x >> 18) | (x << 14)) ^ (x >> 3)
+            s1 = ((y >> 17) | (y << 15)) ^ ((y >> 19) | (y << 13)) ^ (y >> 10)
+            w.append((w[i-16] + s0 + w[i-7] + s1) & 0xffffffff)
         
-        a, b, c, d, e, f, g, h = (
-            (t1 + (rightrotate(a, 2) ^ rightrotate(a, 13) ^ rightrotate(a, 22)) + ((a & b) ^ (a & c) ^ (b & c))) % 2**32,
-            a, b, c, (d + t1) % 2**32, e, f, g,
-        )
-    
-    return struct.pack('>8I', *((x + y) % 2**32 for x, y in zip(start_state, [a, b, c, d, e, f, g, h])))
+        a, b, c, d, e, f, g, h = start_state = struct.unpack('>8I', state)
+        for k_i, w_i in zip(k, w):
+            t1 = h + (((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) ^ ((e >> 25) | (e << 7))) + ((e & f) ^ (~e & g)) + k_i + w_i
+            t2 = (((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) ^ ((a >> 22) | (a << 10))) + ((a & b) ^ (a & c) ^ (b & c))
+            a, b, c, d, e, f, g, h = (t1 + t2) & 0xffffffff, a, b, c, (d + t1) & 0xffffffff, e, f, g
+        
+        state = struct.pack('>8I', *((x + y) & 0xffffffff for x, y in zip(start_state, [a, b, c, d, e, f, g, h])))
+    return state
+
+# process(state, data) runs the compression function over every 64-byte block of data
+try:
+    from fast_sha256 import process # compiled backend, built from fast_sha256/
+except ImportError:
+    process = python_process
 
 
 initial_state = struct.pack('>8I', 0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
@@ -47,15 +51,12 @@ class sha256(object):
         self.update(data)
     
     def update(self, data):
-        state = self.state
         buf = self.buf + data
         
-        chunks = [buf[i:i + self.block_size] for i in xrange(0, len(buf) + 1, self.block_size)]
-        for chunk in chunks[:-1]:
-            state = process(state, chunk)
-        
-        self.state = state
-        self.buf = chunks[-1]
+        full = len(buf) - len(buf) % self.block_size
+        if full:
+            self.state = process(self.state, buf[:full])
+        self.buf = buf[full:]
         
         self.length += 8*len(data)
     
@@ -63,13 +64,7 @@ class sha256(object):
         return self.__class__(data, (self.state, self.buf, self.length))
     
     def digest(self):
-        state = self.state
-        buf = self.buf + '\x80' + '\x00'*((self.block_size - 9 - len(self.buf)) % self.block_size) + struct.pack('>Q', self.length)
-        
-        for chunk in [buf[i:i + self.block_size] for i in xrange(0, len(buf), self.block_size)]:
-            state = process(state, chunk)
-        
-        return state
+        return process(self.state, self.buf + '\x80' + '\x00'*((self.block_size - 9 - len(self.buf)) % self.block_size) + struct.pack('>Q', self.length))
     
     def hexdigest(self):
         return self.digest().encode('hex')
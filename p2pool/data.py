@@ -1,16 +1,24 @@
 from __future__ import division
 
+import array
+import bisect
+import collections
 import hashlib
+import itertools
+import mmap
+import operator
 import os
 import random
 import sys
 import time
+import zlib
 
+from twisted.internet import defer
 from twisted.python import log
 
 import p2pool
 from p2pool.bitcoin import data as bitcoin_data, script, sha256
-from p2pool.util import math, forest, pack
+from p2pool.util import math, forest, memoize, pack
 
 # hashlink
 
@@ -30,7 +38,7 @@ def check_hash_link(hash_link, data, const_ending=''):
     assert len(hash_link['extra_data']) == max(0, extra_length - len(const_ending))
     extra = (hash_link['extra_data'] + const_ending)[len(hash_link['extra_data']) + len(const_ending) - extra_length:]
     assert len(extra) == extra_length
-    return pack.IntType(256).unpack(hashlib.sha256(sha256.sha256(data, (hash_link['state'], extra, 8*hash_link['length'])).digest()).digest())
+    return bitcoin_data.hash_to_int(hashlib.sha256(sha256.sha256(data, (hash_link['state'], extra, 8*hash_link['length'])).digest()).digest())
 
 # shares
 
@@ -39,18 +47,52 @@ share_type = pack.ComposedType([
     ('contents', pack.VarStrType()),
 ])
 
-def load_share(share, net, peer_addr):
+def load_share(share, net, peer_addr, pow_hash=None, gentx_hash=None, header_hash=None):
     assert peer_addr is None or isinstance(peer_addr, tuple)
     if share['type'] in [0, 1, 2, 3, 4, 5, 6, 7, 8]:
         from p2pool import p2p
         raise p2p.PeerMisbehavingError('sent an obsolete share')
     elif share['type'] == Share.VERSION:
-        return Share(net, peer_addr, Share.share_type.unpack(share['contents']))
+        return Share(net, peer_addr, Share.share_type.unpack(share['contents']), pow_hash, share['contents'], gentx_hash, header_hash)
     else:
         raise ValueError('unknown share type: %r' % (share['type'],))
 
+def get_share_hashes(net_name, raw_shares):
+    # runs in a worker process, returning (pow_hash, gentx_hash, header_hash) for each share
+    # None means "couldn't tell", and the share is then fully checked when it's loaded
+    from p2pool import networks
+    net = networks.nets[net_name]
+    res = []
+    for type_, contents in raw_shares:
+        try:
+            share = load_share(dict(type=type_, contents=contents), net, None)
+        except Exception:
+            res.append(None)
+        else:
+            res.append((share.pow_hash, share.gentx_hash, share.header_hash))
+    return res
+
+def load_shares(shares, net, peer_addr, pool=None):
+    '''
+    Like load_share, but for a list of shares, returning a Deferred. If a
+    processpool.ProcessPool is given, the proof-of-work, gentx and header
+    hashes are computed by its workers, so that the reactor only has to unpack
+    each share once and isn't blocked for large batches.
+    '''
+    if pool is None or pool.processes == 0 or not shares:
+        return defer.maybeDeferred(lambda: [load_share(share, net, peer_addr) for share in shares])
+    
+    raw_shares = [(share['type'], share['contents']) for share in shares]
+    chunk_size = -(-len(raw_shares)//pool.processes)
+    df = pool.map(get_share_hashes, [(net.NAME, raw_shares[i:i + chunk_size]) for i in xrange(0, len(raw_shares), chunk_size)])
+    df.addCallback(lambda hash_lists: [load_share(share, net, peer_addr, *(hashes or ()))
+        for share, hashes in zip(shares, (hashes for hashes_list in hash_lists for hashes in hashes_list))])
+    return df
+
 DONATION_SCRIPT = '4104ffd03de44a6e11b9917f3a29f9443283d9871c9d743ef30d5eddcd37094b64d1b3d8090496b53256786bf5c82932ec23c3b74d9f05a6f95a8b5529352656664bac'.decode('hex')
 
+stale_info_type = pack.EnumType(pack.IntType(8), dict((k, {0: None, 253: 'orphan', 254: 'doa'}.get(k, 'unk%i' % (k,))) for k in xrange(256)))
+
 class Share(object):
     VERSION = 9
     SUCCESSOR = None
@@ -65,17 +107,19 @@ class Share(object):
         ('nonce', pack.IntType(32)),
     ])
     
+    share_data_type = pack.ComposedType([
+        ('previous_share_hash', pack.PossiblyNoneType(0, pack.IntType(256))),
+        ('coinbase', pack.VarStrType()),
+        ('nonce', pack.IntType(32)),
+        ('pubkey_hash', pack.IntType(160)),
+        ('subsidy', pack.IntType(64)),
+        ('donation', pack.IntType(16)),
+        ('stale_info', stale_info_type),
+        ('desired_version', pack.VarIntType()),
+    ])
+    
     share_info_type = pack.ComposedType([
-        ('share_data', pack.ComposedType([
-            ('previous_share_hash', pack.PossiblyNoneType(0, pack.IntType(256))),
-            ('coinbase', pack.VarStrType()),
-            ('nonce', pack.IntType(32)),
-            ('pubkey_hash', pack.IntType(160)),
-            ('subsidy', pack.IntType(64)),
-            ('donation', pack.IntType(16)),
-            ('stale_info', pack.EnumType(pack.IntType(8), dict((k, {0: None, 253: 'orphan', 254: 'doa'}.get(k, 'unk%i' % (k,))) for k in xrange(256)))),
-            ('desired_version', pack.VarIntType()),
-        ])),
+        ('share_data', share_data_type),
         ('new_transaction_hashes', pack.ListType(pack.IntType(256))),
         ('transaction_hash_refs', pack.ListType(pack.VarIntType(), 2)), # pairs of share_count, tx_count
         ('far_share_hash', pack.PossiblyNoneType(0, pack.IntType(256))),
@@ -107,7 +151,8 @@ class Share(object):
     gentx_before_refhash = pack.VarStrType().pack(DONATION_SCRIPT) + pack.IntType(64).pack(0) + pack.VarStrType().pack('\x24' + pack.IntType(256).pack(0) + pack.IntType(32).pack(0))[:2]
     
     @classmethod
-    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None):
+    def generate_transaction(cls, tracker, share_data, block_target, desired_timestamp, desired_target, ref_merkle_link, desired_other_transaction_hashes_and_fees, net, known_txs=None, last_txout_nonce=0, base_subsidy=None, merkle_tree=None):
+        # merkle_tree, if given, is a MerkleTree over [None] + the desired tx hashes that the caller keeps between calls
         previous_share = tracker.items[share_data['previous_share_hash']] if share_data['previous_share_hash'] is not None else None
         
         height, last = tracker.get_height_and_last(share_data['previous_share_hash'])
@@ -126,17 +171,14 @@ class Share(object):
         new_transaction_size = 0
         transaction_hash_refs = []
         other_transaction_hashes = []
+        new_merkle_tree = merkle_tree is None
+        if new_merkle_tree:
+            merkle_tree = bitcoin_data.MerkleTree([None]) # gentx goes first
         
-        past_shares = list(tracker.get_chain(share_data['previous_share_hash'], min(height, 100)))
-        tx_hash_to_this = {}
-        for i, share in enumerate(past_shares):
-            for j, tx_hash in enumerate(share.new_transaction_hashes):
-                if tx_hash not in tx_hash_to_this:
-                    tx_hash_to_this[tx_hash] = [1+i, j] # share_count, tx_count
+        tx_hash_to_this = get_transaction_refs(tracker, share_data['previous_share_hash'], min(height, 100))
         for tx_hash, fee in desired_other_transaction_hashes_and_fees:
-            if tx_hash in tx_hash_to_this:
-                this = tx_hash_to_this[tx_hash]
-            else:
+            this = tx_hash_to_this.get(tx_hash)
+            if this is None:
                 if known_txs is not None:
                     this_size = bitcoin_data.tx_type.packed_size(known_txs[tx_hash])
                     if new_transaction_size + this_size > 50000: # only allow 50 kB of new txns/share
@@ -146,6 +188,8 @@ class Share(object):
                 this = [0, len(new_transaction_hashes)-1]
             transaction_hash_refs.extend(this)
             other_transaction_hashes.append(tx_hash)
+            if new_merkle_tree:
+                merkle_tree.append(tx_hash)
         
         included_transactions = set(other_transaction_hashes)
         removed_fees = [fee for tx_hash, fee in desired_other_transaction_hashes_and_fees if tx_hash not in included_transactions]
@@ -199,6 +243,8 @@ class Share(object):
             lock_time=0,
         )
         
+        merkle_link = merkle_tree.get_link(0, 1 + len(other_transaction_hashes)) # the desired txs after the 50 kB of new ones are left out
+        
         def get_share(header, last_txout_nonce=last_txout_nonce):
             min_header = dict(header); del min_header['merkle_root']
             share = cls(net, None, dict(
@@ -207,64 +253,71 @@ class Share(object):
                 ref_merkle_link=dict(branch=[], index=0),
                 last_txout_nonce=last_txout_nonce,
                 hash_link=prefix_to_hash_link(bitcoin_data.tx_type.pack(gentx)[:-32-4-4], cls.gentx_before_refhash),
-                merkle_link=bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0),
+                merkle_link=merkle_link,
             ))
             assert share.header == header # checks merkle_root
             return share
         
-        return share_info, gentx, other_transaction_hashes, get_share
+        return share_info, gentx, other_transaction_hashes, merkle_link, get_share
     
     @classmethod
     def get_ref_hash(cls, net, share_info, ref_merkle_link):
-        return pack.IntType(256).pack(bitcoin_data.check_merkle_link(bitcoin_data.hash256(cls.ref_type.pack(dict(
+        return bitcoin_data.check_merkle_link_raw(bitcoin_data.sha256d(cls.ref_type.pack(dict(
             identifier=net.IDENTIFIER,
             share_info=share_info,
-        ))), ref_merkle_link))
+        ))), ref_merkle_link)
+    
+    __slots__ = 'net peer_addr packed _contents hash max_target target timestamp previous_hash new_script desired_version gentx_hash merkle_root pow_hash header_hash time_seen'.split(' ')
     
-    __slots__ = 'net peer_addr contents min_header share_info hash_link merkle_link hash share_data max_target target timestamp previous_hash new_script desired_version gentx_hash header pow_hash header_hash new_transaction_hashes time_seen'.split(' ')
+    COMPACT = True # if set, only packed and the scalars above are kept, and everything else is decoded from packed when used. otherwise the unpacked contents are kept as well, trading memory for faster access
     
-    def __init__(self, net, peer_addr, contents):
+    def __init__(self, net, peer_addr, contents, pow_hash=None, packed=None, gentx_hash=None, header_hash=None):
         self.net = net
         self.peer_addr = peer_addr
-        self.contents = contents
+        self.packed = packed if packed is not None else self.share_type.pack(contents)
+        self._contents = None if self.COMPACT else contents
         
-        self.min_header = contents['min_header']
-        self.share_info = contents['share_info']
-        self.hash_link = contents['hash_link']
-        self.merkle_link = contents['merkle_link']
+        share_info = contents['share_info']
+        share_data = share_info['share_data']
+        hash_link = contents['hash_link']
+        merkle_link = contents['merkle_link']
         
-        if not (2 <= len(self.share_info['share_data']['coinbase']) <= 100):
-            raise ValueError('''bad coinbase size! %i bytes''' % (len(self.share_info['share_data']['coinbase']),))
+        if not (2 <= len(share_data['coinbase']) <= 100):
+            raise ValueError('''bad coinbase size! %i bytes''' % (len(share_data['coinbase']),))
         
-        if len(self.merkle_link['branch']) > 16:
+        if len(merkle_link['branch']) > 16:
             raise ValueError('merkle branch too long!')
         
-        assert not self.hash_link['extra_data'], repr(self.hash_link['extra_data'])
+        assert not hash_link['extra_data'], repr(hash_link['extra_data'])
         
-        self.share_data = self.share_info['share_data']
-        self.max_target = self.share_info['max_bits'].target
-        self.target = self.share_info['bits'].target
-        self.timestamp = self.share_info['timestamp']
-        self.previous_hash = self.share_data['previous_share_hash']
-        self.new_script = bitcoin_data.pubkey_hash_to_script2(self.share_data['pubkey_hash'])
-        self.desired_version = self.share_data['desired_version']
+        self.max_target = share_info['max_bits'].target
+        self.target = share_info['bits'].target
+        self.timestamp = share_info['timestamp']
+        self.previous_hash = share_data['previous_share_hash']
+        self.new_script = bitcoin_data.pubkey_hash_to_script2(share_data['pubkey_hash'])
+        self.desired_version = share_data['desired_version']
         
         n = set()
-        for share_count, tx_count in self.iter_transaction_hash_refs():
+        for share_count, tx_count in zip(share_info['transaction_hash_refs'][::2], share_info['transaction_hash_refs'][1::2]):
             assert share_count < 110
             if share_count == 0:
                 n.add(tx_count)
-        assert n == set(range(len(self.share_info['new_transaction_hashes'])))
+        assert n == set(range(len(share_info['new_transaction_hashes'])))
         
         self.gentx_hash = check_hash_link(
-            self.hash_link,
-            self.get_ref_hash(net, self.share_info, contents['ref_merkle_link']) + pack.IntType(32).pack(self.contents['last_txout_nonce']) + pack.IntType(32).pack(0),
+            hash_link,
+            self.get_ref_hash(net, share_info, contents['ref_merkle_link']) + pack.IntType(32).pack(contents['last_txout_nonce']) + pack.IntType(32).pack(0),
             self.gentx_before_refhash,
-        )
-        merkle_root = bitcoin_data.check_merkle_link(self.gentx_hash, self.merkle_link)
-        self.header = dict(self.min_header, merkle_root=merkle_root)
-        self.pow_hash = net.PARENT.POW_FUNC(bitcoin_data.block_header_type.pack(self.header))
-        self.hash = self.header_hash = bitcoin_data.hash256(bitcoin_data.block_header_type.pack(self.header))
+        ) if gentx_hash is None else gentx_hash
+        self.merkle_root = bitcoin_data.check_merkle_link(self.gentx_hash, merkle_link)
+        if pow_hash is None or header_hash is None:
+            packed_header = bitcoin_data.block_header_type.pack(dict(contents['min_header'], merkle_root=self.merkle_root))
+            if pow_hash is None:
+                pow_hash = net.PARENT.POW_FUNC(packed_header)
+            if header_hash is None:
+                header_hash = bitcoin_data.hash256(packed_header)
+        self.pow_hash = pow_hash
+        self.hash = self.header_hash = header_hash
         
         if self.target > net.MAX_TARGET:
             from p2pool import p2p
@@ -274,24 +327,68 @@ class Share(object):
             from p2pool import p2p
             raise p2p.PeerMisbehavingError('share PoW invalid')
         
-        self.new_transaction_hashes = self.share_info['new_transaction_hashes']
-        
         # XXX eww
         self.time_seen = time.time()
     
+    @property
+    def contents(self):
+        if self._contents is not None:
+            return self._contents
+        return self.share_type.unpack(self.packed)
+    
+    @property
+    def min_header(self):
+        if self._contents is not None:
+            return self._contents['min_header']
+        return self.small_block_header_type.read((self.packed, 0))[0]
+    
+    @property
+    def share_data(self):
+        if self._contents is not None:
+            return self._contents['share_info']['share_data']
+        # share_data directly follows min_header, so the rest doesn't have to be decoded
+        return self.share_data_type.read(self.small_block_header_type.read((self.packed, 0))[1])[0]
+    
+    @property
+    def share_info(self):
+        if self._contents is not None:
+            return self._contents['share_info']
+        # hash_link and merkle_link come after share_info and aren't decoded
+        return self.share_info_type.read(self.small_block_header_type.read((self.packed, 0))[1])[0]
+    
+    @property
+    def hash_link(self):
+        return self.contents['hash_link']
+    
+    @property
+    def merkle_link(self):
+        return self.contents['merkle_link']
+    
+    @property
+    def new_transaction_hashes(self):
+        return self.share_info['new_transaction_hashes']
+    
+    @property
+    def header(self):
+        return dict(self.min_header, merkle_root=self.merkle_root)
+    
     def __repr__(self):
         return 'Share' + repr((self.net, self.peer_addr, self.contents))
     
     def as_share(self):
-        return dict(type=self.VERSION, contents=self.share_type.pack(self.contents))
+        return dict(type=self.VERSION, contents=self.packed)
     
-    def iter_transaction_hash_refs(self):
-        return zip(self.share_info['transaction_hash_refs'][::2], self.share_info['transaction_hash_refs'][1::2])
+    def iter_transaction_hash_refs(self, share_info=None):
+        # share_info can be passed in by callers that already decoded it
+        transaction_hash_refs = (share_info if share_info is not None else self.share_info)['transaction_hash_refs']
+        return zip(transaction_hash_refs[::2], transaction_hash_refs[1::2])
     
     def check(self, tracker):
         from p2pool import p2p
-        if self.share_data['previous_share_hash'] is not None:
-            previous_share = tracker.items[self.share_data['previous_share_hash']]
+        contents = self.contents # decoded once here, as it's needed repeatedly
+        
+        if self.previous_hash is not None:
+            previous_share = tracker.items[self.previous_hash]
             if type(self) is type(previous_share):
                 pass
             elif type(self) is type(previous_share).SUCCESSOR:
@@ -307,30 +404,35 @@ class Share(object):
             else:
                 raise p2p.PeerMisbehavingError('''%s can't follow %s''' % (type(self).__name__, type(previous_share).__name__))
         
-        other_tx_hashes = [tracker.items[tracker.get_nth_parent_hash(self.hash, share_count)].share_info['new_transaction_hashes'][tx_count] for share_count, tx_count in self.iter_transaction_hash_refs()]
+        parent_tx_hashes = memoize.cdict(lambda share_count: tracker.items[tracker.get_nth_parent_hash(self.hash, share_count)].new_transaction_hashes if share_count else contents['share_info']['new_transaction_hashes'])
+        other_tx_hashes = [parent_tx_hashes[share_count][tx_count] for share_count, tx_count in self.iter_transaction_hash_refs(contents['share_info'])]
         
-        share_info, gentx, other_tx_hashes2, get_share = self.generate_transaction(tracker, self.share_info['share_data'], self.header['bits'].target, self.share_info['timestamp'], self.share_info['bits'].target, self.contents['ref_merkle_link'], [(h, None) for h in other_tx_hashes], self.net, last_txout_nonce=self.contents['last_txout_nonce'])
+        share_info, gentx, other_tx_hashes2, merkle_link, get_share = self.generate_transaction(tracker, contents['share_info']['share_data'], contents['min_header']['bits'].target, contents['share_info']['timestamp'], contents['share_info']['bits'].target, contents['ref_merkle_link'], [(h, None) for h in other_tx_hashes], self.net, last_txout_nonce=contents['last_txout_nonce'])
         assert other_tx_hashes2 == other_tx_hashes
-        if share_info != self.share_info:
+        if share_info != contents['share_info']:
             raise ValueError('share_info invalid')
         if bitcoin_data.hash256(bitcoin_data.tx_type.pack(gentx)) != self.gentx_hash:
             raise ValueError('''gentx doesn't match hash_link''')
         
-        if bitcoin_data.calculate_merkle_link([None] + other_tx_hashes, 0) != self.merkle_link:
+        if merkle_link != contents['merkle_link']:
             raise ValueError('merkle_link and other_tx_hashes do not match')
         
         return gentx # only used by as_block
     
-    def get_other_tx_hashes(self, tracker):
-        parents_needed = max(share_count for share_count, tx_count in self.iter_transaction_hash_refs()) if self.share_info['transaction_hash_refs'] else 0
+    def get_other_tx_hashes(self, tracker, share_info=None):
+        if share_info is None:
+            share_info = self.share_info
+        transaction_hash_refs = self.iter_transaction_hash_refs(share_info)
+        parents_needed = max(share_count for share_count, tx_count in transaction_hash_refs) if transaction_hash_refs else 0
         parents = tracker.get_height(self.hash) - 1
         if parents < parents_needed:
             return None
         last_shares = list(tracker.get_chain(self.hash, parents_needed + 1))
-        return [last_shares[share_count].share_info['new_transaction_hashes'][tx_count] for share_count, tx_count in self.iter_transaction_hash_refs()]
+        parent_tx_hashes = memoize.cdict(lambda share_count: last_shares[share_count].new_transaction_hashes if share_count else share_info['new_transaction_hashes'])
+        return [parent_tx_hashes[share_count][tx_count] for share_count, tx_count in transaction_hash_refs]
     
-    def _get_other_txs(self, tracker, known_txs):
-        other_tx_hashes = self.get_other_tx_hashes(tracker)
+    def _get_other_txs(self, tracker, known_txs, share_info=None):
+        other_tx_hashes = self.get_other_tx_hashes(tracker, share_info)
         if other_tx_hashes is None:
             return None # not all parents present
         
@@ -340,13 +442,15 @@ class Share(object):
         return [known_txs[tx_hash] for tx_hash in other_tx_hashes]
     
     def should_punish_reason(self, previous_block, bits, tracker, known_txs):
-        if (self.header['previous_block'], self.header['bits']) != (previous_block, bits) and self.header_hash != previous_block and self.peer_addr is not None:
-            return True, 'Block-stale detected! %x < %x' % (self.header['previous_block'], previous_block)
+        min_header = self.min_header
+        if (min_header['previous_block'], min_header['bits']) != (previous_block, bits) and self.header_hash != previous_block and self.peer_addr is not None:
+            return True, 'Block-stale detected! %x < %x' % (min_header['previous_block'], previous_block)
         
-        if self.pow_hash <= self.header['bits'].target:
+        if self.pow_hash <= min_header['bits'].target:
             return -1, 'block solution'
         
-        other_txs = self._get_other_txs(tracker, known_txs)
+        share_info = self.share_info
+        other_txs = self._get_other_txs(tracker, known_txs, share_info)
         if other_txs is None:
             if self.time_seen != 0: # ignore if loaded from ShareStore
                 return True, 'not all txs present'
@@ -355,7 +459,7 @@ class Share(object):
             if all_txs_size > 1000000:
                 return True, 'txs over block size limit'
             
-            new_txs_size = sum(bitcoin_data.tx_type.packed_size(known_txs[tx_hash]) for tx_hash in self.share_info['new_transaction_hashes'])
+            new_txs_size = sum(bitcoin_data.tx_type.packed_size(known_txs[tx_hash]) for tx_hash in share_info['new_transaction_hashes'])
             if new_txs_size > 50000:
                 return True, 'new txs over limit'
         
@@ -368,9 +472,240 @@ class Share(object):
         return dict(header=self.header, txs=[self.check(tracker)] + other_txs)
 
 
+def get_transaction_refs(tracker, previous_share_hash, count):
+    index = getattr(tracker, 'tx_refs', None)
+    if index is not None and index.covers(previous_share_hash, count):
+        return index
+    
+    tx_hash_to_this = {}
+    for i, share in enumerate(tracker.get_chain(previous_share_hash, count)):
+        for j, tx_hash in enumerate(share.new_transaction_hashes):
+            if tx_hash not in tx_hash_to_this:
+                tx_hash_to_this[tx_hash] = [1+i, j] # share_count, tx_count
+    return tx_hash_to_this
+
+class TransactionRefIndex(object):
+    '''
+    Maps the hashes of transactions introduced by the last LOOKBEHIND shares
+    ending at head to the [share_count, tx_count] pair a child of head would
+    use to refer to them. Rolled forward as head advances instead of being
+    rebuilt for every generated or checked share.
+    '''
+    
+    LOOKBEHIND = 100
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.head = None
+        self._valid = True
+        self._seq = 0 # sequence number of head
+        self._window = collections.deque() # (share_hash, new_transaction_hashes), oldest first
+        self._window_hashes = set()
+        self._refs = {} # tx_hash -> list of (seq, tx_count), oldest first
+        
+        self.tracker.removed_many.watch_weakref(self, lambda self, shares: self._handle_removed_many(shares))
+    
+    def _handle_removed_many(self, shares):
+        if any(share.hash in self._window_hashes for share in shares):
+            self._valid = False
+    
+    def _push(self, share):
+        new_transaction_hashes = share.new_transaction_hashes
+        self._seq += 1
+        self._window.append((share.hash, new_transaction_hashes))
+        self._window_hashes.add(share.hash)
+        for j, tx_hash in enumerate(new_transaction_hashes):
+            refs = self._refs.setdefault(tx_hash, [])
+            if not refs or refs[-1][0] != self._seq:
+                refs.append((self._seq, j))
+        
+        if len(self._window) > self.LOOKBEHIND:
+            oldest_seq = self._seq - len(self._window) + 1
+            share_hash, tx_hashes = self._window.popleft()
+            self._window_hashes.remove(share_hash)
+            for tx_hash in tx_hashes:
+                refs = self._refs.get(tx_hash)
+                if refs and refs[0][0] == oldest_seq:
+                    refs.pop(0)
+                    if not refs:
+                        del self._refs[tx_hash]
+    
+    def _reset(self, head):
+        self.head = head
+        self._valid = True
+        self._window.clear()
+        self._window_hashes.clear()
+        self._refs.clear()
+        if head is not None:
+            for share in reversed(list(self.tracker.get_chain(head, min(self.tracker.get_height(head), self.LOOKBEHIND)))):
+                self._push(share)
+    
+    def set_head(self, head):
+        if not self._valid or head is None or head not in self.tracker.items:
+            self._reset(head if head is None or head in self.tracker.items else None)
+            return
+        if head == self.head:
+            return
+        
+        new_shares = []
+        for share in self.tracker.get_chain(head, min(self.tracker.get_height(head), self.LOOKBEHIND)):
+            if share.hash == self.head:
+                break
+            new_shares.append(share)
+        else:
+            self._reset(head)
+            return
+        self.head = head
+        for share in reversed(new_shares):
+            self._push(share)
+    
+    def covers(self, share_hash, count):
+        if not self._valid:
+            self.set_head(self.head)
+        return share_hash == self.head and len(self._window) == count
+    
+    def get(self, tx_hash, default=None):
+        refs = self._refs.get(tx_hash)
+        if not refs:
+            return default
+        seq, tx_count = refs[-1]
+        return [self._seq - seq + 1, tx_count]
+
+
+class WeightsWindow(object):
+    '''
+    The shares counted by a cumulative weights query, kept so that the query
+    for a child of head can be answered by adding the child and trimming the
+    tail instead of walking the chain again.
+    '''
+    
+    def __init__(self, head, max_shares, desired_weight):
+        assert desired_weight % 65535 == 0, divmod(desired_weight, 65535)
+        self.head = head
+        self.max_shares = max_shares
+        self.desired_weight = desired_weight
+        self.items = collections.deque() # (script, weight, total_weight, donation_weight) of fully counted shares, head first
+        self.weights = {}
+        self.total_weight = 0
+        self.total_donation_weight = 0
+        self.partial = None # item of the share after the last one, if it is partially counted
+    
+    @classmethod
+    def from_chain(cls, tracker, head, max_shares, desired_weight):
+        self = cls(head, max_shares, desired_weight)
+        for share in tracker.get_chain(head, max_shares):
+            item = self.get_item(share)
+            if self.total_weight + item[2] > desired_weight:
+                self.partial = item
+                break
+            self.items.append(item)
+            self._add(item, 1)
+            if self.total_weight == desired_weight:
+                break
+        return self
+    
+    @staticmethod
+    def get_item(share):
+        att = bitcoin_data.target_to_average_attempts(share.target)
+        return share.new_script, att*(65535-share.share_data['donation']), att*65535, att*share.share_data['donation']
+    
+    def _add(self, (script, weight, total_weight, donation_weight), sign):
+        new_weight = self.weights.get(script, 0) + sign*weight
+        if new_weight:
+            self.weights[script] = new_weight
+        else:
+            self.weights.pop(script, None)
+        self.total_weight += sign*total_weight
+        self.total_donation_weight += sign*donation_weight
+    
+    def extend(self, share, max_shares):
+        '''
+        Moves head to share, a child of head. Returns False if the window would
+        have to grow past its tail, in which case it is left unusable.
+        '''
+        assert share.previous_hash == self.head
+        if max_shares > self.max_shares + 1:
+            return False
+        
+        item = self.get_item(share)
+        self.items.appendleft(item)
+        self._add(item, 1)
+        
+        next_item = self.partial
+        while len(self.items) > max_shares or self.total_weight > self.desired_weight:
+            next_item = self.items.pop()
+            self._add(next_item, -1)
+        
+        if len(self.items) < max_shares and self.total_weight < self.desired_weight:
+            if next_item is None:
+                return False
+            self.partial = next_item
+        else:
+            self.partial = None
+        
+        self.head = share.hash
+        self.max_shares = max_shares
+        return True
+    
+    def get_result(self):
+        weights = dict(self.weights)
+        total_weight = self.total_weight
+        total_donation_weight = self.total_donation_weight
+        if self.partial is not None:
+            script, weight, item_total_weight, donation_weight = self.partial
+            amount = (self.desired_weight - total_weight)//65535
+            weights[script] = weights.get(script, 0) + amount*weight//(item_total_weight//65535)
+            total_donation_weight += amount*donation_weight//(item_total_weight//65535)
+            total_weight = self.desired_weight
+        return dict((script, weight) for script, weight in weights.iteritems() if weight), total_weight, total_donation_weight
+
 class WeightsSkipList(forest.TrackerSkipList):
     # share_count, weights, total_weight
     
+    def __init__(self, tracker):
+        forest.TrackerSkipList.__init__(self, tracker)
+        
+        self.results = memoize.LRUDict(20) # (start, max_shares, desired_weight) -> result
+        self.windows = memoize.LRUDict(4) # (head, max_shares, desired_weight) -> WeightsWindow
+        self.hits = self.misses = self.derived = 0
+    
+    def forget_item(self, item):
+        forest.TrackerSkipList.forget_item(self, item)
+        for key in [key for key in self.windows.inner if key[0] == item]:
+            self.windows.pop(key)
+    
+    def __call__(self, start, max_shares, desired_weight):
+        key = start, max_shares, desired_weight
+        res = self.results.get(key)
+        if res is not None:
+            self.hits += 1
+            return res
+        self.misses += 1
+        
+        window = self._get_window(start, max_shares, desired_weight)
+        if window is not None:
+            res = window.get_result()
+        else:
+            res = forest.TrackerSkipList.__call__(self, start, max_shares, desired_weight)
+        self.results[key] = res
+        return res
+    
+    def _get_window(self, start, max_shares, desired_weight):
+        if start is None:
+            return None
+        
+        share = self.tracker.items[start]
+        window = self.windows.pop((share.previous_hash, max_shares, desired_weight)) or self.windows.pop((share.previous_hash, max_shares - 1, desired_weight))
+        if window is not None and window.extend(share, max_shares):
+            self.derived += 1
+        elif start in self.tracker.heads:
+            # only worth walking the whole chain for heads, which are likely to be extended
+            window = WeightsWindow.from_chain(self.tracker, start, max_shares, desired_weight)
+        else:
+            return None
+        self.windows[start, max_shares, desired_weight] = window
+        return window
+    
     def get_delta(self, element):
         from p2pool.bitcoin import data as bitcoin_data
         share = self.tracker.items[element]
@@ -410,12 +745,64 @@ class OkayTracker(forest.Tracker):
         forest.Tracker.__init__(self, delta_type=forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
             work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
             min_work=lambda share: bitcoin_data.target_to_average_attempts(share.max_target),
-        )))
+        )), view_type=forest.ArrayTrackerView)
         self.net = net
         self.verified = forest.SubsetTracker(delta_type=forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
             work=lambda share: bitcoin_data.target_to_average_attempts(share.target),
-        )), subset_of=self)
+        )), view_type=forest.ArrayTrackerView, subset_of=self)
         self.get_cumulative_weights = WeightsSkipList(self)
+        self.tx_refs = TransactionRefIndex(self)
+        self._windows = memoize.LRUDict(8) # (head, length) -> ChainWindow, for the stats functions below
+        self.removed_many.watch_weakref(self, lambda self, shares: self._forget_windows(shares))
+        
+        # state kept between calls to think, so that only heads whose chains changed since the last call are looked at again
+        self._dirty_heads = set() # heads (or former heads) of self touched by added/removed_many since the last call
+        self._dirty_verified_heads = set() # same, for self.verified
+        self._wants = {} # unverified head -> (last, max timestamp, min target) of the parent it's waiting for
+        self._short_heads = set() # verified heads with less than CHAIN_LENGTH height
+        self._head_entries = {} # verified head -> (tail, decoration), decoration being its key in self._sorted_heads
+        self._sorted_heads = {} # verified tail -> sorted list of (decoration, head) of its heads
+        self._tail_best = {} # verified tail -> (work, head) of its head with the most work
+        self._scores = {} # verified head -> ((height, last), score), for self._score_inputs
+        self._score_inputs = None
+        self._punishments = {} # head -> should_punish_reason result, for self._punish_inputs
+        self._punish_inputs = None
+        self._punish_txs = {} # head -> hashes of the txs its entry in self._punishments depends on
+        self._punish_tx_heads = {} # tx hash -> heads in self._punish_txs that depend on it
+        self.added.watch_weakref(self, lambda self, share: self._mark_added(self, self._dirty_heads, share))
+        self.removed_many.watch_weakref(self, lambda self, shares: self._mark_removed(self, self._dirty_heads, shares))
+        self.verified.added.watch_weakref(self, lambda self, share: self._mark_added(self.verified, self._dirty_verified_heads, share))
+        self.verified.removed_many.watch_weakref(self, lambda self, shares: self._mark_removed(self.verified, self._dirty_verified_heads, shares))
+    
+    @staticmethod
+    def _mark_added(tracker, dirty, share):
+        dirty.add(share.previous_hash) # no longer a head
+        if share.hash in tracker.heads:
+            dirty.add(share.hash)
+        else:
+            # added below existing heads, which all get a new height and last
+            dirty.update(tracker.tails[tracker.get_last(share.hash)])
+    
+    @staticmethod
+    def _mark_removed(tracker, dirty, shares):
+        for share in shares:
+            dirty.add(share.hash)
+            if share.previous_hash in tracker.heads:
+                dirty.add(share.previous_hash)
+            dirty.update(tracker.tails.get(share.hash, ()))
+    
+    def get_state(self):
+        return dict(forest.Tracker.get_state(self),
+            verified=self.verified.get_state(),
+            weights_skips=self.get_cumulative_weights.skips,
+        )
+    
+    def set_state(self, items, state):
+        forest.Tracker.set_state(self, items, state)
+        self.verified.set_state(items, state['verified'])
+        self.get_cumulative_weights.skips = state['weights_skips']
+        self._dirty_heads.update(self.heads)
+        self._dirty_verified_heads.update(self.verified.heads)
     
     def attempt_verify(self, share):
         if share.hash in self.verified.items:
@@ -435,15 +822,19 @@ class OkayTracker(forest.Tracker):
     def think(self, block_rel_height_func, previous_block, bits, known_txs):
         desired = set()
         
-        # O(len(self.heads))
-        #   make 'unverified heads' set?
-        # for each overall head, attempt verification
+        # for each overall head whose chain changed, attempt verification
         # if it fails, attempt on parent, and repeat
         # if no successful verification because of lack of parents, request parent
+        # other heads keep the result they had, as checking is deterministic
+        dirty_heads, self._dirty_heads = self._dirty_heads, set()
         bads = set()
-        for head in set(self.heads) - set(self.verified.heads):
+        for head in dirty_heads:
+            self._wants.pop(head, None)
+            if head not in self.heads or head in self.verified.heads:
+                continue
             head_height, last = self.get_height_and_last(head)
             
+            want = None
             for share in self.get_chain(head, head_height if last is None else min(5, max(0, head_height - self.net.CHAIN_LENGTH))):
                 if self.attempt_verify(share):
                     break
@@ -451,21 +842,36 @@ class OkayTracker(forest.Tracker):
                     bads.add(share.hash)
             else:
                 if last is not None:
-                    desired.add((
-                        self.items[random.choice(list(self.reverse[last]))].peer_addr,
+                    want = (
                         last,
                         max(x.timestamp for x in self.get_chain(head, min(head_height, 5))),
                         min(x.target for x in self.get_chain(head, min(head_height, 5))),
-                    ))
+                    )
+            if want is not None:
+                if head in bads:
+                    desired.add((self.items[random.choice(list(self.reverse[want[0]]))].peer_addr,) + want)
+                else:
+                    self._wants[head] = want
+        for want in self._wants.itervalues():
+            desired.add((self.items[random.choice(list(self.reverse[want[0]]))].peer_addr,) + want)
         for bad in bads:
             assert bad not in self.verified.items
             assert bad in self.heads
             if p2pool.DEBUG:
                 print "BAD", bad
-            self.remove(bad)
+        self.remove_many(bads)
+        
+        # known_txs changing in place has to be signalled with forget_punishments
+        if self._punish_inputs is None or self._punish_inputs[:2] != (previous_block, bits) or self._punish_inputs[2] is not known_txs:
+            self._punish_inputs = previous_block, bits, known_txs
+            self._punishments.clear()
+            self._punish_txs.clear()
+            self._punish_tx_heads.clear()
+            self._dirty_verified_heads.update(self.verified.heads) # all decorations include a punishment
+        self._update_verified_heads()
         
         # try to get at least CHAIN_LENGTH height for each verified head, requesting parents if needed
-        for head in list(self.verified.heads):
+        for head in list(self._short_heads):
             head_height, last_hash = self.verified.get_height_and_last(head)
             last_height, last_last_hash = self.get_height_and_last(last_hash)
             # XXX review boundary conditions
@@ -483,9 +889,13 @@ class OkayTracker(forest.Tracker):
                     max(x.timestamp for x in self.get_chain(head, min(head_height, 5))),
                     min(x.target for x in self.get_chain(head, min(head_height, 5))),
                 ))
+        self._update_verified_heads() # for shares verified by the loop above
         
         # decide best tree
-        decorated_tails = sorted((self.score(max(self.verified.tails[tail_hash], key=self.verified.get_work), block_rel_height_func), tail_hash) for tail_hash in self.verified.tails)
+        if self._score_inputs != (block_rel_height_func, previous_block):
+            self._score_inputs = block_rel_height_func, previous_block
+            self._scores.clear()
+        decorated_tails = sorted((self._get_score(best_head, block_rel_height_func), tail_hash) for tail_hash, (work, best_head) in self._tail_best.iteritems())
         if p2pool.DEBUG:
             print len(decorated_tails), 'tails:'
             for score, tail_hash in decorated_tails:
@@ -493,12 +903,7 @@ class OkayTracker(forest.Tracker):
         best_tail_score, best_tail = decorated_tails[-1] if decorated_tails else (None, None)
         
         # decide best verified head
-        decorated_heads = sorted(((
-            self.verified.get_work(self.verified.get_nth_parent_hash(h, min(5, self.verified.get_height(h)))),
-            #self.items[h].peer_addr is None,
-            -self.items[h].should_punish_reason(previous_block, bits, self, known_txs)[0],
-            -self.items[h].time_seen,
-        ), h) for h in self.verified.tails.get(best_tail, []))
+        decorated_heads = self._sorted_heads.get(best_tail, [])
         if p2pool.DEBUG:
             print len(decorated_heads), 'heads. Top 10:'
             for score, head_hash in decorated_heads[-10:]:
@@ -507,7 +912,7 @@ class OkayTracker(forest.Tracker):
         
         if best is not None:
             best_share = self.items[best]
-            punish, punish_reason = best_share.should_punish_reason(previous_block, bits, self, known_txs)
+            punish, punish_reason = self._get_punishment(best)
             if punish > 0:
                 print 'Punishing share for %r! Jumping from %s to %s!' % (punish_reason, format_hash(best), format_hash(best_share.previous_hash))
                 best = best_share.previous_hash
@@ -523,7 +928,117 @@ class OkayTracker(forest.Tracker):
             for peer_addr, hash, ts, targ in desired:
                 print '   ', '%s:%i' % peer_addr, format_hash(hash), math.format_dt(time.time() - ts), bitcoin_data.target_to_difficulty(targ), ts >= timestamp_cutoff, targ <= target_cutoff
         
-        return best, [(peer_addr, hash) for peer_addr, hash, ts, targ in desired if ts >= timestamp_cutoff], decorated_heads
+        return best, [(peer_addr, hash) for peer_addr, hash, ts, targ in desired if ts >= timestamp_cutoff], list(decorated_heads)
+    
+    def _update_verified_heads(self):
+        # moves dirty verified heads to their place in self._sorted_heads, O(log heads) each
+        dirty_heads, self._dirty_verified_heads = self._dirty_verified_heads, set()
+        touched_tails = set()
+        lost_best = set() # tails whose best head was taken out
+        inserted = {} # tail -> heads put back in
+        for head in dirty_heads:
+            entry = self._head_entries.pop(head, None)
+            if entry is not None:
+                tail, decoration = entry
+                sorted_heads = self._sorted_heads[tail]
+                del sorted_heads[bisect.bisect_left(sorted_heads, (decoration, head))]
+                if not sorted_heads:
+                    del self._sorted_heads[tail]
+                if tail in self._tail_best and self._tail_best[tail][1] == head:
+                    lost_best.add(tail)
+                touched_tails.add(tail)
+            
+            if head not in self.verified.heads:
+                self._short_heads.discard(head)
+                self._scores.pop(head, None)
+                self._forget_punishment(head)
+                continue
+            
+            head_height = self.verified.get_height(head)
+            if head_height < self.net.CHAIN_LENGTH:
+                self._short_heads.add(head)
+            else:
+                self._short_heads.discard(head)
+            
+            tail = self.verified.heads[head]
+            decoration = (
+                self.verified.get_work(self.verified.get_nth_parent_hash(head, min(5, head_height))),
+                #self.items[head].peer_addr is None,
+                -self._get_punishment(head)[0],
+                -self.items[head].time_seen,
+            )
+            self._head_entries[head] = tail, decoration
+            bisect.insort(self._sorted_heads.setdefault(tail, []), (decoration, head))
+            inserted.setdefault(tail, []).append(head)
+            touched_tails.add(tail)
+        
+        for tail in touched_tails:
+            if tail not in self._sorted_heads:
+                self._tail_best.pop(tail, None)
+                continue
+            candidates = [(self.verified.get_work(head), head) for head in inserted.get(tail, [])]
+            old_best = self._tail_best.get(tail)
+            if old_best is not None and tail not in lost_best:
+                candidates.append(old_best)
+            elif old_best is not None and candidates and max(candidates)[0] >= old_best[0]:
+                pass # e.g. the best head was extended. heads that weren't touched have no more work than it had
+            else:
+                candidates = [(self.verified.get_work(head), head) for decoration, head in self._sorted_heads[tail]]
+            self._tail_best[tail] = max(candidates)
+    
+    def _get_score(self, share_hash, block_rel_height_func):
+        key = self.verified.get_height_and_last(share_hash)
+        cached = self._scores.get(share_hash)
+        if cached is None or cached[0] != key:
+            cached = self._scores[share_hash] = key, self.score(share_hash, block_rel_height_func)
+        return cached[1]
+    
+    def forget_punishments(self, tx_hashes=None):
+        # with tx_hashes, only heads whose txs include one of them are looked at again
+        if tx_hashes is None:
+            self._punish_inputs = None
+            return
+        for tx_hash in tx_hashes:
+            for head in list(self._punish_tx_heads.get(tx_hash, ())):
+                self._forget_punishment(head)
+                self._dirty_verified_heads.add(head)
+    
+    def _forget_punishment(self, share_hash):
+        self._punishments.pop(share_hash, None)
+        for tx_hash in self._punish_txs.pop(share_hash, ()):
+            heads = self._punish_tx_heads[tx_hash]
+            heads.discard(share_hash)
+            if not heads:
+                del self._punish_tx_heads[tx_hash]
+    
+    def _get_punishment(self, share_hash):
+        if share_hash not in self._punishments:
+            previous_block, bits, known_txs = self._punish_inputs
+            share = self.items[share_hash]
+            self._punishments[share_hash] = share.should_punish_reason(previous_block, bits, self, known_txs)
+            tx_hashes = share.get_other_tx_hashes(self) or []
+            self._punish_txs[share_hash] = tx_hashes
+            for tx_hash in tx_hashes:
+                self._punish_tx_heads.setdefault(tx_hash, set()).add(share_hash)
+        return self._punishments[share_hash]
+    
+    def get_window(self, share_hash, length):
+        # the returned window is moved along by later calls, so it shouldn't be held onto
+        res = self._windows.get((share_hash, length))
+        if res is not None:
+            return res
+        share = self.items[share_hash]
+        res = self._windows.pop((share.previous_hash, length))
+        if res is None or not res.extend(share, length):
+            res = ChainWindow.from_chain(self, share_hash, length)
+        self._windows[share_hash, length] = res
+        return res
+    
+    def _forget_windows(self, shares):
+        # pruning removes shares from the far end of chains, so windows are usually unaffected
+        for key, window in list(self._windows.inner.iteritems()):
+            if any(share.hash in window.hash_set for share in shares):
+                self._windows.pop(key)
     
     def score(self, share_hash, block_rel_height_func):
         # returns approximate lower bound on chain's hashrate in the last self.net.CHAIN_LENGTH*15//16*self.net.SHARE_PERIOD time
@@ -539,6 +1054,128 @@ class OkayTracker(forest.Tracker):
         
         return self.net.CHAIN_LENGTH, self.verified.get_delta(share_hash, end_point).work/((0 - block_height + 1)*self.net.PARENT.BLOCK_PERIOD)
 
+class ChainWindow(object):
+    '''
+    The shares of tracker.get_chain(head, length) as parallel columns, head
+    first. Moved along a chain by extend, like WeightsWindow, so that a new
+    best share doesn't mean walking the whole chain again. Keeps {pubkey_hash:
+    (stale count, count)} up to date as shares come and go.
+    
+    The numeric columns are arrays, with stale infos as their one byte codes,
+    so that sums over them are done in C. A column that gets a value too big
+    for its array (attempts and desired versions are unbounded) becomes a list.
+    '''
+    
+    def __init__(self, head, length):
+        self.head = head
+        self.length = length
+        self.hashes = collections.deque()
+        self.hash_set = set()
+        self.pubkey_hashes = collections.deque()
+        self.attempts = array.array('L')
+        self.timestamps = array.array('L')
+        self.stale_codes = array.array('B')
+        self.desired_versions = array.array('L')
+        self.user_counts = {} # pubkey_hash -> (stale count, count)
+    
+    @classmethod
+    def from_chain(cls, tracker, head, length):
+        self = cls(head, length)
+        for share in tracker.get_chain(head, length):
+            self._add(share, at_head=False)
+        return self
+    
+    def _add(self, share, at_head):
+        stale_info = share.share_data['stale_info']
+        index = 0 if at_head else len(self.hashes)
+        if at_head:
+            self.hashes.appendleft(share.hash)
+            self.pubkey_hashes.appendleft(share.share_data['pubkey_hash'])
+        else:
+            self.hashes.append(share.hash)
+            self.pubkey_hashes.append(share.share_data['pubkey_hash'])
+        for name, value in [
+            ('attempts', bitcoin_data.target_to_average_attempts(share.target)),
+            ('timestamps', share.timestamp),
+            ('stale_codes', stale_info_type.unpack_to_pack[stale_info]),
+            ('desired_versions', share.desired_version),
+        ]:
+            column = getattr(self, name)
+            try:
+                column.insert(index, value)
+            except OverflowError:
+                column = list(column)
+                column.insert(index, value)
+                setattr(self, name, column)
+        self._count(share.hash, share.share_data['pubkey_hash'], stale_info is not None, 1)
+    
+    def _count(self, share_hash, pubkey_hash, is_stale, sign):
+        if sign > 0:
+            self.hash_set.add(share_hash)
+        else:
+            self.hash_set.discard(share_hash)
+        stale, count = self.user_counts.get(pubkey_hash, (0, 0))
+        stale, count = stale + sign*is_stale, count + sign
+        if count:
+            self.user_counts[pubkey_hash] = stale, count
+        else:
+            self.user_counts.pop(pubkey_hash, None)
+    
+    def extend(self, share, length):
+        '''
+        Moves head to share, a child of head, keeping the window at length
+        shares. Returns False if it can't, in which case it is left unusable.
+        '''
+        assert share.previous_hash == self.head
+        if length != self.length or len(self.hashes) != length:
+            return False
+        
+        self._add(share, at_head=True)
+        
+        self.attempts.pop()
+        self.timestamps.pop()
+        self.desired_versions.pop()
+        self._count(self.hashes.pop(), self.pubkey_hashes.pop(), self.stale_codes.pop() != 0, -1)
+        
+        self.head = share.hash
+        return True
+    
+    def __len__(self):
+        return len(self.hashes)
+    
+    def get_mask(self, share_hashes):
+        # which shares in the window are in share_hashes
+        return array.array('B', [h in share_hashes for h in self.hashes])
+    
+    def _sum_by(self, keys, weights, mask, end):
+        # returns {key: sum of weights (or count, if weights is None)} over the first end shares where mask is true
+        keys = keys[:end]
+        res = {}
+        for key in set(keys):
+            selected = itertools.imap(operator.eq, keys, itertools.repeat(key))
+            if mask is not None:
+                selected = itertools.imap(operator.and_, selected, mask)
+            total = sum(itertools.compress(weights, selected)) if weights is not None else sum(selected)
+            if total:
+                res[key] = total
+        return res
+    
+    def _by_stale_info(self, res):
+        return dict((stale_info_type.pack_to_unpack[code], total) for code, total in res.iteritems())
+    
+    def get_stale_info_counts(self, mask=None, end=None):
+        return self._by_stale_info(self._sum_by(self.stale_codes, None, mask, end))
+    
+    def get_stale_info_attempts(self, mask=None, end=None):
+        return self._by_stale_info(self._sum_by(self.stale_codes, self.attempts, mask, end))
+    
+    def get_desired_version_attempts(self, mask=None, end=None):
+        return self._sum_by(self.desired_versions, self.attempts, mask, end)
+    
+    def get_user_stale_counts(self):
+        # returns {pubkey_hash: (stale count, count)}
+        return dict(self.user_counts)
+
 def get_pool_attempts_per_second(tracker, previous_share_hash, dist, min_work=False, integer=False):
     assert dist >= 2
     near = tracker.items[previous_share_hash]
@@ -552,31 +1189,26 @@ def get_pool_attempts_per_second(tracker, previous_share_hash, dist, min_work=Fa
     return attempts/time
 
 def get_average_stale_prop(tracker, share_hash, lookbehind):
-    stales = sum(1 for share in tracker.get_chain(share_hash, lookbehind) if share.share_data['stale_info'] is not None)
+    counts = tracker.get_window(share_hash, lookbehind).get_stale_info_counts()
+    stales = lookbehind - counts.get(None, 0)
     return stales/(lookbehind + stales)
 
 def get_stale_counts(tracker, share_hash, lookbehind, rates=False):
-    res = {}
-    for share in tracker.get_chain(share_hash, lookbehind - 1):
-        res['good'] = res.get('good', 0) + bitcoin_data.target_to_average_attempts(share.target)
-        s = share.share_data['stale_info']
-        if s is not None:
-            res[s] = res.get(s, 0) + bitcoin_data.target_to_average_attempts(share.target)
+    # with rates, the window also holds the share whose timestamp the first lookbehind - 1 shares are timed from
+    window = tracker.get_window(share_hash, lookbehind if rates else lookbehind - 1)
+    res = window.get_stale_info_attempts(end=lookbehind - 1)
+    work = sum(res.itervalues())
+    res.pop(None, None)
+    if lookbehind > 1:
+        res['good'] = work
     if rates:
-        dt = tracker.items[share_hash].timestamp - tracker.items[tracker.get_nth_parent_hash(share_hash, lookbehind - 1)].timestamp
+        dt = window.timestamps[0] - window.timestamps[lookbehind - 1]
         res = dict((k, v/dt) for k, v in res.iteritems())
     return res
 
 def get_user_stale_props(tracker, share_hash, lookbehind):
-    res = {}
-    for share in tracker.get_chain(share_hash, lookbehind - 1):
-        stale, total = res.get(share.share_data['pubkey_hash'], (0, 0))
-        total += 1
-        if share.share_data['stale_info'] is not None:
-            stale += 1
-            total += 1
-        res[share.share_data['pubkey_hash']] = stale, total
-    return dict((pubkey_hash, stale/total) for pubkey_hash, (stale, total) in res.iteritems())
+    res = tracker.get_window(share_hash, lookbehind - 1).get_user_stale_counts()
+    return dict((pubkey_hash, stale/(count + stale)) for pubkey_hash, (stale, count) in res.iteritems())
 
 def get_expected_payouts(tracker, best_share_hash, block_target, subsidy, net):
     weights, total_weight, donation_weight = tracker.get_cumulative_weights(best_share_hash, min(tracker.get_height(best_share_hash), net.REAL_CHAIN_LENGTH), 65535*net.SPREAD*bitcoin_data.target_to_average_attempts(block_target))
@@ -585,10 +1217,7 @@ def get_expected_payouts(tracker, best_share_hash, block_target, subsidy, net):
     return res
 
 def get_desired_version_counts(tracker, best_share_hash, dist):
-    res = {}
-    for share in tracker.get_chain(best_share_hash, dist):
-        res[share.desired_version] = res.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
-    return res
+    return tracker.get_window(best_share_hash, dist).get_desired_version_attempts()
 
 def get_warnings(tracker, best_share, net, bitcoind_warning, bitcoind_work_value):
     res = []
@@ -610,83 +1239,244 @@ def get_warnings(tracker, best_share, net, bitcoind_warning, bitcoind_work_value
     
     return res
 
+def check_stored_share(share, net):
+    '''
+    Recomputes the hashes that were trusted when share was loaded from a
+    ShareStore, returning whether they match
+    '''
+    try:
+        share2 = load_share(share.as_share(), net, None)
+    except Exception:
+        return False
+    return (share2.hash, share2.pow_hash, share2.gentx_hash) == (share.hash, share.pow_hash, share.gentx_hash)
+
 def format_hash(x):
     if x is None:
         return 'xxxxxxxx'
     return '%08x' % (x % 2**32)
 
 class ShareStore(object):
-    def __init__(self, prefix, net):
+    '''
+    Shares are stored in files named prefix + N. Files start with MAGIC,
+    followed by records of record_header_type and length bytes of data. Files
+    of the old format, with a hex-encoded record per line, are still read, but
+    are no longer written to.
+    
+    New records are buffered and only written out by flush().
+    '''
+    
+    MAGIC = '\x00p2pool-shares\x01'
+    
+    record_header_type = pack.ComposedType([
+        ('length', pack.IntType(32)),
+        ('kind', pack.IntType(8)), # 2 = verified hash, 5 = share, 6 = zlib-compressed share, 7 and 8 = 5 and 6 prefixed by share_meta_type
+        ('hash', pack.IntType(256)),
+    ])
+    record_header_size = record_header_type.packed_size(dict(length=0, kind=0, hash=0))
+    
+    share_meta_type = pack.ComposedType([
+        ('pow_hash', pack.IntType(256)),
+        ('gentx_hash', pack.IntType(256)),
+    ])
+    share_meta_size = share_meta_type.packed_size(dict(pow_hash=0, gentx_hash=0))
+    
+    def __init__(self, prefix, net, compress=False):
         self.filename = prefix
         self.dirname = os.path.dirname(os.path.abspath(prefix))
         self.filename = os.path.basename(os.path.abspath(prefix))
         self.net = net
+        self.compress = compress
         self.known = None # will be filename -> set of share hashes, set of verified hashes
         self.known_desired = None
+        self.offsets = {} # filename -> share hash -> offset of record
+        self.unverified_hashes = set() # shares loaded by get_shares(trusted=True) without being checked
+        self.share_files = {} # share hash -> filename
+        self.verified_files = {} # share hash -> filename
+        
+        self._current = None # (filename, size) of file being appended to
+        self._pending = {} # filename -> list of data not yet written to it
+    
+    def _is_binary(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read(len(self.MAGIC)) == self.MAGIC
+    
+    def _read_hex_records(self, filename):
+        with open(filename, 'rb') as f:
+            for line in f:
+                try:
+                    type_id_str, data_hex = line.strip().split(' ')
+                    type_id = int(type_id_str)
+                    if type_id == 0:
+                        pass
+                    elif type_id == 1:
+                        pass
+                    elif type_id == 2:
+                        yield None, 2, int(data_hex, 16), ''
+                    elif type_id == 5:
+                        yield None, 5, None, data_hex.decode('hex')
+                    else:
+                        raise NotImplementedError("share type %i" % (type_id,))
+                except Exception:
+                    log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
+    
+    def _read_binary_records(self, filename):
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size <= len(self.MAGIC):
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = len(self.MAGIC)
+            while pos < size:
+                if pos + self.record_header_size > size:
+                    break
+                header = self.record_header_type.unpack(data[pos:pos + self.record_header_size])
+                end = pos + self.record_header_size + header['length']
+                if end > size:
+                    break
+                yield pos, header['kind'], header['hash'], data[pos + self.record_header_size:end]
+                pos = end
+        finally:
+            data.close()
+        
+        if pos != size:
+            print >>sys.stderr, 'Truncating partially written record at end of %s' % (filename,)
+            with open(filename, 'r+b') as f:
+                f.truncate(pos)
+    
+    def _read_record(self, filename, offset):
+        with open(filename, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header = self.record_header_type.unpack(data[offset:offset + self.record_header_size])
+            return header['kind'], header['hash'], data[offset + self.record_header_size:offset + self.record_header_size + header['length']]
+        finally:
+            data.close()
+    
+    def _decode_share(self, kind, data):
+        meta = None
+        if kind in [7, 8]:
+            meta = self.share_meta_type.unpack(data[:self.share_meta_size])
+            data = data[self.share_meta_size:]
+        return share_type.unpack(zlib.decompress(data) if kind in [6, 8] else data), meta
     
-    def get_shares(self):
+    def get_shares(self, trusted=False):
+        '''
+        With trusted, shares whose records include their proof-of-work and
+        generation transaction hashes are loaded without recomputing them, and
+        are listed in unverified_hashes so they can be checked later with
+        check_stored_share.
+        '''
+        
         if self.known is not None:
             raise AssertionError()
         known = {}
         filenames, next = self.get_filenames_and_next()
         for filename in filenames:
             share_hashes, verified_hashes = known.setdefault(filename, (set(), set()))
-            with open(filename, 'rb') as f:
-                for line in f:
-                    try:
-                        type_id_str, data_hex = line.strip().split(' ')
-                        type_id = int(type_id_str)
-                        if type_id == 0:
-                            pass
-                        elif type_id == 1:
-                            pass
-                        elif type_id == 2:
-                            verified_hash = int(data_hex, 16)
-                            yield 'verified_hash', verified_hash
-                            verified_hashes.add(verified_hash)
-                        elif type_id == 5:
-                            raw_share = share_type.unpack(data_hex.decode('hex'))
-                            if raw_share['type'] in [0, 1, 2, 3, 4, 5, 6, 7, 8]:
-                                continue
-                            share = load_share(raw_share, self.net, None)
-                            yield 'share', share
-                            share_hashes.add(share.hash)
+            offsets = self.offsets.setdefault(filename, {})
+            for offset, kind, hash, data in (self._read_binary_records if self._is_binary(filename) else self._read_hex_records)(filename):
+                try:
+                    if kind == 2:
+                        yield 'verified_hash', hash
+                        verified_hashes.add(hash)
+                        self.verified_files.setdefault(hash, filename)
+                    elif kind in [5, 6, 7, 8]:
+                        raw_share, meta = self._decode_share(kind, data)
+                        if raw_share['type'] in [0, 1, 2, 3, 4, 5, 6, 7, 8]:
+                            continue
+                        if trusted and meta is not None:
+                            share = load_share(raw_share, self.net, None, meta['pow_hash'], meta['gentx_hash'])
+                            if share.hash != hash:
+                                raise ValueError('stored share hash mismatch')
+                            self.unverified_hashes.add(share.hash)
                         else:
-                            raise NotImplementedError("share type %i" % (type_id,))
-                    except Exception:
-                        log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
+                            share = load_share(raw_share, self.net, None)
+                        yield 'share', share
+                        share_hashes.add(share.hash)
+                        self.share_files.setdefault(share.hash, filename)
+                        if offset is not None:
+                            offsets[share.hash] = offset
+                    else:
+                        raise NotImplementedError("record kind %i" % (kind,))
+                except Exception:
+                    log.err(None, "HARMLESS error while reading saved shares, continuing where left off:")
         self.known = known
-        self.known_desired = dict((k, (set(a), set(b))) for k, (a, b) in known.iteritems())
+        # hashes stored in more than one file only keep the first one alive
+        self.known_desired = dict((filename, (set(), set())) for filename in known)
+        for share_hash, filename in self.share_files.iteritems():
+            self.known_desired[filename][0].add(share_hash)
+        for share_hash, filename in self.verified_files.iteritems():
+            self.known_desired[filename][1].add(share_hash)
     
-    def _add_line(self, line):
-        filenames, next = self.get_filenames_and_next()
-        if filenames and os.path.getsize(filenames[-1]) < 10e6:
-            filename = filenames[-1]
-        else:
-            filename = next
+    def get_digest(self):
+        '''
+        Returns a hash of the set of shares and verified hashes stored, which
+        is what get_shares will yield
+        '''
+        return hashlib.sha256(''.join(
+            [pack.IntType(256).pack(share_hash) for share_hash in sorted(self.share_files)] + ['\x00'] +
+            [pack.IntType(256).pack(share_hash) for share_hash in sorted(self.verified_files)]
+        )).digest()
+    
+    def get_share(self, share_hash):
+        filename = self.share_files.get(share_hash)
+        if filename is None or share_hash not in self.offsets.get(filename, {}):
+            return None
+        if filename in self._pending:
+            self.flush()
+        kind, hash, data = self._read_record(filename, self.offsets[filename][share_hash])
+        assert hash == share_hash
+        raw_share, meta = self._decode_share(kind, data)
+        return load_share(raw_share, self.net, None)
+    
+    def _add_record(self, kind, hash, data=''):
+        if self._current is None or self._current[1] >= 10e6:
+            self._rotate()
+        filename, size = self._current
         
-        with open(filename, 'ab') as f:
-            f.write(line + '\n')
+        pending = self._pending.setdefault(filename, [])
+        if size == 0:
+            pending.append(self.MAGIC)
+            size += len(self.MAGIC)
+        record = self.record_header_type.pack(dict(length=len(data), kind=kind, hash=hash)) + data
+        pending.append(record)
+        self._current = filename, size + len(record)
         
-        return filename
+        return filename, size
     
-    def add_share(self, share):
-        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
-            if share.hash in share_hashes:
-                break
+    def _rotate(self):
+        self.flush() # so that the listing includes the current file
+        filenames, next = self.get_filenames_and_next()
+        if self._current is None and filenames and self._is_binary(filenames[-1]) and os.path.getsize(filenames[-1]) < 10e6:
+            self._current = filenames[-1], os.path.getsize(filenames[-1])
         else:
-            filename = self._add_line("%i %s" % (5, share_type.pack(share.as_share()).encode('hex')))
+            self._current = next, 0
+    
+    def flush(self):
+        for filename, pending in self._pending.iteritems():
+            with open(filename, 'ab') as f:
+                f.write(''.join(pending))
+        self._pending = {}
+    
+    def add_share(self, share):
+        filename = self.share_files.get(share.hash)
+        if filename is None:
+            data = share_type.pack(share.as_share())
+            meta = self.share_meta_type.pack(dict(pow_hash=share.pow_hash, gentx_hash=share.gentx_hash))
+            filename, offset = self._add_record(8, share.hash, meta + zlib.compress(data)) if self.compress else self._add_record(7, share.hash, meta + data)
+            self.offsets.setdefault(filename, {})[share.hash] = offset
+            self.share_files[share.hash] = filename
             share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
             share_hashes.add(share.hash)
         share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
         share_hashes.add(share.hash)
     
     def add_verified_hash(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known.iteritems():
-            if share_hash in verified_hashes:
-                break
-        else:
-            filename = self._add_line("%i %x" % (2, share_hash))
+        filename = self.verified_files.get(share_hash)
+        if filename is None:
+            filename, offset = self._add_record(2, share_hash)
+            self.verified_files[share_hash] = filename
             share_hashes, verified_hashes = self.known.setdefault(filename, (set(), set()))
             verified_hashes.add(share_hash)
         share_hashes, verified_hashes = self.known_desired.setdefault(filename, (set(), set()))
@@ -697,25 +1487,49 @@ class ShareStore(object):
         return [os.path.join(self.dirname, self.filename + str(suffix)) for suffix in suffixes], os.path.join(self.dirname, self.filename + (str(suffixes[-1] + 1) if suffixes else str(0)))
     
     def forget_share(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            if share_hash in share_hashes:
-                share_hashes.remove(share_hash)
-        self.check_remove()
+        filename = self.share_files.get(share_hash)
+        if filename is not None:
+            self.known_desired[filename][0].discard(share_hash)
+            self._check_remove(filename)
+    
+    def forget_shares(self, share_hashes, verified=False):
+        # like forget_share/forget_verified_share, but only checks each file once
+        files = self.verified_files if verified else self.share_files
+        filenames = set()
+        for share_hash in share_hashes:
+            filename = files.get(share_hash)
+            if filename is not None:
+                self.known_desired[filename][1 if verified else 0].discard(share_hash)
+                filenames.add(filename)
+        for filename in filenames:
+            self._check_remove(filename)
     
     def forget_verified_share(self, share_hash):
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            if share_hash in verified_hashes:
-                verified_hashes.remove(share_hash)
-        self.check_remove()
+        filename = self.verified_files.get(share_hash)
+        if filename is not None:
+            self.known_desired[filename][1].discard(share_hash)
+            self._check_remove(filename)
     
     def check_remove(self):
-        to_remove = set()
-        for filename, (share_hashes, verified_hashes) in self.known_desired.iteritems():
-            #print filename, len(share_hashes) + len(verified_hashes)
-            if not share_hashes and not verified_hashes:
-                to_remove.add(filename)
-        for filename in to_remove:
-            self.known.pop(filename)
-            self.known_desired.pop(filename)
+        for filename in list(self.known_desired):
+            self._check_remove(filename)
+    
+    def _check_remove(self, filename):
+        share_hashes, verified_hashes = self.known_desired[filename]
+        if share_hashes or verified_hashes:
+            return
+        share_hashes, verified_hashes = self.known.pop(filename)
+        for share_hash in share_hashes:
+            if self.share_files.get(share_hash) == filename:
+                del self.share_files[share_hash]
+        for share_hash in verified_hashes:
+            if self.verified_files.get(share_hash) == filename:
+                del self.verified_files[share_hash]
+        self.known_desired.pop(filename)
+        self.offsets.pop(filename, None)
+        self._pending.pop(filename, None)
+        if os.path.exists(filename):
             os.remove(filename)
-            print "REMOVED", filename
+        if self._current is not None and self._current[0] == filename:
+            self._current = None
+        print "REMOVED", filename
@@ -1,6 +1,7 @@
 from __future__ import division
 
 import base64
+import cPickle
 import gc
 import json
 import os
@@ -21,10 +22,12 @@ from nattraverso import portmapper, ipdiscover
 
 import bitcoin.p2p as bitcoin_p2p, bitcoin.data as bitcoin_data
 from bitcoin import stratum, worker_interface, helper
-from util import fixargparse, jsonrpc, variable, deferral, math, logging, switchprotocol
+from util import fixargparse, jsonrpc, variable, deferral, math, logging, processpool, switchprotocol
 from . import networks, web, work
 import p2pool, p2pool.data as p2pool_data, p2pool.node as p2pool_node
 
+CHECKPOINT_VERSION = 3 # increase when the tracker's state changes, e.g. when delta attributes are added
+
 @defer.inlineCallbacks
 def main(args, net, datadir_path, merged_urls, worker_endpoint):
     try:
@@ -98,11 +101,11 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         print '    ...success! Payout address:', bitcoin_data.pubkey_hash_to_address(my_pubkey_hash, net.PARENT)
         print
         
-        ss = p2pool_data.ShareStore(os.path.join(datadir_path, 'shares.'), net)
+        ss = p2pool_data.ShareStore(os.path.join(datadir_path, 'shares.'), net, compress=args.compress_shares)
         shares = {}
         known_verified = set()
         print "Loading shares..."
-        for i, (mode, contents) in enumerate(ss.get_shares()):
+        for i, (mode, contents) in enumerate(ss.get_shares(trusted=args.trust_stored_shares)):
             if mode == 'share':
                 contents.time_seen = 0
                 shares[contents.hash] = contents
@@ -115,10 +118,41 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         print "    ...done loading %i shares (%i verified)!" % (len(shares), len(known_verified))
         print
         
+        unchecked = [share_hash for share_hash in ss.unverified_hashes if share_hash in shares]
+        if unchecked:
+            sample = random.sample(unchecked, min(len(unchecked), 100))
+            if all([p2pool_data.check_stored_share(shares[share_hash], net) for share_hash in sample]):
+                unchecked = list(set(unchecked) - set(sample))
+            else:
+                print >>sys.stderr, 'Saved shares failed verification! Checking all of them...'
+                for share_hash in unchecked:
+                    if not p2pool_data.check_stored_share(shares[share_hash], net):
+                        del shares[share_hash]
+                unchecked = []
+        
+        checkpoint_path = os.path.join(datadir_path, 'tracker_checkpoint')
+        tracker_state = None
+        if args.tracker_checkpoint and os.path.exists(checkpoint_path):
+            try:
+                with open(checkpoint_path, 'rb') as f:
+                    checkpoint = cPickle.load(f)
+                if checkpoint.get('version') != CHECKPOINT_VERSION:
+                    print 'Tracker checkpoint is from an incompatible version, ignoring it.'
+                elif checkpoint['digest'] != ss.get_digest():
+                    print 'Tracker checkpoint is out of date with saved shares, ignoring it.'
+                elif not set(checkpoint['state']['items']).issubset(shares):
+                    print 'Tracker checkpoint refers to shares that failed to load, ignoring it.'
+                else:
+                    tracker_state = checkpoint['state']
+                del checkpoint
+            except:
+                log.err(None, 'Error while reading tracker checkpoint:')
+        
         
         print 'Initializing work...'
         
-        node = p2pool_node.Node(factory, bitcoind, shares.values(), known_verified, net)
+        node = p2pool_node.Node(factory, bitcoind, shares.values(), known_verified, net, tracker_state)
+        del tracker_state
         yield node.start()
         
         for share_hash in shares:
@@ -128,15 +162,41 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
             if share_hash not in node.tracker.verified.items:
                 ss.forget_verified_share(share_hash)
         del shares, known_verified
-        node.tracker.removed.watch(lambda share: ss.forget_share(share.hash))
-        node.tracker.verified.removed.watch(lambda share: ss.forget_verified_share(share.hash))
+        node.tracker.removed_many.watch(lambda shares: ss.forget_shares(share.hash for share in shares))
+        node.tracker.verified.removed_many.watch(lambda shares: ss.forget_shares((share.hash for share in shares), verified=True))
         
         def save_shares():
             for share in node.tracker.get_chain(node.best_share_var.value, min(node.tracker.get_height(node.best_share_var.value), 2*net.CHAIN_LENGTH)):
                 ss.add_share(share)
                 if share.hash in node.tracker.verified.items:
                     ss.add_verified_hash(share.hash)
+            ss.flush()
         task.LoopingCall(save_shares).start(60)
+        reactor.addSystemEventTrigger('before', 'shutdown', ss.flush)
+        
+        if args.tracker_checkpoint:
+            def save_checkpoint():
+                # make sure everything in the checkpoint is in ss, so that it's loaded next time
+                for share in node.tracker.items.itervalues():
+                    ss.add_share(share)
+                for share_hash in node.tracker.verified.items:
+                    ss.add_verified_hash(share_hash)
+                ss.flush()
+                with open(checkpoint_path + '.new', 'wb') as f:
+                    cPickle.dump(dict(version=CHECKPOINT_VERSION, digest=ss.get_digest(), state=node.tracker.get_state()), f, cPickle.HIGHEST_PROTOCOL)
+                if os.path.exists(checkpoint_path):
+                    os.remove(checkpoint_path) # for Windows, where rename doesn't replace
+                os.rename(checkpoint_path + '.new', checkpoint_path)
+            task.LoopingCall(save_checkpoint).start(30*60, now=False)
+            reactor.addSystemEventTrigger('before', 'shutdown', save_checkpoint)
+        
+        def check_stored_shares():
+            for share_hash in unchecked:
+                if share_hash in node.tracker.items and not p2pool_data.check_stored_share(node.tracker.items[share_hash], net):
+                    print >>sys.stderr, 'Saved share %s failed verification! Dropping it and its children.' % (p2pool_data.format_hash(share_hash),)
+                    node.drop_share(share_hash)
+                yield
+        task.cooperate(check_stored_shares())
         
         print '    ...success!'
         print
@@ -144,6 +204,9 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
         
         print 'Joining p2pool network using port %i...' % (args.p2pool_port,)
         
+        share_verify_pool = processpool.ProcessPool(args.share_verify_processes)
+        reactor.addSystemEventTrigger('before', 'shutdown', share_verify_pool.stop)
+        
         @defer.inlineCallbacks
         def parse(host):
             port = net.P2P_PORT
@@ -180,6 +243,7 @@ def main(args, net, datadir_path, merged_urls, worker_endpoint):
             addr_store=addrs,
             connect_addrs=connect_addrs,
             desired_outgoing_conns=args.p2pool_outgoing_conns,
+            share_verify_pool=share_verify_pool,
         )
         node.p2p_node.start()
         
@@ -414,6 +478,21 @@ def run():
     p2pool_group.add_argument('--outgoing-conns', metavar='CONNS',
         help='outgoing connections (default: 6)',
         type=int, action='store', default=6, dest='p2pool_outgoing_conns')
+    p2pool_group.add_argument('--share-verify-processes', metavar='PROCESSES',
+        help='number of worker processes used to check the proof of work of shares received from peers, so that large batches of shares don\'t block the main process (default: 0, meaning shares are checked in the main process)',
+        type=int, action='store', default=0, dest='share_verify_processes')
+    p2pool_group.add_argument('--full-shares',
+        help='keep shares in memory decoded as well as in their packed form, which speeds up access to their fields at the cost of memory usage (default: only packed, decoding fields when they are used)',
+        action='store_true', default=False, dest='full_shares')
+    p2pool_group.add_argument('--compress-shares',
+        help='zlib-compress shares saved to disk',
+        action='store_true', default=False, dest='compress_shares')
+    p2pool_group.add_argument('--tracker-checkpoint',
+        help='periodically save the share tracker\'s structure and caches to disk and restore them at startup, if the saved shares haven\'t changed since, to speed up restarts',
+        action='store_true', default=False, dest='tracker_checkpoint')
+    p2pool_group.add_argument('--trust-stored-shares',
+        help='load saved shares without recomputing their proof of work, checking a random sample of them at startup and the rest in the background',
+        action='store_true', default=False, dest='trust_stored_shares')
     
     worker_group = parser.add_argument_group('worker interface')
     worker_group.add_argument('-w', '--worker-port', metavar='PORT or ADDR:PORT',
@@ -449,6 +528,8 @@ def run():
     else:
         p2pool.DEBUG = False
     
+    p2pool_data.Share.COMPACT = not args.full_shares
+    
     net_name = args.net_name + ('_testnet' if args.testnet else '')
     net = networks.nets[net_name]
     
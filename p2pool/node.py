@@ -1,8 +1,10 @@
+import heapq
 import random
 import sys
 import time
+import weakref
 
-from twisted.internet import defer, reactor, task
+from twisted.internet import defer, error, reactor, task
 from twisted.python import log
 
 from p2pool import data as p2pool_data, p2p
@@ -58,6 +60,26 @@ class P2PNode(p2p.Node):
         else:
             self.handle_shares(shares, peer)
     
+    def handle_have_shares(self, hashes, peer):
+        # ask for announced shares we don't have, unless another peer was just asked for them
+        now = time.time()
+        self.wanted_share_hashes = dict((share_hash, t) for share_hash, t in self.wanted_share_hashes.iteritems() if t > now - 5)
+        new_hashes = [x for x in hashes if x not in self.node.tracker.items and x not in self.wanted_share_hashes]
+        if not new_hashes:
+            return
+        for share_hash in new_hashes:
+            self.wanted_share_hashes[share_hash] = now
+        peer.send_want_shares(hashes=new_hashes)
+    
+    def handle_want_shares(self, hashes, peer):
+        shares = [self.node.tracker.items[share_hash] for share_hash in hashes if share_hash in self.node.tracker.items]
+        if not shares:
+            return
+        try:
+            peer.sendShares(shares, self.node.tracker, self.node.known_txs_var.value, include_txs_with=hashes)
+        except ValueError:
+            log.err(None, 'in handle_want_shares:')
+    
     def handle_get_shares(self, hashes, parents, stops, peer):
         parents = min(parents, 1000//len(hashes))
         stops = set(stops)
@@ -84,48 +106,26 @@ class P2PNode(p2p.Node):
             self.shared_share_hashes.add(share.hash)
             shares.append(share)
         
+        packed_shares_cache = {}
         for peer in self.peers.itervalues():
-            peer.sendShares([share for share in shares if share.peer_addr != peer.addr], self.node.tracker, self.node.known_txs_var.value, include_txs_with=[share_hash])
+            peer_shares = [share for share in shares if share.peer_addr != peer.addr and share.hash not in peer.remote_share_hashes]
+            if peer.other_version >= 1300:
+                # shares found here are pushed right away, the rest are only announced and sent if the peer asks for them
+                peer.announceShares([share.hash for share in peer_shares if share.peer_addr is not None])
+                peer_shares = [share for share in peer_shares if share.peer_addr is None]
+            if not peer_shares:
+                continue
+            peer.sendShares(peer_shares, self.node.tracker, self.node.known_txs_var.value, include_txs_with=[share_hash], packed_shares_cache=packed_shares_cache)
     
     def start(self):
         p2p.Node.start(self)
         
         self.shared_share_hashes = set(self.node.tracker.items)
-        self.node.tracker.removed.watch_weakref(self, lambda self, share: self.shared_share_hashes.discard(share.hash))
-        
-        @apply
-        @defer.inlineCallbacks
-        def download_shares():
-            while True:
-                desired = yield self.node.desired_var.get_when_satisfies(lambda val: len(val) != 0)
-                peer_addr, share_hash = random.choice(desired)
-                
-                if len(self.peers) == 0:
-                    yield deferral.sleep(1)
-                    continue
-                peer = random.choice(self.peers.values())
-                
-                print 'Requesting parent share %s from %s' % (p2pool_data.format_hash(share_hash), '%s:%i' % peer.addr)
-                try:
-                    shares = yield peer.get_shares(
-                        hashes=[share_hash],
-                        parents=random.randrange(500), # randomize parents so that we eventually get past a too large block of shares
-                        stops=list(set(self.node.tracker.heads) | set(
-                            self.node.tracker.get_nth_parent_hash(head, min(max(0, self.node.tracker.get_height_and_last(head)[0] - 1), 10)) for head in self.node.tracker.heads
-                        ))[:100],
-                    )
-                except defer.TimeoutError:
-                    print 'Share request timed out!'
-                    continue
-                except:
-                    log.err(None, 'in download_shares:')
-                    continue
-                
-                if not shares:
-                    yield deferral.sleep(1) # sleep so we don't keep rerequesting the same share nobody has
-                    continue
-                self.handle_shares(shares, peer)
+        self.wanted_share_hashes = {} # hash -> time it was last asked for with want_shares
+        self.node.tracker.removed_many.watch_weakref(self, lambda self, shares: self.shared_share_hashes.difference_update(share.hash for share in shares))
         
+        self.share_downloader = ShareDownloader(self)
+        self.share_downloader.run()
         
         @self.node.best_block_header.changed.watch
         def _(header):
@@ -148,21 +148,233 @@ class P2PNode(p2p.Node):
             reactor.callLater(5, spread) # so get_height_rel_highest can update
         
 
+class ShareDownloader(object):
+    '''
+    Downloads the parents of shares the tracker wants, keeping several
+    requests in flight to different peers at once. A hash that's already being
+    requested isn't requested again, the stops list is only rebuilt after the
+    tracker's heads change, and peers are picked by their measured latency and by how
+    often they delivered. The number of parents asked for follows the size of
+    previous replies.
+    '''
+    
+    MAX_REQUESTS = 4 # requests in flight at once, each to a different peer
+    MIN_PARENTS = 10
+    MAX_PARENTS = 500
+    EMPTY_RETRY_DELAY = 1 # seconds before rerequesting a share nobody returned
+    
+    def __init__(self, p2p_node):
+        self.p2p_node = p2p_node
+        self.tracker = p2p_node.node.tracker
+        self.desired_var = p2p_node.node.desired_var
+        
+        self.parents = 100
+        self.requested = set() # hashes with a request in flight
+        self.busy_peers = set() # peers with a request in flight
+        self.retry_times = {} # hash -> time before which it won't be rerequested after an empty reply
+        self.peer_stats = weakref.WeakKeyDictionary() # peer -> (average latency, average fraction of requests delivered)
+        self.request_finished = variable.Event()
+        
+        # while catching up, shares are added below the heads between every pair of requests, which leaves the stops as they were
+        self._stops = None
+        self.tracker.added.watch_weakref(self, lambda self, share: self._share_added(share))
+        self.tracker.removed_many.watch_weakref(self, lambda self, shares: self._shares_removed(shares))
+    
+    def _share_added(self, share):
+        if share.hash in self.tracker.heads:
+            self._stops = None
+    
+    def _shares_removed(self, shares):
+        if self._stops is not None and any(share.hash in self._stops or share.previous_hash in self.tracker.heads for share in shares):
+            self._stops = None
+    
+    def get_stops(self):
+        if self._stops is None:
+            self._stops = list(set(self.tracker.heads) | set(
+                self.tracker.get_nth_parent_hash(head, min(max(0, self.tracker.get_height_and_last(head)[0] - 1), 10)) for head in self.tracker.heads
+            ))[:100]
+        return self._stops
+    
+    def get_peer_score(self, peer):
+        latency, delivery = self.peer_stats.get(peer, (1, 1)) # unmeasured peers get tried
+        return latency / (delivery + .1)
+    
+    def _update_peer_stats(self, peer, latency, delivered):
+        old_latency, old_delivery = self.peer_stats.get(peer, (latency, 1))
+        self.peer_stats[peer] = .7*old_latency + .3*latency, .7*old_delivery + .3*delivered
+    
+    @defer.inlineCallbacks
+    def run(self):
+        while True:
+            desired = yield self.desired_var.get_when_satisfies(lambda val: len(val) != 0)
+            if not self.start_requests(desired):
+                try:
+                    yield self.request_finished.get_deferred(timeout=1)
+                except defer.TimeoutError:
+                    pass
+    
+    def start_requests(self, desired):
+        # returns whether any request was started
+        now = time.time()
+        self.retry_times = dict((share_hash, t) for share_hash, t in self.retry_times.iteritems() if t > now)
+        share_hashes = list(set(share_hash for peer_addr, share_hash in desired
+            if share_hash not in self.requested and share_hash not in self.retry_times))
+        random.shuffle(share_hashes)
+        
+        started = False
+        for share_hash in share_hashes:
+            if len(self.requested) >= self.MAX_REQUESTS:
+                break
+            peers = [peer for peer in self.p2p_node.peers.itervalues() if peer not in self.busy_peers]
+            if not peers:
+                break
+            peer = min(peers, key=lambda peer: self.get_peer_score(peer)*random.expovariate(1))
+            self.request(peer, share_hash)
+            started = True
+        return started
+    
+    @defer.inlineCallbacks
+    def request(self, peer, share_hash):
+        self.requested.add(share_hash)
+        self.busy_peers.add(peer)
+        parents = self.parents
+        start = reactor.seconds()
+        
+        print 'Requesting parent share %s from %s' % (p2pool_data.format_hash(share_hash), '%s:%i' % peer.addr)
+        try:
+            shares = yield peer.get_shares(
+                hashes=[share_hash],
+                parents=parents,
+                stops=self.get_stops(),
+            )
+        except defer.TimeoutError:
+            print 'Share request timed out!'
+            self._update_peer_stats(peer, reactor.seconds() - start, 0)
+        except p2p.ShareReplyError, e:
+            print 'Share request failed! %s' % (e,)
+            self.parents = max(self.MIN_PARENTS, parents//2) # older peers fail requests whose reply would be too long
+        except (p2p.PeerMisbehavingError, error.ConnectionClosed):
+            pass # peer was dropped, which was already reported
+        except:
+            log.err(None, 'in download_shares:')
+        else:
+            self._update_peer_stats(peer, reactor.seconds() - start, 1 if shares else 0)
+            if not shares:
+                self.retry_times[share_hash] = time.time() + self.EMPTY_RETRY_DELAY # so we don't keep rerequesting the same share nobody has
+            else:
+                # a full reply means more would have fit, a short one was cut off at the size limit or reached the stops
+                self.parents = min(self.MAX_PARENTS, 2*parents) if len(shares) > parents else max(self.MIN_PARENTS, len(shares))
+                self.p2p_node.handle_shares(shares, peer)
+        finally:
+            self.requested.discard(share_hash)
+            self.busy_peers.discard(peer)
+            self.request_finished.happened()
+
+class EvictionQueue(object):
+    '''
+    Keeps track of which heads and tails of a tracker may be due for removal,
+    so that cleaning only has to look at those. Heads are kept in a heap by
+    the time they could become removable and tails in a set of those whose
+    heights changed since they were last looked at.
+    '''
+    
+    HEAD_AGE = 300 # heads must be at least this old to be removed
+    TAIL_AGE = 120 # unverified heads' oldest shares must be at least this old to be removed
+    
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.head_queue = [] # heap of (time, head hash), entries not matching head_times are skipped
+        self.head_times = {} # head hash -> earliest time it's scheduled to be looked at
+        self.dirty_tails = set(tracker.tails)
+        for head_hash in tracker.heads:
+            self._schedule_head(head_hash, tracker.items[head_hash].time_seen + self.HEAD_AGE)
+        
+        tracker.added.watch_weakref(self, lambda self, share: self._handle_added(share))
+        tracker.removed_many.watch_weakref(self, lambda self, shares: self._handle_removed_many(shares))
+    
+    def _schedule_head(self, share_hash, t):
+        if share_hash in self.head_times and self.head_times[share_hash] <= t:
+            return
+        self.head_times[share_hash] = t
+        heapq.heappush(self.head_queue, (t, share_hash))
+    
+    def _handle_added(self, share):
+        if share.hash in self.tracker.heads:
+            self._schedule_head(share.hash, share.time_seen + self.HEAD_AGE)
+        self.dirty_tails.add(self.tracker.get_last(share.hash))
+    
+    def _handle_removed_many(self, shares):
+        for share in shares:
+            self.head_times.pop(share.hash, None)
+        for share in shares:
+            if share.previous_hash in self.tracker.heads:
+                self._schedule_head(share.previous_hash, self.tracker.items[share.previous_hash].time_seen + self.HEAD_AGE)
+            self.dirty_tails.add(self.tracker.get_last(share.previous_hash))
+            if share.hash in self.tracker.tails:
+                # share was at the bottom, so its heads' oldest shares changed
+                self.dirty_tails.add(share.hash)
+                for head_hash in self.tracker.tails[share.hash]:
+                    if head_hash not in self.tracker.verified.items:
+                        self._schedule_head(head_hash, self.tracker.items[head_hash].time_seen + self.HEAD_AGE)
+    
+    def get_due_heads(self, keep):
+        # returns heads that can be removed now, except those in keep. removing them can make their parents due
+        now = time.time()
+        res = []
+        postponed = set()
+        while self.head_queue and self.head_queue[0][0] <= now:
+            t, share_hash = heapq.heappop(self.head_queue)
+            if self.head_times.get(share_hash) != t:
+                continue
+            del self.head_times[share_hash]
+            if share_hash not in self.tracker.heads:
+                continue
+            if share_hash in keep:
+                postponed.add(share_hash)
+                continue
+            if share_hash not in self.tracker.verified.items:
+                latest = max(self.tracker.items[after_tail_hash].time_seen for after_tail_hash in self.tracker.reverse[self.tracker.heads[share_hash]])
+                if latest > now - self.TAIL_AGE:
+                    self._schedule_head(share_hash, latest + self.TAIL_AGE)
+                    continue
+            res.append(share_hash)
+        for share_hash in postponed:
+            self._schedule_head(share_hash, now)
+        return res
+    
+    def get_due_tails(self, min_height):
+        # returns tails whose heads are all at least min_height high. removing the shares above them can make the next tails due
+        res = []
+        while self.dirty_tails:
+            tail = self.dirty_tails.pop()
+            if tail not in self.tracker.tails:
+                continue
+            if min(self.tracker.get_height(head) for head in self.tracker.tails[tail]) < min_height:
+                continue
+            res.append(tail)
+        return res
+
 class Node(object):
-    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net):
+    def __init__(self, factory, bitcoind, shares, known_verified_share_hashes, net, tracker_state=None):
         self.factory = factory
         self.bitcoind = bitcoind
         self.net = net
         
         self.tracker = p2pool_data.OkayTracker(self.net)
         
+        if tracker_state is not None:
+            self.tracker.set_state(dict((share.hash, share) for share in shares), tracker_state)
+        
         for share in shares:
-            self.tracker.add(share)
+            if share.hash not in self.tracker.items:
+                self.tracker.add(share)
         
         for share_hash in known_verified_share_hashes:
-            if share_hash in self.tracker.items:
+            if share_hash in self.tracker.items and share_hash not in self.tracker.verified.items:
                 self.tracker.verified.add(self.tracker.items[share_hash])
         
+        self.eviction_queue = EvictionQueue(self.tracker)
+        
         self.p2p_node = None # overwritten externally
     
     @defer.inlineCallbacks
@@ -213,11 +425,13 @@ class Node(object):
         
         # BEST SHARE
         
-        self.known_txs_var = variable.Variable({}) # hash -> tx
-        self.mining_txs_var = variable.Variable({}) # hash -> tx
+        self.known_txs_var = variable.DictVariable({}) # hash -> tx
+        self.mining_txs_var = variable.DictVariable({}) # hash -> tx
+        self.known_txs_var.diffed.watch(lambda added, removed: self.tracker.forget_punishments(set(added) | set(removed)))
         self.get_height_rel_highest = yield height_tracker.get_height_rel_highest_func(self.bitcoind, self.factory, lambda: self.bitcoind_work.value['previous_block'], self.net)
         
         self.best_share_var = variable.Variable(None)
+        self.best_share_var.changed.watch(self.tracker.tx_refs.set_head)
         self.desired_var = variable.Variable(None)
         self.bitcoind_work.changed.watch(lambda _: self.set_best_share())
         self.set_best_share()
@@ -227,28 +441,22 @@ class Node(object):
         # update mining_txs according to getwork results
         @self.bitcoind_work.changed.run_and_watch
         def _(_=None):
-            new_mining_txs = {}
-            new_known_txs = dict(self.known_txs_var.value)
-            for tx_hash, tx in zip(self.bitcoind_work.value['transaction_hashes'], self.bitcoind_work.value['transactions']):
-                new_mining_txs[tx_hash] = tx
-                new_known_txs[tx_hash] = tx
+            new_mining_txs = dict(zip(self.bitcoind_work.value['transaction_hashes'], self.bitcoind_work.value['transactions']))
             self.mining_txs_var.set(new_mining_txs)
-            self.known_txs_var.set(new_known_txs)
+            self.known_txs_var.update(added=new_mining_txs)
         # add p2p transactions from bitcoind to known_txs
         @self.factory.new_tx.watch
         def _(tx):
-            new_known_txs = dict(self.known_txs_var.value)
-            new_known_txs[bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))] = tx
-            self.known_txs_var.set(new_known_txs)
+            self.known_txs_var.update(added={bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)): tx})
         # forward transactions seen to bitcoind
-        @self.known_txs_var.transitioned.watch
+        @self.known_txs_var.diffed.watch
         @defer.inlineCallbacks
-        def _(before, after):
+        def _(added, removed):
             yield deferral.sleep(random.expovariate(1/1))
             if self.factory.conn.value is None:
                 return
-            for tx_hash in set(after) - set(before):
-                self.factory.conn.value.send_tx(tx=after[tx_hash])
+            for tx in added.itervalues():
+                self.factory.conn.value.send_tx(tx=tx)
         
         @self.tracker.verified.added.watch
         def _(share):
@@ -269,6 +477,7 @@ class Node(object):
             if self.p2p_node is not None:
                 for peer in self.p2p_node.peers.itervalues():
                     new_known_txs.update(peer.remembered_txs)
+                    new_known_txs.update((tx_hash, tx) for tx_hash, (tx, refs) in peer.compact_txs.iteritems())
             new_known_txs.update(self.mining_txs_var.value)
             for share in self.tracker.get_chain(self.best_share_var.value, min(120, self.tracker.get_height(self.best_share_var.value))):
                 for tx_hash in share.new_transaction_hashes:
@@ -292,51 +501,37 @@ class Node(object):
     def get_current_txouts(self):
         return p2pool_data.get_expected_payouts(self.tracker, self.best_share_var.value, self.bitcoind_work.value['bits'].target, self.bitcoind_work.value['subsidy'], self.net)
     
+    def drop_share(self, share_hash):
+        # removes share_hash along with every share built on it
+        to_remove = [share_hash]
+        for x in to_remove:
+            to_remove.extend(self.tracker.reverse.get(x, set()))
+        self.remove_shares(reversed(to_remove))
+        self.set_best_share()
+    
+    def remove_shares(self, share_hashes):
+        # children must come before their parents. if removed from tracker, it must be removed from verified
+        share_hashes = list(share_hashes)
+        self.tracker.verified.remove_many([share_hash for share_hash in share_hashes if share_hash in self.tracker.verified.items])
+        self.tracker.remove_many(share_hashes)
+    
     def clean_tracker(self):
         best, desired, decorated_heads = self.tracker.think(self.get_height_rel_highest, self.bitcoind_work.value['previous_block'], self.bitcoind_work.value['bits'], self.known_txs_var.value)
         
         # eat away at heads
         if decorated_heads:
-            for i in xrange(1000):
-                to_remove = set()
-                for share_hash, tail in self.tracker.heads.iteritems():
-                    if share_hash in [head_hash for score, head_hash in decorated_heads[-5:]]:
-                        #print 1
-                        continue
-                    if self.tracker.items[share_hash].time_seen > time.time() - 300:
-                        #print 2
-                        continue
-                    if share_hash not in self.tracker.verified.items and max(self.tracker.items[after_tail_hash].time_seen for after_tail_hash in self.tracker.reverse.get(tail)) > time.time() - 120: # XXX stupid
-                        #print 3
-                        continue
-                    to_remove.add(share_hash)
+            keep = set(head_hash for score, head_hash in decorated_heads[-5:])
+            while True:
+                to_remove = self.eviction_queue.get_due_heads(keep)
                 if not to_remove:
                     break
-                for share_hash in to_remove:
-                    if share_hash in self.tracker.verified.items:
-                        self.tracker.verified.remove(share_hash)
-                    self.tracker.remove(share_hash)
-                #print "_________", to_remove
+                self.remove_shares(to_remove)
         
         # drop tails
-        for i in xrange(1000):
-            to_remove = set()
-            for tail, heads in self.tracker.tails.iteritems():
-                if min(self.tracker.get_height(head) for head in heads) < 2*self.tracker.net.CHAIN_LENGTH + 10:
-                    continue
-                to_remove.update(self.tracker.reverse.get(tail, set()))
+        while True:
+            to_remove = [aftertail for tail in self.eviction_queue.get_due_tails(2*self.tracker.net.CHAIN_LENGTH + 10) for aftertail in self.tracker.reverse[tail]]
             if not to_remove:
                 break
-            # if removed from this, it must be removed from verified
-            #start = time.time()
-            for aftertail in to_remove:
-                if self.tracker.items[aftertail].previous_hash not in self.tracker.tails:
-                    print "erk", aftertail, self.tracker.items[aftertail].previous_hash
-                    continue
-                if aftertail in self.tracker.verified.items:
-                    self.tracker.verified.remove(aftertail)
-                self.tracker.remove(aftertail)
-            #end = time.time()
-            #print "removed! %i %f" % (len(to_remove), (end - start)/len(to_remove))
+            self.remove_shares(to_remove)
         
         self.set_best_share()
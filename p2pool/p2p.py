@@ -1,5 +1,7 @@
 from __future__ import division
 
+import collections
+import hashlib
 import math
 import random
 import sys
@@ -16,6 +18,9 @@ from p2pool.util import deferral, p2protocol, pack, variable
 class PeerMisbehavingError(Exception):
     pass
 
+class ShareReplyError(Exception):
+    pass # a sharereply whose result wasn't good, e.g. 'too long'
+
 
 def fragment(f, **kwargs):
     try:
@@ -24,8 +29,17 @@ def fragment(f, **kwargs):
         fragment(f, **dict((k, v[:len(v)//2]) for k, v in kwargs.iteritems()))
         fragment(f, **dict((k, v[len(v)//2:]) for k, v in kwargs.iteritems()))
 
+short_tx_id_type = pack.IntType(48)
+
+def get_short_tx_id(salt, tx_hash):
+    return short_tx_id_type.unpack(hashlib.sha256(salt + bitcoin_data.int_to_hash(tx_hash)).digest()[:6])
+
 class Protocol(p2protocol.Protocol):
     max_remembered_txs_size = 2500000
+    max_remote_share_hashes = 20000 # number of shares remembered as known to the peer
+    tx_announce_delay = 0.5 # seconds to hold have_tx/losing_tx announcements so they can be sent together
+    max_tx_announce_batch = 1000 # number of held announcements that causes them to be sent right away
+    compact_txs_timeout = 20 # seconds to wait for txs a cmpctshares referred to by short ids that aren't known
     
     def __init__(self, node, incoming):
         p2protocol.Protocol.__init__(self, node.net.PREFIX, 1000000, node.traffic_happened)
@@ -34,6 +48,15 @@ class Protocol(p2protocol.Protocol):
         
         self.other_version = None
         self.connected2 = False
+        
+        self._pending_have_tx = set()
+        self._pending_losing_tx = set()
+        self._tx_announce_delayed = None
+        
+        self.remote_share_hashes = collections.OrderedDict() # view of shares the peer has or was told about, least recently seen first
+        
+        self.loading_shares = 0 # shares messages still being loaded by load_shares
+        self.held_forget_tx = set() # forgotten by peer, but kept in remembered_txs until the shares sent before were handled
     
     def connectionMade(self):
         self.factory.proto_made_connection(self)
@@ -43,7 +66,7 @@ class Protocol(p2protocol.Protocol):
         self.addr = self.transport.getPeer().host, self.transport.getPeer().port
         
         self.send_version(
-            version=1100,
+            version=1300,
             services=0,
             addr_to=dict(
                 services=0,
@@ -76,6 +99,13 @@ class Protocol(p2protocol.Protocol):
         self.remembered_txs = {} # view of peer's mining_txs
         self.remembered_txs_size = 0
         self.known_txs_cache = {}
+        
+        self.short_id_cache = {} # tx hash -> short tx id, filled in lazily for known_txs when a cmpctshares arrives
+        self.short_id_index = {} # short tx id -> tx hash, or None if ambiguous
+        self.compact_sent_txs = {} # cmpctshares id -> short tx id -> tx, kept so peer can ask for txs it's missing
+        self.compact_pending = {} # cmpctshares id -> (shares, set of missing short tx ids, set of tx hashes held, timeout call)
+        self.compact_txs = {} # tx hash -> (tx, number of cmpctshares using it), charged to remembered_txs_size like remember_tx
+        self.compact_loading = {} # tx hash -> number of cmpctshares using it whose shares are being loaded, like held_forget_tx
     
     def _connect_timeout(self):
         self.timeout_delayed = None
@@ -133,6 +163,7 @@ class Protocol(p2protocol.Protocol):
         
         self.nonce = nonce
         self.connected2 = True
+        self.short_id_salt = pack.IntType(64).pack(min(nonce, self.node.nonce)) + pack.IntType(64).pack(max(nonce, self.node.nonce))
         
         self.timeout_delayed.cancel()
         self.timeout_delayed = reactor.callLater(100, self._timeout)
@@ -160,35 +191,28 @@ class Protocol(p2protocol.Protocol):
         if self.other_version < 8:
             return
         
-        def update_remote_view_of_my_known_txs(before, after):
-            added = set(after) - set(before)
-            removed = set(before) - set(after)
-            if added:
-                self.send_have_tx(tx_hashes=list(added))
+        def update_remote_view_of_my_known_txs(added, removed):
+            self.queue_tx_announcements(added, removed)
             if removed:
-                self.send_losing_tx(tx_hashes=list(removed))
-                
                 # cache forgotten txs here for a little while so latency of "losing_tx" packets doesn't cause problems
                 key = max(self.known_txs_cache) + 1 if self.known_txs_cache else 0
-                self.known_txs_cache[key] = dict((h, before[h]) for h in removed)
+                self.known_txs_cache[key] = removed
                 reactor.callLater(20, self.known_txs_cache.pop, key)
-        watch_id = self.node.known_txs_var.transitioned.watch(update_remote_view_of_my_known_txs)
-        self.connection_lost_event.watch(lambda: self.node.known_txs_var.transitioned.unwatch(watch_id))
+        watch_id = self.node.known_txs_var.diffed.watch(update_remote_view_of_my_known_txs)
+        self.connection_lost_event.watch(lambda: self.node.known_txs_var.diffed.unwatch(watch_id))
         
         self.send_have_tx(tx_hashes=self.node.known_txs_var.value.keys())
         
-        def update_remote_view_of_my_mining_txs(before, after):
-            added = set(after) - set(before)
-            removed = set(before) - set(after)
+        def update_remote_view_of_my_mining_txs(added, removed):
             if added:
-                self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(after[x]) for x in added)
+                self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(tx) for tx in added.itervalues())
                 assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
-                fragment(self.send_remember_tx, tx_hashes=[x for x in added if x in self.remote_tx_hashes], txs=[after[x] for x in added if x not in self.remote_tx_hashes])
+                fragment(self.send_remember_tx, tx_hashes=[x for x in added if x in self.remote_tx_hashes], txs=[tx for x, tx in added.iteritems() if x not in self.remote_tx_hashes])
             if removed:
-                self.send_forget_tx(tx_hashes=list(removed))
-                self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(before[x]) for x in removed)
-        watch_id2 = self.node.mining_txs_var.transitioned.watch(update_remote_view_of_my_mining_txs)
-        self.connection_lost_event.watch(lambda: self.node.mining_txs_var.transitioned.unwatch(watch_id2))
+                self.send_forget_tx(tx_hashes=removed.keys())
+                self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(tx) for tx in removed.itervalues())
+        watch_id2 = self.node.mining_txs_var.diffed.watch(update_remote_view_of_my_mining_txs)
+        self.connection_lost_event.watch(lambda: self.node.mining_txs_var.diffed.unwatch(watch_id2))
         
         self.remote_remembered_txs_size += sum(100 + bitcoin_data.tx_type.packed_size(x) for x in self.node.mining_txs_var.value.values())
         assert self.remote_remembered_txs_size <= self.max_remembered_txs_size
@@ -255,9 +279,41 @@ class Protocol(p2protocol.Protocol):
         ('shares', pack.ListType(p2pool_data.share_type)),
     ])
     def handle_shares(self, shares):
-        self.node.handle_shares([p2pool_data.load_share(share, self.node.net, self.addr) for share in shares if share['type'] >= 9], self)
+        # loading can finish after later messages were handled, so forget_tx is held back until then (see handle_forget_tx)
+        self.loading_shares += 1
+        df = p2pool_data.load_shares([share for share in shares if share['type'] >= 9], self.node.net, self.addr, self.node.share_verify_pool)
+        df.addCallback(self._got_shares)
+        df.addCallback(self.node.handle_shares, self)
+        df.addErrback(self._shares_failed)
+        df.addErrback(lambda fail: None)
+        df.addCallback(lambda _: self._shares_handled())
+        return df
+    
+    def _shares_handled(self):
+        self.loading_shares -= 1
+        if not self.loading_shares and self.held_forget_tx:
+            tx_hashes = list(self.held_forget_tx)
+            self.held_forget_tx.clear()
+            self.handle_forget_tx(tx_hashes)
+    
+    def _got_shares(self, shares):
+        self.note_remote_share_hashes(share.hash for share in shares)
+        return shares
+    
+    def _shares_failed(self, fail):
+        if fail.check(defer.FirstError):
+            fail = fail.value.subFailure
+        if fail.check(PeerMisbehavingError):
+            print 'Peer %s:%i misbehaving, will drop and ban. Reason:' % self.addr, fail.value.message
+            self.badPeerHappened()
+        else:
+            log.err(fail, 'Error handling shares:')
+            self.disconnect()
+        return fail
     
-    def sendShares(self, shares, tracker, known_txs, include_txs_with=[]):
+    def sendShares(self, shares, tracker, known_txs, include_txs_with=[], packed_shares_cache=None):
+        self.note_remote_share_hashes(share.hash for share in shares)
+        
         if self.other_version >= 8:
             tx_hashes = set()
             for share in shares:
@@ -268,20 +324,191 @@ class Protocol(p2protocol.Protocol):
             
             hashes_to_send = [x for x in tx_hashes if x not in self.node.mining_txs_var.value and x in known_txs]
             
+            # the peer charges txs sent with compact shares to the same budget as remembered ones
             new_remote_remembered_txs_size = self.remote_remembered_txs_size + sum(100 + bitcoin_data.tx_type.packed_size(known_txs[x]) for x in hashes_to_send)
             if new_remote_remembered_txs_size > self.max_remembered_txs_size:
                 raise ValueError('shares have too many txs')
+            
+            if self.other_version >= 1200 and hashes_to_send:
+                try:
+                    self.sendCompactShares(shares, [(x, known_txs[x]) for x in hashes_to_send])
+                except p2protocol.TooLong:
+                    pass # fall back to remember_tx, which can be fragmented
+                else:
+                    # there's no forget_tx to follow, as the peer drops the txs once the shares are loaded. it stops
+                    # counting them then, or when it gives up waiting for missing ones, so this is released after that
+                    size = new_remote_remembered_txs_size - self.remote_remembered_txs_size
+                    self.remote_remembered_txs_size = new_remote_remembered_txs_size
+                    reactor.callLater(2*self.compact_txs_timeout, self._release_remote_compact_txs, size)
+                    return
+            
             self.remote_remembered_txs_size = new_remote_remembered_txs_size
             
-            fragment(self.send_remember_tx, tx_hashes=[x for x in hashes_to_send if x in self.remote_tx_hashes], txs=[known_txs[x] for x in hashes_to_send if x not in self.remote_tx_hashes])
+            if hashes_to_send:
+                fragment(self.send_remember_tx, tx_hashes=[x for x in hashes_to_send if x in self.remote_tx_hashes], txs=[known_txs[x] for x in hashes_to_send if x not in self.remote_tx_hashes])
         
-        fragment(self.send_shares, shares=[share.as_share() for share in shares])
+        self.sendSharesMessage(shares, packed_shares_cache)
         
-        if self.other_version >= 8:
+        if self.other_version >= 8 and hashes_to_send:
             self.send_forget_tx(tx_hashes=hashes_to_send)
             
             self.remote_remembered_txs_size -= sum(100 + bitcoin_data.tx_type.packed_size(known_txs[x]) for x in hashes_to_send)
     
+    def _release_remote_compact_txs(self, size):
+        self.remote_remembered_txs_size -= size
+        assert self.remote_remembered_txs_size >= 0
+    
+    def sendSharesMessage(self, shares, packed_shares_cache=None):
+        # the packed message only depends on the shares, so a broadcast can pass a cache dict to reuse it for every peer
+        key = tuple(share.hash for share in shares)
+        if packed_shares_cache is not None and key in packed_shares_cache:
+            packet = packed_shares_cache[key]
+        else:
+            try:
+                packet = self.packPacket('shares', dict(shares=[share.as_share() for share in shares]))
+            except p2protocol.TooLong:
+                packet = None
+            if packed_shares_cache is not None:
+                packed_shares_cache[key] = packet
+        
+        if packet is None:
+            fragment(self.send_shares, shares=[share.as_share() for share in shares])
+        else:
+            self.sendPackedPacket(packet)
+    
+    def sendCompactShares(self, shares, txs):
+        # txs the peer has announced are sent as short ids, the rest in full
+        short_txs = {}
+        full_txs = []
+        for tx_hash, tx in txs:
+            if tx_hash in self.remote_tx_hashes:
+                short_id = get_short_tx_id(self.short_id_salt, tx_hash)
+                if short_id not in short_txs:
+                    short_txs[short_id] = tx_hash, tx
+                    continue
+                full_txs.append(short_txs.pop(short_id)[1]) # colliding short ids can't be resolved by the peer
+            full_txs.append(tx)
+        
+        id = random.randrange(2**64)
+        self.compact_sent_txs[id] = dict((short_id, tx) for short_id, (tx_hash, tx) in short_txs.iteritems())
+        try:
+            self.send_cmpctshares(id=id, shares=[share.as_share() for share in shares], short_ids=short_txs.keys(), txs=full_txs)
+        except:
+            del self.compact_sent_txs[id]
+            raise
+        reactor.callLater(self.compact_txs_timeout, self.compact_sent_txs.pop, id, None)
+    
+    def resolve_short_ids(self, short_ids):
+        # short ids of known_txs are only worked out when a peer sends some, then kept for this connection's salt
+        known_txs = self.node.known_txs_var.value
+        if len(self.short_id_cache) > 2*len(known_txs) + 1000:
+            self.short_id_cache, self.short_id_index = {}, {} # mostly forgotten txs
+        for tx_hash in known_txs:
+            if tx_hash not in self.short_id_cache:
+                short_id = self.short_id_cache[tx_hash] = get_short_tx_id(self.short_id_salt, tx_hash)
+                self.short_id_index[short_id] = tx_hash if self.short_id_index.get(short_id, tx_hash) == tx_hash else None
+        
+        resolved, missing = {}, set()
+        for short_id in short_ids:
+            tx_hash = self.short_id_index.get(short_id)
+            if tx_hash is not None and tx_hash in known_txs:
+                resolved[tx_hash] = known_txs[tx_hash]
+            else:
+                missing.add(short_id)
+        return resolved, missing
+    
+    def _hold_compact_txs(self, id, txs):
+        held = self.compact_pending[id][2]
+        for tx_hash, tx in txs.iteritems():
+            if tx_hash in held:
+                continue
+            held.add(tx_hash)
+            if tx_hash in self.compact_txs:
+                tx, refs = self.compact_txs[tx_hash]
+                self.compact_txs[tx_hash] = tx, refs + 1
+            else:
+                self.compact_txs[tx_hash] = tx, 1
+                self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
+        self.check_remembered_txs_size()
+    
+    def _release_compact_txs(self, held, loaded=False):
+        for tx_hash in held:
+            if loaded:
+                loading = self.compact_loading.pop(tx_hash)
+                if loading > 1:
+                    self.compact_loading[tx_hash] = loading - 1
+            tx, refs = self.compact_txs.pop(tx_hash)
+            if refs > 1:
+                self.compact_txs[tx_hash] = tx, refs - 1
+            else:
+                self.remembered_txs_size -= 100 + bitcoin_data.tx_type.packed_size(tx)
+                assert self.remembered_txs_size >= 0
+    
+    def _compact_timed_out(self, id):
+        shares, missing, held, timeout = self.compact_pending.pop(id)
+        self._release_compact_txs(held)
+    
+    def _finish_compact_shares(self, id):
+        shares, missing, held, timeout = self.compact_pending.pop(id)
+        if timeout is not None:
+            timeout.cancel()
+        # like a remember_tx/shares/forget_tx sequence, with the forget once the shares are loaded
+        self.node.known_txs_var.update(added=dict((tx_hash, self.compact_txs[tx_hash][0]) for tx_hash in held if tx_hash not in self.node.known_txs_var.value))
+        for tx_hash in held:
+            self.compact_loading[tx_hash] = self.compact_loading.get(tx_hash, 0) + 1
+        df = self.handle_shares(shares)
+        df.addCallback(lambda _: self._release_compact_txs(held, loaded=True))
+    
+    message_cmpctshares = pack.ComposedType([
+        ('id', pack.IntType(64)),
+        ('shares', pack.ListType(p2pool_data.share_type)),
+        ('short_ids', pack.ListType(short_tx_id_type)),
+        ('txs', pack.ListType(bitcoin_data.tx_type)),
+    ])
+    def handle_cmpctshares(self, id, shares, short_ids, txs):
+        if id in self.compact_pending:
+            raise PeerMisbehavingError('cmpctshares id reused')
+        
+        resolved, missing = self.resolve_short_ids(short_ids)
+        resolved.update((bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), tx) for tx in txs)
+        self.compact_pending[id] = shares, missing, set(), reactor.callLater(self.compact_txs_timeout, self._compact_timed_out, id) if missing else None
+        self._hold_compact_txs(id, resolved)
+        
+        if not missing:
+            self._finish_compact_shares(id)
+            return
+        self.send_cmpcttxreq(id=id, short_ids=list(missing))
+    
+    message_cmpcttxreq = pack.ComposedType([
+        ('id', pack.IntType(64)),
+        ('short_ids', pack.ListType(short_tx_id_type)),
+    ])
+    def handle_cmpcttxreq(self, id, short_ids):
+        sent_txs = self.compact_sent_txs.get(id, {})
+        fragment(lambda txs: self.send_cmpcttxs(id=id, txs=txs), txs=[sent_txs[short_id] for short_id in short_ids if short_id in sent_txs])
+    
+    message_cmpcttxs = pack.ComposedType([
+        ('id', pack.IntType(64)),
+        ('txs', pack.ListType(bitcoin_data.tx_type)),
+    ])
+    def handle_cmpcttxs(self, id, txs):
+        if id not in self.compact_pending:
+            return # timed out
+        shares, missing, held, timeout = self.compact_pending[id]
+        
+        new_txs = {}
+        for tx in txs:
+            tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
+            short_id = get_short_tx_id(self.short_id_salt, tx_hash)
+            if short_id not in missing:
+                raise PeerMisbehavingError('sent transaction that was not requested')
+            missing.remove(short_id)
+            new_txs[tx_hash] = tx
+        self._hold_compact_txs(id, new_txs)
+        
+        if not missing:
+            self._finish_compact_shares(id)
+    
     
     message_sharereq = pack.ComposedType([
         ('id', pack.IntType(256)),
@@ -291,10 +518,22 @@ class Protocol(p2protocol.Protocol):
     ])
     def handle_sharereq(self, id, hashes, parents, stops):
         shares = self.node.handle_get_shares(hashes, parents, stops, self)
-        try:
-            self.send_sharereply(id=id, result='good', shares=[share.as_share() for share in shares])
-        except p2protocol.TooLong:
+        # reply with as many shares as fit in one message rather than failing the whole request
+        # shares keep their packed contents, so the size is added up from them instead of packing each share again
+        var_int_type = pack.VarIntType()
+        packed_shares = []
+        size = 100 # id, result and length of shares list
+        for share in shares:
+            contents = share.packed
+            size += var_int_type.packed_size(share.VERSION) + var_int_type.packed_size(len(contents)) + len(contents)
+            if size > self._max_payload_length:
+                break
+            packed_shares.append(dict(type=share.VERSION, contents=contents))
+        self.note_remote_share_hashes(share.hash for share in shares[:len(packed_shares)])
+        if shares and not packed_shares:
             self.send_sharereply(id=id, result='too long', shares=[])
+        else:
+            self.send_sharereply(id=id, result='good', shares=packed_shares)
     
     message_sharereply = pack.ComposedType([
         ('id', pack.IntType(256)),
@@ -303,12 +542,43 @@ class Protocol(p2protocol.Protocol):
     ])
     def handle_sharereply(self, id, result, shares):
         if result == 'good':
-            res = [p2pool_data.load_share(share, self.node.net, self.addr) for share in shares if share['type'] >= 9]
+            res = p2pool_data.load_shares([share for share in shares if share['type'] >= 9], self.node.net, self.addr, self.node.share_verify_pool)
+            res.addCallback(self._got_shares)
+            res.addErrback(self._shares_failed)
         else:
-            res = failure.Failure("sharereply result: " + result)
+            res = failure.Failure(ShareReplyError('sharereply result: ' + result))
         self.get_shares.got_response(id, res)
     
     
+    def note_remote_share_hashes(self, share_hashes):
+        for share_hash in share_hashes:
+            self.remote_share_hashes.pop(share_hash, None)
+            self.remote_share_hashes[share_hash] = None
+        while len(self.remote_share_hashes) > self.max_remote_share_hashes:
+            self.remote_share_hashes.popitem(last=False)
+    
+    def announceShares(self, share_hashes):
+        # tells the peer about shares without sending them. it asks for the ones it doesn't have with want_shares
+        share_hashes = [share_hash for share_hash in share_hashes if share_hash not in self.remote_share_hashes]
+        if not share_hashes:
+            return
+        self.note_remote_share_hashes(share_hashes)
+        fragment(self.send_have_shares, hashes=share_hashes)
+    
+    message_have_shares = pack.ComposedType([
+        ('hashes', pack.ListType(pack.IntType(256))),
+    ])
+    def handle_have_shares(self, hashes):
+        self.note_remote_share_hashes(hashes)
+        self.node.handle_have_shares(hashes, self)
+    
+    message_want_shares = pack.ComposedType([
+        ('hashes', pack.ListType(pack.IntType(256))),
+    ])
+    def handle_want_shares(self, hashes):
+        self.node.handle_want_shares(hashes, self)
+    
+    
     message_bestblock = pack.ComposedType([
         ('header', bitcoin_data.block_header_type),
     ])
@@ -331,6 +601,36 @@ class Protocol(p2protocol.Protocol):
         #assert self.remote_tx_hashes.issuperset(tx_hashes)
         self.remote_tx_hashes.difference_update(tx_hashes)
     
+    def queue_tx_announcements(self, added, removed):
+        # a tx that's added and removed again before being announced cancels out, as the peer's view doesn't change
+        for tx_hash in added:
+            if tx_hash in self._pending_losing_tx:
+                self._pending_losing_tx.remove(tx_hash)
+            else:
+                self._pending_have_tx.add(tx_hash)
+        for tx_hash in removed:
+            if tx_hash in self._pending_have_tx:
+                self._pending_have_tx.remove(tx_hash)
+            else:
+                self._pending_losing_tx.add(tx_hash)
+        
+        if len(self._pending_have_tx) + len(self._pending_losing_tx) >= self.max_tx_announce_batch:
+            self.flush_tx_announcements()
+        elif (self._pending_have_tx or self._pending_losing_tx) and self._tx_announce_delayed is None:
+            self._tx_announce_delayed = reactor.callLater(self.tx_announce_delay, self.flush_tx_announcements)
+    
+    def flush_tx_announcements(self):
+        if self._tx_announce_delayed is not None:
+            if self._tx_announce_delayed.active():
+                self._tx_announce_delayed.cancel()
+            self._tx_announce_delayed = None
+        if self._pending_have_tx:
+            fragment(self.send_have_tx, tx_hashes=list(self._pending_have_tx))
+            self._pending_have_tx.clear()
+        if self._pending_losing_tx:
+            fragment(self.send_losing_tx, tx_hashes=list(self._pending_losing_tx))
+            self._pending_losing_tx.clear()
+    
     
     message_remember_tx = pack.ComposedType([
         ('tx_hashes', pack.ListType(pack.IntType(256))),
@@ -338,6 +638,11 @@ class Protocol(p2protocol.Protocol):
     ])
     def handle_remember_tx(self, tx_hashes, txs):
         for tx_hash in tx_hashes:
+            if tx_hash in self.held_forget_tx:
+                # still remembered, so the held forget is just cancelled
+                self.held_forget_tx.remove(tx_hash)
+                continue
+            
             if tx_hash in self.remembered_txs:
                 print >>sys.stderr, 'Peer referenced transaction twice, disconnecting'
                 self.disconnect()
@@ -358,10 +663,14 @@ class Protocol(p2protocol.Protocol):
             
             self.remembered_txs[tx_hash] = tx
             self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
-        new_known_txs = dict(self.node.known_txs_var.value)
+        new_known_txs = {}
         warned = False
         for tx in txs:
             tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
+            if tx_hash in self.held_forget_tx:
+                self.held_forget_tx.remove(tx_hash)
+                continue
+            
             if tx_hash in self.remembered_txs:
                 print >>sys.stderr, 'Peer referenced transaction twice, disconnecting'
                 self.disconnect()
@@ -374,13 +683,25 @@ class Protocol(p2protocol.Protocol):
             self.remembered_txs[tx_hash] = tx
             self.remembered_txs_size += 100 + bitcoin_data.tx_type.packed_size(tx)
             new_known_txs[tx_hash] = tx
-        self.node.known_txs_var.set(new_known_txs)
-        if self.remembered_txs_size >= self.max_remembered_txs_size:
+        self.node.known_txs_var.update(added=new_known_txs)
+        self.check_remembered_txs_size()
+    
+    def check_remembered_txs_size(self):
+        if self.remembered_txs_size < self.max_remembered_txs_size:
+            return
+        # held txs were already forgotten from the peer's point of view, as were txs only used by compact shares being loaded
+        released = sum(100 + bitcoin_data.tx_type.packed_size(self.remembered_txs[tx_hash]) for tx_hash in self.held_forget_tx)
+        released += sum(100 + bitcoin_data.tx_type.packed_size(self.compact_txs[tx_hash][0]) for tx_hash, loading in self.compact_loading.iteritems() if loading == self.compact_txs[tx_hash][1])
+        if self.remembered_txs_size - released >= self.max_remembered_txs_size:
             raise PeerMisbehavingError('too much transaction data stored')
     message_forget_tx = pack.ComposedType([
         ('tx_hashes', pack.ListType(pack.IntType(256))),
     ])
     def handle_forget_tx(self, tx_hashes):
+        if self.loading_shares:
+            # shares received before this may still need these txs once they're loaded
+            self.held_forget_tx.update(tx_hashes)
+            return
         for tx_hash in tx_hashes:
             self.remembered_txs_size -= 100 + bitcoin_data.tx_type.packed_size(self.remembered_txs[tx_hash])
             assert self.remembered_txs_size >= 0
@@ -391,6 +712,13 @@ class Protocol(p2protocol.Protocol):
         self.connection_lost_event.happened()
         if self.timeout_delayed is not None:
             self.timeout_delayed.cancel()
+        if self._tx_announce_delayed is not None:
+            self._tx_announce_delayed.cancel()
+            self._tx_announce_delayed = None
+        for shares, missing, held, timeout in self.compact_pending.itervalues():
+            if timeout is not None:
+                timeout.cancel()
+        self.compact_pending.clear()
         if self.connected2:
             self.factory.proto_disconnected(self, reason)
             self._stop_thread()
@@ -551,15 +879,16 @@ class SingleClientFactory(protocol.ReconnectingClientFactory):
         self.node.lost_conn(proto, reason)
 
 class Node(object):
-    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=variable.Variable({}), mining_txs_var=variable.Variable({})):
+    def __init__(self, best_share_hash_func, port, net, addr_store={}, connect_addrs=set(), desired_outgoing_conns=10, max_outgoing_attempts=30, max_incoming_conns=50, preferred_storage=1000, known_txs_var=None, mining_txs_var=None, share_verify_pool=None):
         self.best_share_hash_func = best_share_hash_func
         self.port = port
         self.net = net
         self.addr_store = dict(addr_store)
         self.connect_addrs = connect_addrs
         self.preferred_storage = preferred_storage
-        self.known_txs_var = known_txs_var
-        self.mining_txs_var = mining_txs_var
+        self.known_txs_var = known_txs_var if known_txs_var is not None else variable.DictVariable({})
+        self.mining_txs_var = mining_txs_var if mining_txs_var is not None else variable.DictVariable({})
+        self.share_verify_pool = share_verify_pool
         
         self.traffic_happened = variable.Event()
         self.nonce = random.randrange(2**64)
@@ -636,6 +965,12 @@ class Node(object):
     def handle_share_hashes(self, hashes, peer):
         print 'handle_share_hashes', (hashes, peer)
     
+    def handle_have_shares(self, hashes, peer):
+        print 'handle_have_shares', (hashes, peer)
+    
+    def handle_want_shares(self, hashes, peer):
+        print 'handle_want_shares', (hashes, peer)
+    
     def handle_get_shares(self, hashes, parents, stops, peer):
         print 'handle_get_shares', (hashes, parents, stops, peer)
     
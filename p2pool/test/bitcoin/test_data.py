@@ -76,3 +76,69 @@ class Test(unittest.TestCase):
             0x13375a426de15631af9afdf00c490e87cc5aab823c327b9856004d0b198d72db,
             0x67d76a64fa9b6c5d39fde87356282ef507b3dec1eead4b54e739c74e02e81db4,
         ]) == 0x37a43a3b812e4eb665975f46393b4360008824aab180f27d642de8c28073bc44
+    
+    def test_hash_int_roundtrip(self):
+        for x in [0, 1, 2**256-1, 0x37a43a3b812e4eb665975f46393b4360008824aab180f27d642de8c28073bc44]:
+            assert data.int_to_hash(x) == pack.IntType(256).pack(x)
+            assert data.hash_to_int(data.int_to_hash(x)) == x
+        self.assertRaises(ValueError, data.int_to_hash, 2**256)
+        self.assertRaises(ValueError, data.int_to_hash, -1)
+    
+    def test_check_merkle_link(self):
+        hashes = [data.hash256(str(i)) for i in xrange(7)]
+        for index in xrange(len(hashes)):
+            link = data.calculate_merkle_link(hashes, index)
+            assert data.check_merkle_link(hashes[index], link) == data.merkle_hash(hashes)
+            assert data.check_merkle_link_raw(data.int_to_hash(hashes[index]), link) == data.int_to_hash(data.merkle_hash(hashes))
+    
+    def test_merkle_tree(self):
+        hashes = [data.hash256(str(i)) for i in xrange(13)]
+        tree = data.MerkleTree([])
+        assert tree.get_root() == 0
+        for i, h in enumerate(hashes):
+            tree.append(h)
+            assert len(tree) == i + 1
+            assert tree.get_root() == data.merkle_hash(hashes[:i + 1])
+            for index in xrange(i + 1):
+                assert data.check_merkle_link(hashes[index], tree.get_link(index)) == tree.get_root()
+        
+        hashes[5] = data.hash256('replaced')
+        tree[5] = hashes[5]
+        assert tree.get_root() == data.merkle_hash(hashes) == data.MerkleTree(hashes).get_root()
+        self.assertRaises(IndexError, tree.get_link, len(hashes))
+        
+        # links over a prefix, as when a share only includes the first txs
+        for length in xrange(1, len(hashes) + 1):
+            for index in xrange(length):
+                assert data.check_merkle_link(hashes[index], tree.get_link(index, length)) == data.merkle_hash(hashes[:length])
+        self.assertRaises(IndexError, tree.get_link, 3, 3)
+        
+        for length in [13, 9, 8, 2, 1, 0]:
+            tree.truncate(length)
+            assert len(tree) == length and tree.get_root() == data.merkle_hash(hashes[:length])
+            assert tree._levels == data.MerkleTree(hashes[:length])._levels
+    
+    def test_merkle_tree_update(self):
+        hashes = [data.hash256(str(i)) for i in xrange(100)]
+        tree = data.MerkleTree(hashes)
+        for new_hashes in [
+            hashes, # unchanged
+            hashes[:50] + [data.hash256('a')] + hashes[51:], # one replaced
+            hashes + [data.hash256('b'), data.hash256('c')], # appended
+            hashes[:97], # removed from the end
+            hashes[:97] + [data.hash256('d')],
+            [data.hash256(str(i)) for i in xrange(100, 170)], # all different
+            [],
+            hashes[:1],
+        ]:
+            tree.update(new_hashes)
+            assert tree._levels == data.MerkleTree(new_hashes)._levels
+    
+    def test_merkle_tree_unknown_leaf(self):
+        hashes = [None] + [data.hash256(str(i)) for i in xrange(6)]
+        tree = data.MerkleTree(hashes)
+        self.assertRaises(ValueError, tree.get_root)
+        self.assertRaises(ValueError, tree.get_link, 3)
+        link = tree.get_link(0)
+        gentx_hash = data.hash256('gentx')
+        assert data.check_merkle_link(gentx_hash, link) == data.merkle_hash([gentx_hash] + hashes[1:])
@@ -35,3 +35,12 @@ class Test(unittest.TestCase):
             b.update(test2)
             b = b.hexdigest()
             assert a == b
+    
+    def test_process(self):
+        def random_str(l):
+            return ''.join(chr(random.randrange(256)) for i in xrange(l))
+        for blocks in xrange(5):
+            state, data = random_str(32), random_str(64*blocks)
+            res = sha256.python_process(state, data)
+            assert res == reduce(sha256.python_process, [data[i:i+64] for i in xrange(0, len(data), 64)], state)
+            assert sha256.process(state, data) == res
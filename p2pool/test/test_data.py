@@ -1,8 +1,15 @@
+from __future__ import division
+
+import array
+import os
 import random
+import shutil
+import tempfile
 import unittest
 
 from p2pool import data
 from p2pool.bitcoin import data as bitcoin_data
+from p2pool.test import test_node
 from p2pool.test.util import test_forest
 from p2pool.util import forest
 
@@ -39,3 +46,281 @@ class Test(unittest.TestCase):
         for i in xrange(200):
             a = random.randrange(200)
             d(a, random.randrange(a + 1), 1000000*65535)[1]
+    
+    def test_transaction_refs(self):
+        t = forest.Tracker()
+        d = data.TransactionRefIndex(t)
+        for i in xrange(300):
+            previous_hash = None if i == 0 else i - 1 if random.randrange(10) else random.randrange(i)
+            t.add(test_forest.FakeShare(hash=i, previous_hash=previous_hash, new_transaction_hashes=[random.randrange(400) for j in xrange(random.randrange(5))]))
+        for i in xrange(300):
+            head = i if random.randrange(4) else random.randrange(300)
+            d.set_head(head)
+            count = min(t.get_height(head), 100)
+            assert d.covers(head, count)
+            refs = data.get_transaction_refs(t, head, count)
+            for tx_hash in xrange(400):
+                assert d.get(tx_hash) == refs.get(tx_hash), (head, tx_hash)
+        for i in xrange(299, 249, -1):
+            t.remove(i)
+        assert not d.covers(299, 100)
+    
+    def test_weights_window(self):
+        t = forest.Tracker()
+        d = data.WeightsSkipList(t)
+        for i in xrange(300):
+            t.add(test_forest.FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None, new_script=random.randrange(10), share_data=dict(donation=random.choice([0, 1234, 65535])), target=2**random.randrange(245, 250)))
+            for max_shares in [min(i + 1, 100), min(i + 1, 50)]:
+                for desired_weight in [65535*2**15, 65535*2**256]:
+                    res = d(i, max_shares, desired_weight)
+                    assert res == forest.TrackerSkipList.__call__(d, i, max_shares, desired_weight), (i, max_shares, desired_weight)
+        assert d.derived > 1000, d.derived
+    
+    def test_chain_window(self):
+        t = data.OkayTracker(test_node.mynet)
+        for i in xrange(200):
+            target = 2**random.randrange(190, 250)
+            t.add(test_forest.FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None, timestamp=1000 + 10*i, target=target, max_target=target, desired_version=random.choice([12, 13]),
+                share_data=dict(stale_info=random.choice([None, None, 'orphan', 'doa']), pubkey_hash=random.randrange(5))))
+        chain = list(t.get_chain(199, 150))
+        
+        stales = sum(1 for share in chain if share.share_data['stale_info'] is not None)
+        assert data.get_average_stale_prop(t, 199, 150) == stales/(150 + stales)
+        stales = sum(1 for share in t.get_chain(199, 200) if share.share_data['stale_info'] is not None)
+        assert data.get_average_stale_prop(t, 199, 200) == stales/(200 + stales)
+        
+        counts = {}
+        for share in chain[:149]:
+            attempts = bitcoin_data.target_to_average_attempts(share.target)
+            counts['good'] = counts.get('good', 0) + attempts
+            if share.share_data['stale_info'] is not None:
+                counts[share.share_data['stale_info']] = counts.get(share.share_data['stale_info'], 0) + attempts
+        assert data.get_stale_counts(t, 199, 150) == counts
+        assert data.get_stale_counts(t, 199, 1) == {}
+        
+        props = {}
+        for share in chain[:149]:
+            stale, total = props.get(share.share_data['pubkey_hash'], (0, 0))
+            stale, total = stale + (share.share_data['stale_info'] is not None), total + 1 + (share.share_data['stale_info'] is not None)
+            props[share.share_data['pubkey_hash']] = stale, total
+        assert data.get_user_stale_props(t, 199, 150) == dict((k, stale/total) for k, (stale, total) in props.iteritems())
+        
+        versions = {}
+        for share in chain:
+            versions[share.desired_version] = versions.get(share.desired_version, 0) + bitcoin_data.target_to_average_attempts(share.target)
+        assert data.get_desired_version_counts(t, 199, 150) == versions
+        assert data.get_desired_version_counts(t, 199, 200) == t.get_window(199, 200).get_desired_version_attempts()
+        assert not hasattr(t, 'stats_view') and not hasattr(t.get_delta_to_last(199), 'stale_count') # counted from windows instead
+        stale_attempts = t.get_window(199, 199).get_stale_info_attempts()
+        stale_attempts['good'] = sum(stale_attempts.itervalues())
+        stale_attempts.pop(None, None)
+        assert data.get_stale_counts(t, 199, 200) == stale_attempts
+        rates = data.get_stale_counts(t, 199, 150, rates=True)
+        assert rates == dict((k, v/(10*149)) for k, v in counts.iteritems())
+        
+        window = t.get_window(199, 150)
+        mine = window.get_mask(set(range(0, 200, 3)))
+        assert sum(window.get_stale_info_counts(mine).itervalues()) == sum(1 for share in chain if share.hash % 3 == 0)
+        assert window.get_stale_info_counts(mine).get('doa', 0) == sum(1 for share in chain if share.hash % 3 == 0 and share.share_data['stale_info'] == 'doa')
+        assert sum(window.get_stale_info_attempts(mine, 100).itervalues()) == sum(bitcoin_data.target_to_average_attempts(share.target) for share in chain[:100] if share.hash % 3 == 0)
+        
+        # new best shares move the window along instead of rebuilding it
+        window = t.get_window(199, 100)
+        for i in xrange(200, 230):
+            t.add(test_forest.FakeShare(hash=i, previous_hash=i - 1, timestamp=1000 + 10*i, target=2**200, max_target=2**200, desired_version=13,
+                share_data=dict(stale_info=random.choice([None, 'doa']), pubkey_hash=random.randrange(3, 8))))
+            assert t.get_window(i, 100) is window
+            fresh = data.ChainWindow.from_chain(t, i, 100)
+            assert list(window.hashes) == list(fresh.hashes) and window.hash_set == set(fresh.hashes)
+            assert window.get_user_stale_counts() == fresh.get_user_stale_counts()
+            assert window.get_desired_version_attempts() == fresh.get_desired_version_attempts()
+            assert window.get_stale_info_attempts(window.get_mask(set(range(0, 230, 3))), 50) == fresh.get_stale_info_attempts(fresh.get_mask(set(range(0, 230, 3))), 50)
+        
+        # columns only fall back to lists when a value doesn't fit
+        assert isinstance(t.get_window(199, 200).attempts, list) == any(bitcoin_data.target_to_average_attempts(share.target) >= 2**(8*array.array('L').itemsize) for share in t.get_chain(199, 200))
+        assert isinstance(data.ChainWindow.from_chain(t, 228, 20).attempts, array.array)
+        
+        t.remove_many(range(30)) # outside the window
+        assert t.get_window(229, 100) is window
+        t.remove(229) # in it
+        assert t.get_window(228, 100) is not window
+    
+    def test_compact_share(self):
+        data.Share.COMPACT = False
+        try:
+            share = get_test_share()
+        finally:
+            data.Share.COMPACT = True
+        share2 = data.load_share(share.as_share(), test_node.mynet, None)
+        assert share2.as_share() == share.as_share()
+        assert share2.hash == share.hash
+        assert share2.packed is share2.as_share()['contents'] # as_share doesn't repack
+        assert share._contents is not None and share2._contents is None # compact shares only keep packed
+        for attr in ['contents', 'min_header', 'share_info', 'share_data', 'hash_link', 'merkle_link', 'new_transaction_hashes', 'header']:
+            assert getattr(share2, attr) == getattr(share, attr), attr
+    
+    def test_share_store(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(tmpdir, 'shares.')
+            shares = [get_test_share(nonce=i) for i in xrange(6)]
+            
+            # old format
+            with open(prefix + '0', 'wb') as f:
+                f.write('5 %s\n' % (data.share_type.pack(shares[0].as_share()).encode('hex'),))
+                f.write('2 %x\n' % (shares[0].hash,))
+            
+            for compress in [False, True]:
+                ss = data.ShareStore(prefix, test_node.mynet, compress=compress)
+                loaded = list(ss.get_shares())
+                for share in shares[:3 + 2*compress]:
+                    ss.add_share(share)
+                    ss.add_verified_hash(share.hash)
+                ss.flush()
+                for share in shares[1:3 + 2*compress]:
+                    assert ss.get_share(share.hash).as_share() == share.as_share()
+            
+            ss = data.ShareStore(prefix, test_node.mynet)
+            loaded = list(ss.get_shares())
+            assert sorted(x.hash for mode, x in loaded if mode == 'share') == sorted(share.hash for share in shares[:5])
+            assert sorted(x for mode, x in loaded if mode == 'verified_hash') == sorted(share.hash for share in shares[:5])
+            assert len(ss.known) == 2
+            
+            ss = data.ShareStore(prefix, test_node.mynet)
+            trusted = dict((x.hash, x) for mode, x in ss.get_shares(trusted=True) if mode == 'share')
+            assert ss.unverified_hashes == set(share.hash for share in shares[1:5])
+            for share in shares[:5]:
+                assert trusted[share.hash].pow_hash == share.pow_hash
+                assert data.check_stored_share(trusted[share.hash], test_node.mynet)
+            assert not data.check_stored_share(data.load_share(shares[1].as_share(), test_node.mynet, None, gentx_hash=123), test_node.mynet)
+            
+            # a partially written record is discarded
+            filename = prefix + '1'
+            with open(filename, 'ab') as f:
+                f.write(ss.record_header_type.pack(dict(length=100, kind=5, hash=shares[5].hash)))
+            ss = data.ShareStore(prefix, test_node.mynet)
+            assert len(list(ss.get_shares())) == len(loaded)
+            digest = ss.get_digest()
+            ss.add_share(shares[5])
+            assert ss.get_digest() != digest
+            digest = ss.get_digest()
+            ss.flush()
+            ss = data.ShareStore(prefix, test_node.mynet)
+            assert len(list(ss.get_shares())) == len(loaded) + 1
+            assert ss.get_digest() == digest
+            
+            for share in shares[:3]:
+                ss.forget_share(share.hash)
+                ss.forget_verified_share(share.hash)
+            ss.forget_shares(share.hash for share in shares[3:])
+            assert ss.known
+            ss.forget_shares((share.hash for share in shares[3:]), verified=True)
+            assert not ss.known and not ss.share_files and not ss.verified_files
+            assert not os.listdir(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+    
+    def test_think_cache(self):
+        calls = []
+        class CountingShare(data.Share):
+            def check(self, tracker):
+                calls.append(('check', self.hash))
+                return data.Share.check(self, tracker)
+            def should_punish_reason(self, *args):
+                calls.append(('punish', self.hash))
+                return data.Share.should_punish_reason(self, *args)
+        
+        tracker = data.OkayTracker(test_node.mynet)
+        share = get_test_share(share_type=CountingShare)
+        tracker.add(share)
+        
+        block_rel_height_func = lambda block_hash: 0
+        known_txs = {}
+        res = tracker.think(block_rel_height_func, 1, share.header['bits'], known_txs)
+        assert res[0] == share.hash
+        assert share.hash in tracker.verified.items
+        assert ('check', share.hash) in calls and ('punish', share.hash) in calls
+        
+        del calls[:]
+        assert tracker.think(block_rel_height_func, 1, share.header['bits'], known_txs) == res
+        assert not calls
+        
+        assert tracker.think(block_rel_height_func, 1, share.header['bits'], {}) == res
+        assert calls == [('punish', share.hash)], calls
+        
+        # a change to known_txs only brings back heads that use a changed tx
+        tx = dict(version=1, tx_ins=[], tx_outs=[dict(value=0, script='')], lock_time=0)
+        tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
+        known_txs = {}
+        other = get_test_share(nonce=1, share_type=CountingShare, tx_hashes=[tx_hash])
+        tracker.add(other)
+        tracker.think(block_rel_height_func, 1, share.header['bits'], known_txs)
+        assert other.hash in tracker._punish_tx_heads[tx_hash]
+        del calls[:]
+        known_txs[123] = None
+        tracker.forget_punishments([123])
+        tracker.think(block_rel_height_func, 1, share.header['bits'], known_txs)
+        assert not calls
+        known_txs[tx_hash] = tx
+        tracker.forget_punishments([tx_hash])
+        tracker.think(block_rel_height_func, 1, share.header['bits'], known_txs)
+        assert calls == [('punish', other.hash)], calls
+        tracker.verified.remove(other.hash)
+        tracker.remove(other.hash)
+        res = tracker.think(block_rel_height_func, 1, share.header['bits'], {})
+        assert res[0] == share.hash
+        
+        # only the new head is looked at
+        del calls[:]
+        child = get_test_share(share_type=CountingShare, tracker=tracker, previous_share_hash=share.hash)
+        tracker.add(child)
+        res = tracker.think(block_rel_height_func, 1, share.header['bits'], {})
+        assert res[0] == child.hash
+        assert sorted(calls) == [('check', child.hash), ('punish', child.hash)], calls
+        assert [head for decoration, head in res[2]] == [child.hash]
+        
+        tracker.verified.remove(child.hash)
+        tracker.remove(child.hash)
+        assert tracker.think(block_rel_height_func, 1, share.header['bits'], {})[0] == share.hash
+        tracker.verified.remove(share.hash)
+        tracker.remove(share.hash)
+        assert tracker.think(block_rel_height_func, 1, share.header['bits'], {})[0] is None
+        assert not tracker._scores and not tracker._punishments and not tracker._wants and not tracker._punish_tx_heads
+        assert not tracker._head_entries and not tracker._sorted_heads and not tracker._tail_best and not tracker._short_heads
+
+    def test_generate_transaction_merkle_tree(self):
+        txs = [dict(version=1, tx_ins=[], tx_outs=[dict(value=i, script='x'*20000)], lock_time=0) for i in xrange(5)]
+        tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in txs]
+        known_txs = dict(zip(tx_hashes, txs))
+        tree = bitcoin_data.MerkleTree([None] + tx_hashes)
+        tracker = data.OkayTracker(test_node.mynet)
+        share_data = dict(previous_share_hash=None, coinbase='\x01\x02', nonce=0, pubkey_hash=0x1234, subsidy=5000000000, donation=1234, stale_info=None, desired_version=9)
+        res = [data.Share.generate_transaction(tracker, share_data, 2**256 - 1, 1351658517, 2**256 - 1, dict(branch=[], index=0), [(tx_hash, 0) for tx_hash in tx_hashes], test_node.mynet,
+            known_txs=known_txs, base_subsidy=5000000000, merkle_tree=merkle_tree) for merkle_tree in [None, tree]]
+        assert res[0][2] == res[1][2] == tx_hashes[:2] # only 50 kB of new txs fit
+        assert res[0][3] == res[1][3]
+        gentx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(res[1][1]))
+        assert bitcoin_data.check_merkle_link(gentx_hash, res[1][3]) == bitcoin_data.merkle_hash([gentx_hash] + tx_hashes[:2])
+        assert len(tree) == 6 # left as it was
+
+def get_test_share(nonce=0, share_type=data.Share, tracker=None, previous_share_hash=None, tx_hashes=[]):
+    if tracker is None:
+        tracker = data.OkayTracker(test_node.mynet)
+    share_info, gentx, other_transaction_hashes, merkle_link, get_share = share_type.generate_transaction(tracker, dict(
+        previous_share_hash=previous_share_hash,
+        coinbase='\x01\x02',
+        nonce=0,
+        pubkey_hash=0x1234,
+        subsidy=5000000000,
+        donation=1234,
+        stale_info=None,
+        desired_version=9,
+    ), 2**256 - 1, 1351658517, 2**256 - 1, dict(branch=[], index=0), [(tx_hash, None) for tx_hash in tx_hashes], test_node.mynet)
+    return get_share(dict(
+        version=2,
+        previous_block=1,
+        timestamp=1351658517,
+        bits=bitcoin_data.FloatingInteger.from_target_upper_bound(2**256 - 1),
+        nonce=nonce,
+        merkle_root=bitcoin_data.check_merkle_link(bitcoin_data.hash256(bitcoin_data.tx_type.pack(gentx)), merkle_link),
+    ))
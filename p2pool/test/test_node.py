@@ -2,14 +2,17 @@ from __future__ import division
 
 import random
 import tempfile
+import time
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, error, reactor
+from twisted.python import failure
 from twisted.trial import unittest
 from twisted.web import client, resource, server
 
-from p2pool import data, node, work
+from p2pool import data, node, p2p, work
 from p2pool.bitcoin import data as bitcoin_data, networks, worker_interface
-from p2pool.util import deferral, jsonrpc, math, variable
+from p2pool.test.util import test_forest
+from p2pool.util import deferral, forest, jsonrpc, math, variable
 
 class bitcoind(object): # can be used as p2p factory, p2p protocol, or rpc jsonrpc proxy
     def __init__(self):
@@ -264,3 +267,150 @@ class Test(unittest.TestCase):
         
         yield deferral.sleep(20) # waiting for work_poller to exit
     test_nodes.timeout = 300
+    
+    def test_eviction_queue(self):
+        now = time.time()
+        def make_share(hash, previous_hash, time_seen):
+            return test_forest.FakeShare(hash=hash, previous_hash=previous_hash, time_seen=time_seen, target=2**240, max_target=2**240,
+                desired_version=13, share_data=dict(stale_info=None, pubkey_hash=0))
+        items = [make_share(i, i - 1 if i > 0 else None, 0) for i in xrange(830)]
+        items.extend(make_share(1000 + i, 1000 + i - 1 if i else 700, 0) for i in xrange(5)) # old branch
+        items.extend(make_share(2000 + i, 2000 + i - 1 if i else 820, now) for i in xrange(5)) # recent branch
+        items.extend(make_share(3000 + i, 3000 + i - 1 if i else 2999, now - 60 if i == 0 else 0) for i in xrange(5)) # unconnected, recently started
+        items.extend(make_share(4000 + i, 4000 + i - 1 if i else 3999, 0) for i in xrange(5)) # unconnected, old
+        
+        trackers = []
+        for i in xrange(2):
+            t = data.OkayTracker(mynet)
+            for item in items:
+                t.add(item)
+            for item in items[:830]:
+                t.verified.add(item)
+            trackers.append(t)
+        
+        # what Node.clean_tracker did before EvictionQueue
+        t = trackers[0]
+        while True:
+            to_remove = set()
+            for share_hash, tail in t.heads.iteritems():
+                if share_hash == 829 or t.items[share_hash].time_seen > time.time() - 300:
+                    continue
+                if share_hash not in t.verified.items and max(t.items[after_tail_hash].time_seen for after_tail_hash in t.reverse.get(tail)) > time.time() - 120:
+                    continue
+                to_remove.add(share_hash)
+            if not to_remove:
+                break
+            for share_hash in to_remove:
+                if share_hash in t.verified.items:
+                    t.verified.remove(share_hash)
+                t.remove(share_hash)
+        while True:
+            to_remove = set()
+            for tail, heads in t.tails.iteritems():
+                if min(t.get_height(head) for head in heads) >= 2*mynet.CHAIN_LENGTH + 10:
+                    to_remove.update(t.reverse.get(tail, set()))
+            if not to_remove:
+                break
+            for aftertail in to_remove:
+                if aftertail in t.verified.items:
+                    t.verified.remove(aftertail)
+                t.remove(aftertail)
+        
+        t = trackers[1]
+        q = node.EvictionQueue(t)
+        def remove_shares(share_hashes):
+            t.verified.remove_many([share_hash for share_hash in share_hashes if share_hash in t.verified.items])
+            t.remove_many(share_hashes)
+        while True:
+            to_remove = q.get_due_heads(set([829]))
+            if not to_remove:
+                break
+            remove_shares(to_remove)
+        while True:
+            to_remove = [aftertail for tail in q.get_due_tails(2*mynet.CHAIN_LENGTH + 10) for aftertail in t.reverse[tail]]
+            if not to_remove:
+                break
+            remove_shares(to_remove)
+        
+        assert set(trackers[1].items) == set(trackers[0].items)
+        assert set(trackers[1].verified.items) == set(trackers[0].verified.items)
+        assert 1000 not in t.items and 4000 not in t.items and 3004 in t.items and 2004 in t.items
+        assert 16 not in t.items and 17 in t.items
+        
+        # nothing more is due until something changes
+        assert not q.get_due_heads(set([829])) and not q.get_due_tails(2*mynet.CHAIN_LENGTH + 10)
+        t.add(make_share(830, 829, 0))
+        assert q.get_due_heads(set([830])) == []
+        assert q.get_due_tails(2*mynet.CHAIN_LENGTH + 10) == []
+        t.add(make_share(2005, 2004, now))
+        assert q.get_due_tails(2*mynet.CHAIN_LENGTH + 10) == [16]
+    
+    def test_share_downloader(self):
+        class FakePeer(object):
+            def __init__(self, port):
+                self.addr = '127.0.0.1', port
+                self.requests = []
+            def get_shares(self, hashes, parents, stops):
+                df = defer.Deferred()
+                self.requests.append((hashes, parents, df))
+                return df
+        class FakeP2PNode(object):
+            def __init__(self):
+                self.node = math.Object(tracker=data.OkayTracker(mynet), desired_var=variable.Variable(None))
+                self.peers = dict((i, FakePeer(i)) for i in xrange(2))
+                self.handled = []
+            def handle_shares(self, shares, peer):
+                self.handled.append((shares, peer))
+        
+        p2p_node = FakeP2PNode()
+        d = node.ShareDownloader(p2p_node)
+        
+        assert d.start_requests([(None, 1), (None, 1), (None, 2), (None, 3)])
+        assert len(d.requested) == 2 and len(d.busy_peers) == 2
+        requests = [request for peer in p2p_node.peers.itervalues() for request in peer.requests]
+        assert sorted(hashes for hashes, parents, df in requests) == sorted([share_hash] for share_hash in d.requested)
+        assert not d.start_requests([(None, 1), (None, 2), (None, 3)]) # every peer is busy
+        
+        (hashes, parents, df), = p2p_node.peers[0].requests
+        df.callback(['share']*(parents + 1))
+        assert p2p_node.handled == [(['share']*(parents + 1), p2p_node.peers[0])]
+        assert d.parents == 2*parents
+        assert p2p_node.peers[0] not in d.busy_peers and hashes[0] not in d.requested
+        
+        (hashes, parents, df), = p2p_node.peers[1].requests
+        df.callback([])
+        assert hashes[0] in d.retry_times
+        assert d.peer_stats[p2p_node.peers[1]][1] < d.peer_stats[p2p_node.peers[0]][1]
+        
+        # only a reply that was too long makes later requests ask for fewer parents
+        for fail, parents in [
+            (error.ConnectionDone(), d.parents),
+            (p2p.ShareReplyError('sharereply result: too long'), d.parents//2),
+        ]:
+            assert d.start_requests([(None, 4)])
+            peer, = d.busy_peers
+            peer.requests[-1][2].errback(failure.Failure(fail))
+            assert d.parents == parents and not d.requested and not d.busy_peers
+        assert not self.flushLoggedErrors()
+        assert d.start_requests([(None, 4)])
+        peer, = d.busy_peers
+        peer.requests[-1][2].errback(failure.Failure(ValueError()))
+        assert len(self.flushLoggedErrors(ValueError)) == 1
+    
+    def test_share_downloader_stops(self):
+        tracker = forest.Tracker(test_forest.FakeShare(hash=i, previous_hash=i - 1) for i in xrange(50, 100))
+        p2p_node = math.Object(node=math.Object(tracker=tracker, desired_var=variable.Variable(None)), peers={})
+        d = node.ShareDownloader(p2p_node)
+        
+        stops = d.get_stops()
+        assert sorted(stops) == [89, 99]
+        for i in reversed(xrange(40, 50)): # catching up, below the head
+            tracker.add(test_forest.FakeShare(hash=i, previous_hash=i - 1))
+            assert d.get_stops() is stops
+        tracker.remove_many(range(40, 45)) # pruning the tail
+        assert d.get_stops() is stops
+        
+        tracker.add(test_forest.FakeShare(hash=100, previous_hash=99))
+        assert sorted(d.get_stops()) == [90, 100]
+        tracker.remove(100)
+        assert sorted(d.get_stops()) == [89, 99]
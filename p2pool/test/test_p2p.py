@@ -5,7 +5,7 @@ from twisted.trial import unittest
 
 from p2pool import networks, p2p
 from p2pool.bitcoin import data as bitcoin_data
-from p2pool.util import deferral
+from p2pool.util import deferral, variable
 
 
 class Test(unittest.TestCase):
@@ -77,3 +77,235 @@ class Test(unittest.TestCase):
             yield n.stop()
         finally:
             p2p.Protocol.max_remembered_txs_size //= 10
+    
+    @defer.inlineCallbacks
+    def test_tx_announce_batching(self):
+        class FakeNode(object):
+            net = networks.nets['bitcoin']
+            traffic_happened = variable.Event()
+        sent = []
+        class MyProtocol(p2p.Protocol):
+            tx_announce_delay = .1
+            max_tx_announce_batch = 5
+            def send_have_tx(self, tx_hashes):
+                sent.append(('have', sorted(tx_hashes)))
+            def send_losing_tx(self, tx_hashes):
+                sent.append(('losing', sorted(tx_hashes)))
+        
+        p = MyProtocol(FakeNode(), False)
+        p.queue_tx_announcements({1: None, 2: None}, {})
+        p.queue_tx_announcements({3: None}, {2: None})
+        p.queue_tx_announcements({}, {4: None})
+        assert sent == []
+        yield deferral.sleep(.3)
+        assert sent == [('have', [1, 3]), ('losing', [4])], sent
+        
+        del sent[:]
+        p.queue_tx_announcements({4: None}, {})
+        p.queue_tx_announcements({}, {4: None})
+        yield deferral.sleep(.3)
+        assert sent == []
+        
+        p.queue_tx_announcements(dict((i, None) for i in xrange(10, 15)), {})
+        assert sent == [('have', range(10, 15))], sent
+        assert p._tx_announce_delayed is None
+    
+    def test_compact_shares(self):
+        def make_tx(i):
+            return dict(version=1, tx_ins=[], tx_outs=[dict(value=i, script='')], lock_time=0)
+        txs = dict((bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)), tx) for tx in map(make_tx, xrange(4)))
+        (h0, tx0), (h1, tx1), (h2, tx2), (h3, tx3) = sorted(txs.iteritems())
+        
+        class FakeNode(object):
+            net = networks.nets['bitcoin']
+            traffic_happened = variable.Event()
+            def __init__(self, known_txs):
+                self.known_txs_var = variable.DictVariable(known_txs)
+                self.mining_txs_var = variable.DictVariable({})
+        class MyProtocol(p2p.Protocol):
+            def sendPacket(self, command, payload2):
+                type_ = getattr(self, 'message_' + command)
+                self.sent.append(command)
+                getattr(self.other, 'handle_' + command)(**type_.unpack(type_.pack(payload2)))
+            def handle_shares(self, shares):
+                self.got_shares.append((shares, dict(self.node.known_txs_var.value), dict(self.compact_txs), self.remembered_txs_size))
+                self.loaded = defer.Deferred()
+                return self.loaded
+        
+        a, b = MyProtocol(FakeNode({}), False), MyProtocol(FakeNode({h0: tx0, h1: tx1}), True)
+        a.other, b.other = b, a
+        for p in [a, b]:
+            p.sent, p.got_shares = [], []
+            p.short_id_salt = 'salt'
+            p.remembered_txs, p.remembered_txs_size = {}, 0
+            p.short_id_cache, p.short_id_index, p.compact_sent_txs, p.compact_pending, p.compact_txs, p.compact_loading = {}, {}, {}, {}, {}, {}
+        
+        a.remote_tx_hashes = set([h0, h1, h2]) # a wrongly thinks b has h2
+        a.sendCompactShares([], [(h0, tx0), (h1, tx1), (h2, tx2), (h3, tx3)])
+        assert a.sent == ['cmpctshares', 'cmpcttxs'], a.sent
+        assert b.sent == ['cmpcttxreq'], b.sent
+        size = sum(100 + bitcoin_data.tx_type.packed_size(tx) for tx in txs.itervalues())
+        assert b.got_shares == [([], txs, dict((tx_hash, (tx, 1)) for tx_hash, tx in txs.iteritems()), size)], b.got_shares
+        assert b.compact_pending == {}
+        
+        # the txs are charged to b's remembered txs budget until the shares are loaded, but the check lets the
+        # loading ones go, as a doesn't know when loading is done
+        assert b.compact_loading == dict((tx_hash, 1) for tx_hash in txs)
+        b.max_remembered_txs_size = size - 1
+        b.check_remembered_txs_size()
+        b.loaded.callback(None)
+        assert b.compact_txs == {} and b.compact_loading == {} and b.remembered_txs_size == 0
+        
+        # a charges what it sends to its view of b's budget, and lets it go only after b would have
+        class FakeShare(object):
+            hash = 5
+            def get_other_tx_hashes(self, tracker):
+                return [h2, h3]
+            def as_share(self):
+                return dict(type=17, contents='')
+        a.other_version = 1300
+        a.remote_remembered_txs_size = 0
+        a.max_remembered_txs_size = p2p.Protocol.max_remembered_txs_size
+        a.sendShares([FakeShare()], None, txs, include_txs_with=[5])
+        charged = sum(100 + bitcoin_data.tx_type.packed_size(tx) for tx in [tx2, tx3])
+        assert a.remote_remembered_txs_size == charged
+        b.loaded.callback(None)
+        release, = [call for call in reactor.getDelayedCalls() if call.func == a._release_remote_compact_txs]
+        assert release.getTime() - reactor.seconds() > a.compact_txs_timeout
+        func, args = release.func, release.args
+        release.cancel()
+        func(*args)
+        assert a.remote_remembered_txs_size == 0
+        
+        b.max_remembered_txs_size = size - 1
+        self.assertRaises(p2p.PeerMisbehavingError, b.handle_cmpctshares, id=1, shares=[], short_ids=[], txs=txs.values())
+        
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+    
+    def test_packed_shares_cache(self):
+        class FakeNode(object):
+            net = networks.nets['bitcoin']
+            traffic_happened = variable.Event()
+            mining_txs_var = variable.DictVariable({})
+        class FakeShare(object):
+            def __init__(self, hash):
+                self.hash = hash
+            def as_share(self):
+                return dict(type=17, contents='share %i' % (self.hash,))
+        class MyProtocol(p2p.Protocol):
+            def packPacket(self, command, payload2):
+                packed.append(command)
+                return p2p.Protocol.packPacket(self, command, payload2)
+            def sendPackedPacket(self, data):
+                self.sent.append(data)
+        packed = []
+        
+        peers = [MyProtocol(FakeNode(), False) for i in xrange(3)]
+        for peer in peers:
+            peer.sent = []
+            peer.other_version = 1200
+            peer.remote_remembered_txs_size = 0
+        shares = map(FakeShare, xrange(3))
+        
+        packed_shares_cache = {}
+        for peer in peers:
+            peer.sendShares(shares if peer is not peers[2] else shares[1:], None, {}, packed_shares_cache=packed_shares_cache)
+        assert packed == ['shares', 'shares'], packed
+        assert peers[0].sent == peers[1].sent != peers[2].sent
+        assert p2p.Protocol.message_shares.unpack(peers[0].sent[0][len(FakeNode.net.PREFIX) + 20:]) == dict(shares=[share.as_share() for share in shares])
+    
+    def test_sharereq_partial_reply(self):
+        class FakeShare(object):
+            VERSION = 17
+            def __init__(self, hash):
+                self.hash = hash
+                self.packed = chr(self.hash)*300000 # replies are made from this, without packing the share again
+        class FakeNode(object):
+            net = networks.nets['bitcoin']
+            traffic_happened = variable.Event()
+            def handle_get_shares(self, hashes, parents, stops, peer):
+                return map(FakeShare, xrange(parents + 1))
+        class MyProtocol(p2p.Protocol):
+            def sendPackedPacket(self, data):
+                sent.append(p2p.Protocol.message_sharereply.unpack(data[len(FakeNode.net.PREFIX) + 20:]))
+        sent = []
+        
+        p = MyProtocol(FakeNode(), False)
+        p.handle_sharereq(id=1, hashes=[0], parents=4, stops=[])
+        p.handle_sharereq(id=2, hashes=[0], parents=1, stops=[])
+        assert [(x['id'], x['result'], [share['contents'][0] for share in x['shares']]) for x in sent] == [
+            (1, 'good', ['\x00', '\x01', '\x02']),
+            (2, 'good', ['\x00', '\x01']),
+        ]
+        assert all(share['type'] == 17 and share['contents'] == share['contents'][0]*300000 for x in sent for share in x['shares'])
+    
+    def test_share_announcements(self):
+        class FakeNode(object):
+            net = networks.nets['bitcoin']
+            traffic_happened = variable.Event()
+            def handle_have_shares(self, hashes, peer):
+                self.announced.append(hashes)
+        class MyProtocol(p2p.Protocol):
+            max_remote_share_hashes = 3
+            def sendPacket(self, command, payload2):
+                type_ = getattr(self, 'message_' + command)
+                getattr(self.other, 'handle_' + command)(**type_.unpack(type_.pack(payload2)))
+        
+        a, b = MyProtocol(FakeNode(), False), MyProtocol(FakeNode(), True)
+        a.other, b.other = b, a
+        for p in [a, b]:
+            p.node.announced = []
+        
+        a.announceShares([1, 2])
+        a.announceShares([2, 3])
+        assert b.node.announced == [[1, 2], [3]], b.node.announced
+        assert list(a.remote_share_hashes) == [1, 2, 3]
+        assert list(b.remote_share_hashes) == [1, 2, 3]
+        
+        a.note_remote_share_hashes([1, 4])
+        assert list(a.remote_share_hashes) == [3, 1, 4]
+        a.announceShares([2, 3])
+        assert b.node.announced == [[1, 2], [3], [2]], b.node.announced
+    
+    def test_forget_tx_held_while_loading(self):
+        tx = dict(version=1, tx_ins=[], tx_outs=[dict(value=0, script='')], lock_time=0)
+        tx_hash = bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx))
+        
+        class FakeNode(object):
+            net = networks.nets['bitcoin']
+            traffic_happened = variable.Event()
+            share_verify_pool = None
+            def __init__(self):
+                self.known_txs_var = variable.DictVariable({})
+                self.handled = []
+            def handle_shares(self, shares, peer):
+                self.handled.append(dict(peer.remembered_txs))
+        class MyProtocol(p2p.Protocol):
+            def disconnect(self):
+                raise AssertionError('disconnected')
+        loads = []
+        def load_shares(shares, net, peer_addr, pool):
+            loads.append(defer.Deferred())
+            return loads[-1]
+        self.patch(p2p.p2pool_data, 'load_shares', load_shares)
+        
+        p = MyProtocol(FakeNode(), False)
+        p.addr = '127.0.0.1', 9333
+        p.remembered_txs, p.remembered_txs_size, p.known_txs_cache = {}, 0, {}
+        p.handle_remember_tx(tx_hashes=[], txs=[tx])
+        p.handle_shares([])
+        p.handle_forget_tx(tx_hashes=[tx_hash])
+        p.handle_remember_tx(tx_hashes=[tx_hash], txs=[]) # cancels the held forget
+        p.handle_shares([])
+        p.handle_forget_tx(tx_hashes=[tx_hash])
+        
+        loads[0].callback([])
+        assert p.remembered_txs == {tx_hash: tx}
+        loads[1].callback([])
+        assert p.node.handled == [{tx_hash: tx}, {tx_hash: tx}]
+        assert p.remembered_txs == {} and p.remembered_txs_size == 0
+        assert p.loading_shares == 0
+        
+        for call in reactor.getDelayedCalls():
+            call.cancel()
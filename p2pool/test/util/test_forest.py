@@ -1,3 +1,5 @@
+import array
+import pickle
 import random
 import unittest
 
@@ -192,3 +194,110 @@ class Test(unittest.TestCase):
                     else:
                         break
                 test_tracker(t)
+    
+    def test_state(self):
+        for ii in xrange(10):
+            items = []
+            for i in xrange(random.randrange(300)):
+                x = random.choice(items + [FakeShare(hash=None), FakeShare(hash=random.randrange(1000000, 2000000))]).hash
+                items.append(FakeShare(hash=i, previous_hash=x))
+            random.shuffle(items)
+            
+            t = forest.Tracker(items[:len(items)//2])
+            for item in t.items.itervalues():
+                t.get_height(item.hash)
+                t.get_nth_parent_hash(item.hash, random.randrange(t.get_height(item.hash) + 1))
+            
+            t2 = forest.Tracker()
+            t2.set_state(dict((item.hash, item) for item in items), pickle.loads(pickle.dumps(t.get_state(), 2)))
+            for t3 in [t, t2]:
+                for item in items[len(items)//2:]:
+                    t3.add(item)
+                test_tracker(t3)
+            assert t2.heads == t.heads and t2.tails == t.tails and t2.reverse == t.reverse
+            for item in items:
+                assert t2.get_height_and_last(item.hash) == t.get_height_and_last(item.hash)
+    
+    def test_array_view(self):
+        delta_type = forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+            work=lambda item: 2**100 if item.hash % 7 == 0 else item.hash, # some don't fit in a C long
+        ))
+        for ii in xrange(10):
+            items = []
+            for i in xrange(random.randrange(200)):
+                x = random.choice(items + [FakeShare(hash=None), FakeShare(hash=random.randrange(1000000, 2000000))]).hash
+                items.append(FakeShare(hash=i, previous_hash=x))
+            
+            t = forest.Tracker(delta_type=delta_type)
+            t2 = forest.Tracker(delta_type=delta_type, view_type=forest.ArrayTrackerView)
+            for item in math.shuffled(items) + math.shuffled(items):
+                if item.hash not in t.items:
+                    t.add(item)
+                    t2.add(item)
+                elif random.randrange(2):
+                    try:
+                        t.remove(item.hash)
+                    except NotImplementedError:
+                        continue
+                    t2.remove(item.hash)
+                test_tracker(t2)
+                for item_hash in t.items:
+                    a = t.get_delta_to_last(item_hash)
+                    b = t2.get_delta_to_last(item_hash)
+                    assert (a.tail, a.height, a.work) == (b.tail, b.height, b.work)
+            assert set(t2._default_view._ids).issubset(t2.items)
+            
+            # states are interchangeable between the two views
+            t3 = forest.Tracker(delta_type=delta_type)
+            t3.set_state(t2.items, pickle.loads(pickle.dumps(t2.get_state(), 2)))
+            t4 = forest.Tracker(delta_type=delta_type, view_type=forest.ArrayTrackerView)
+            t4.set_state(t.items, pickle.loads(pickle.dumps(t.get_state(), 2)))
+            for item_hash in t.items:
+                assert t3.get_height_and_last(item_hash) == t4.get_height_and_last(item_hash) == t.get_height_and_last(item_hash)
+                assert t3.get_work(item_hash) == t4.get_work(item_hash) == t.get_work(item_hash)
+    
+    def test_array_view_overflow(self):
+        big = set([3, 4])
+        delta_type = forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+            work=lambda item: 2**100 if item.hash in big else 1,
+        ))
+        t = forest.Tracker(delta_type=delta_type, view_type=forest.ArrayTrackerView)
+        for i in xrange(10):
+            t.add(FakeShare(hash=i, previous_hash=i - 1 if i > 0 else None))
+        for i in xrange(10):
+            assert t.get_work(i) == (i + 1) + (2**100 - 1)*len([x for x in big if x <= i])
+        view = t._default_view
+        assert all(isinstance(column, array.array) for column in view._columns) # overflow doesn't convert the column
+        assert view._overflows[list(delta_type.attr_names).index('work')]
+        
+        t2 = forest.Tracker(delta_type=delta_type)
+        t2.set_state(t.items, pickle.loads(pickle.dumps(t.get_state(), 2)))
+        for i in xrange(10):
+            assert t2.get_work(i) == t.get_work(i)
+        
+        # overflowed entries are dropped once their items go
+        for i in xrange(10):
+            t.remove(i)
+        assert not any(view._overflows) and not view._ids
+    
+    def test_remove_many(self):
+        t = generate_tracker_simple(100)
+        t2 = generate_tracker_simple(100)
+        batches = []
+        t.removed_many.watch(batches.append)
+        singles = []
+        t.removed.watch(singles.append)
+        
+        t.remove_many([99, 98, 97, 0, 1])
+        for item_hash in [99, 98, 97, 0, 1]:
+            t2.remove(item_hash)
+        test_tracker(t)
+        assert [[item.hash for item in batch] for batch in batches] == [[99, 98, 97, 0, 1]]
+        assert [item.hash for item in singles] == [99, 98, 97, 0, 1]
+        assert t.heads == t2.heads and t.tails == t2.tails
+        for item_hash in t.items:
+            assert t.get_height_and_last(item_hash) == t2.get_height_and_last(item_hash)
+        
+        # items removed before a failure are still reported
+        self.assertRaises(NotImplementedError, t.remove_many, [96, 50])
+        assert [item.hash for item in batches[-1]] == [96]
@@ -0,0 +1,53 @@
+import random
+import unittest
+
+from p2pool.util import p2protocol, pack
+
+class Transport(object):
+    def __init__(self, other):
+        self.other = other
+    
+    def write(self, data):
+        self.other.written.append(data)
+
+class MyProtocol(p2protocol.Protocol):
+    message_ping = pack.ComposedType([
+        ('data', pack.VarStrType()),
+    ])
+    def handle_ping(self, data):
+        self.received.append(data)
+
+class Test(unittest.TestCase):
+    def test_framing(self):
+        for i in xrange(20):
+            p = MyProtocol('\xfe\xed\xbe\xef', 1000)
+            p.received, p.written = [], []
+            p.transport = Transport(p)
+            p.connected = True
+            
+            datas = [''.join(chr(random.randrange(2**8)) for j in xrange(random.randrange(500))) for k in xrange(10)]
+            for data in datas:
+                p.written.append('garbage\xfe\xed'[:random.randrange(10)])
+                p.send_ping(data=data)
+            stream = ''.join(p.written)
+            
+            pos = 0
+            while pos < len(stream):
+                x = random.randrange(1, 100)
+                p.dataReceived(stream[pos:pos + x])
+                pos += x
+            assert p.received == datas
+    
+    def test_too_long(self):
+        p = MyProtocol('\xfe\xed\xbe\xef', 100)
+        p.received, p.written = [], []
+        p.transport = Transport(p)
+        p.connected = True
+        
+        p._max_payload_length = 1000
+        p.send_ping(data='x'*500)
+        p.send_ping(data='y')
+        p._max_payload_length = 100
+        
+        p.dataReceived(''.join(p.written))
+        assert p.received == ['y']
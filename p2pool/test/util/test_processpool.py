@@ -0,0 +1,72 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from p2pool.util import processpool
+
+def square(x):
+    return x*x
+
+def fail(x):
+    raise ValueError(x)
+
+def make_lambda():
+    return lambda: None
+
+def sleep(x):
+    import time
+    time.sleep(x)
+
+class Test(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_synchronous(self):
+        pool = processpool.ProcessPool(0)
+        assert (yield pool(square, 5)) == 25
+        assert (yield pool.map(square, [(i,) for i in xrange(10)])) == [i*i for i in xrange(10)]
+        try:
+            yield pool(fail, 3)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError()
+    
+    @defer.inlineCallbacks
+    def test_processes(self):
+        pool = processpool.ProcessPool(2)
+        try:
+            assert (yield pool(square, 5)) == 25
+            assert (yield pool.map(square, [(i,) for i in xrange(10)])) == [i*i for i in xrange(10)]
+            try:
+                yield pool(fail, 3)
+            except processpool.ProcessError:
+                pass
+            else:
+                raise AssertionError()
+        finally:
+            pool.stop()
+    
+    @defer.inlineCallbacks
+    def test_unpicklable(self):
+        pool = processpool.ProcessPool(1)
+        try:
+            for args in [(lambda: None,), (square, lambda: None), (make_lambda,)]: # function, argument, result
+                try:
+                    yield pool(*args)
+                except processpool.ProcessError:
+                    pass
+                else:
+                    raise AssertionError()
+            assert (yield pool(square, 3)) == 9 # pool still works
+        finally:
+            pool.stop()
+    
+    @defer.inlineCallbacks
+    def test_stop(self):
+        pool = processpool.ProcessPool(1)
+        df = pool(sleep, 10)
+        pool.stop()
+        try:
+            yield df
+        except processpool.ProcessError:
+            pass
+        else:
+            raise AssertionError()
@@ -0,0 +1,30 @@
+import unittest
+
+from p2pool.util import variable
+
+class Test(unittest.TestCase):
+    def test_dict_variable(self):
+        v = variable.DictVariable({1: 'a'})
+        diffs = []
+        v.diffed.watch(lambda added, removed: diffs.append((added, removed)))
+        changes = []
+        v.changed.watch(changes.append)
+        value = v.value
+        
+        v.update(added={2: 'b', 1: 'x'})
+        assert v.value is value and v.value == {1: 'a', 2: 'b'}
+        assert diffs == [({2: 'b'}, {})]
+        
+        v.update(removed=[1, 3])
+        assert v.value == {2: 'b'}
+        assert diffs[-1] == ({}, {1: 'a'})
+        
+        v.update(added={2: 'c'}, removed=[4])
+        assert len(diffs) == 2 and len(changes) == 2 # nothing changed
+        
+        v.set({3: 'c', 2: 'b'})
+        assert v.value is value and v.value == {2: 'b', 3: 'c'}
+        assert diffs[-1] == ({3: 'c'}, {})
+        v.set({})
+        assert v.value == {} and diffs[-1] == ({}, {2: 'b', 3: 'c'})
+        assert len(changes) == len(diffs) == 4
@@ -121,7 +121,10 @@ class GenericDeferrer(object):
             return
         df, timer = self.map.pop(id)
         timer.cancel()
-        df.callback(resp)
+        if isinstance(resp, defer.Deferred):
+            resp.chainDeferred(df)
+        else:
+            df.callback(resp)
     
     def respond_all(self, resp):
         while self.map:
@@ -2,6 +2,7 @@
 forest data structure
 '''
 
+import array
 import itertools
 
 from p2pool.util import skiplist, variable
@@ -12,7 +13,11 @@ class TrackerSkipList(skiplist.SkipList):
         skiplist.SkipList.__init__(self)
         self.tracker = tracker
         
-        self.tracker.removed.watch_weakref(self, lambda self, item: self.forget_item(item.hash))
+        self.tracker.removed_many.watch_weakref(self, lambda self, items: self._handle_removed_many(items))
+    
+    def _handle_removed_many(self, items):
+        for item in items:
+            self.forget_item(item.hash)
     
     def previous(self, element):
         return self.tracker._delta_type.from_element(self.tracker.items[element]).tail
@@ -59,6 +64,14 @@ def get_attributedelta_type(attrs): # attrs: {name: func}
         def from_element(cls, item):
             return cls(item.hash, item.previous_hash, **dict((k, v(item)) for k, v in attrs.iteritems()))
         
+        @classmethod
+        def from_values(cls, head, tail, values): # values in attr_names order
+            res = cls.__new__(cls)
+            res.head, res.tail = head, tail
+            for k, v in zip(cls.attr_names, values):
+                setattr(res, k, v)
+            return res
+        
         @staticmethod
         def get_head(item):
             return item.hash
@@ -87,8 +100,41 @@ def get_attributedelta_type(attrs): # attrs: {name: func}
         def __repr__(self):
             return '%s(%r, %r%s)' % (self.__class__, self.head, self.tail, ''.join(', %s=%r' % (k, getattr(self, k)) for k in attrs))
     ProtoAttributeDelta.attrs = attrs
+    ProtoAttributeDelta.attr_names = tuple(attrs)
     return ProtoAttributeDelta
 
+class Counts(dict):
+    '''
+    {key: number} that can be used as a delta attribute, adding and
+    subtracting per key. Shouldn't be modified, as deltas share them.
+    '''
+    
+    __slots__ = []
+    
+    def _combine(self, other, sign):
+        if not isinstance(other, dict):
+            assert other == 0 # from get_none
+            return self
+        res = dict(self)
+        for k, v in other.iteritems():
+            x = res.get(k, 0) + sign*v
+            if x:
+                res[k] = x
+            else:
+                res.pop(k, None)
+        return Counts(res)
+    
+    def __add__(self, other):
+        return self._combine(other, 1)
+    __radd__ = __add__
+    
+    def __sub__(self, other):
+        return self._combine(other, -1)
+    
+    def __rsub__(self, other):
+        assert other == 0
+        return Counts()._combine(self, -1)
+
 AttributeDelta = get_attributedelta_type(dict(
     height=lambda item: 1,
 ))
@@ -107,6 +153,7 @@ class TrackerView(object):
         
         self._tracker.remove_special.watch_weakref(self, lambda self, item: self._handle_remove_special(item))
         self._tracker.remove_special2.watch_weakref(self, lambda self, item: self._handle_remove_special2(item))
+        # these have to be handled as each item is removed, not batched, as the next removal depends on them
         self._tracker.removed.watch_weakref(self, lambda self, item: self._handle_removed(item))
     
     def _handle_remove_special(self, item):
@@ -159,6 +206,23 @@ class TrackerView(object):
                 del self._reverse_delta_refs[delta2.tail]
     
     
+    def get_state(self):
+        to_tuple = lambda delta: (delta.head, delta.tail, dict((k, getattr(delta, k)) for k in self._delta_type.attrs))
+        return dict(
+            deltas=dict((item_hash, (to_tuple(delta), ref)) for item_hash, (delta, ref) in self._deltas.iteritems()),
+            delta_refs=dict((ref, to_tuple(delta)) for ref, delta in self._delta_refs.iteritems()),
+        )
+    
+    def set_state(self, state):
+        from_tuple = lambda (head, tail, attrs): self._delta_type(head, tail, **attrs)
+        self._deltas = dict((item_hash, (from_tuple(delta), ref)) for item_hash, (delta, ref) in state['deltas'].iteritems())
+        self._reverse_deltas = {}
+        for item_hash, (delta, ref) in self._deltas.iteritems():
+            self._reverse_deltas.setdefault(ref, set()).add(item_hash)
+        self._delta_refs = dict((ref, from_tuple(delta)) for ref, delta in state['delta_refs'].iteritems())
+        self._reverse_delta_refs = dict((delta.tail, ref) for ref, delta in self._delta_refs.iteritems())
+        self._ref_generator = itertools.count(max(self._delta_refs) + 1 if self._delta_refs else 0)
+    
     def get_height(self, item_hash):
         return self.get_delta_to_last(item_hash).height
     
@@ -221,8 +285,179 @@ class TrackerView(object):
         assert self._tracker.is_child_of(ancestor, item)
         return self.get_delta_to_last(item) - self.get_delta_to_last(ancestor)
 
+class ArrayTrackerView(TrackerView):
+    '''
+    TrackerView that interns item hashes to small integer ids and keeps cached
+    deltas in array columns indexed by id, instead of a delta object per item.
+    Only the delta cache is stored this way; the Tracker's own items, reverse,
+    heads and tails are still dicts keyed by item hash.
+    '''
+    
+    def __init__(self, tracker, delta_type):
+        TrackerView.__init__(self, tracker, delta_type)
+        self._reset_columns()
+    
+    def _reset_columns(self):
+        self._deltas = None # unused, see columns
+        self._ids = {} # item_hash -> id
+        self._hashes = [] # id -> item_hash, None if free
+        self._free_ids = []
+        self._refs = array.array('l') # id -> ref
+        # one column per attr (in attr_names order), id -> value of delta from item to its ref's head
+        self._columns = [array.array('l') for k in self._delta_type.attr_names]
+        # values that don't fit in a C long (e.g. work) go in a per-column {id: value} instead, with 0 left in the column
+        self._overflows = [{} for k in self._delta_type.attr_names]
+        # self._reverse_deltas holds ids instead of item_hashes
+    
+    def _new_id(self, item_hash):
+        if self._free_ids:
+            id = self._free_ids.pop()
+            self._hashes[id] = item_hash
+        else:
+            id = len(self._hashes)
+            self._hashes.append(item_hash)
+            self._refs.append(-1)
+            for column in self._columns:
+                column.append(0)
+        self._ids[item_hash] = id
+        return id
+    
+    def _release_id(self, item_hash):
+        id = self._ids.pop(item_hash)
+        self._hashes[id] = None
+        self._refs[id] = -1
+        for overflow in self._overflows:
+            overflow.pop(id, None)
+        self._free_ids.append(id)
+    
+    def _store(self, id, delta):
+        for k, column, overflow in zip(self._delta_type.attr_names, self._columns, self._overflows):
+            value = getattr(delta, k)
+            try:
+                column[id] = value
+            except (OverflowError, TypeError):
+                column[id] = 0
+                overflow[id] = value
+            else:
+                if overflow:
+                    overflow.pop(id, None)
+    
+    def _load(self, id):
+        return [overflow[id] if overflow and id in overflow else column[id]
+            for column, overflow in zip(self._columns, self._overflows)]
+    
+    def _handle_remove_special(self, item):
+        delta = self._delta_type.from_element(item)
+        
+        if delta.tail not in self._reverse_delta_refs:
+            return
+        
+        # move delta refs referencing children down to this, so they can be moved up in one step
+        for x in list(self._reverse_deltas.get(self._reverse_delta_refs.get(delta.head, object()), set())):
+            self.get_last(self._hashes[x])
+        
+        assert delta.head not in self._reverse_delta_refs
+        
+        if delta.tail not in self._reverse_delta_refs:
+            return
+        
+        # move ref pointing to this up
+        
+        ref = self._reverse_delta_refs[delta.tail]
+        cur_delta = self._delta_refs[ref]
+        assert cur_delta.tail == delta.tail
+        self._delta_refs[ref] = cur_delta - delta
+        assert self._delta_refs[ref].tail == delta.head
+        del self._reverse_delta_refs[delta.tail]
+        self._reverse_delta_refs[delta.head] = ref
+    
+    def _handle_remove_special2(self, item):
+        delta = self._delta_type.from_element(item)
+        
+        if delta.tail not in self._reverse_delta_refs:
+            return
+        
+        ref = self._reverse_delta_refs.pop(delta.tail)
+        del self._delta_refs[ref]
+        
+        for x in self._reverse_deltas.pop(ref):
+            self._release_id(self._hashes[x])
+    
+    def _handle_removed(self, item):
+        delta = self._delta_type.from_element(item)
+        
+        # delete delta entry and ref if it is empty
+        if delta.head in self._ids:
+            id = self._ids[delta.head]
+            ref = self._refs[id]
+            self._release_id(delta.head)
+            self._reverse_deltas[ref].remove(id)
+            if not self._reverse_deltas[ref]:
+                del self._reverse_deltas[ref]
+                delta2 = self._delta_refs.pop(ref)
+                del self._reverse_delta_refs[delta2.tail]
+    
+    
+    def get_state(self):
+        # same format as TrackerView's, so states can be moved between the two
+        to_tuple = lambda delta: (delta.head, delta.tail, dict((k, getattr(delta, k)) for k in self._delta_type.attrs))
+        return dict(
+            deltas=dict((item_hash, ((item_hash, self._delta_refs[self._refs[id]].head, dict(zip(self._delta_type.attr_names, self._load(id)))), self._refs[id]))
+                for item_hash, id in self._ids.iteritems()),
+            delta_refs=dict((ref, to_tuple(delta)) for ref, delta in self._delta_refs.iteritems()),
+        )
+    
+    def set_state(self, state):
+        TrackerView.set_state(self, state)
+        deltas = self._deltas
+        self._reset_columns()
+        self._reverse_deltas = {}
+        for item_hash, (delta, ref) in deltas.iteritems():
+            id = self._new_id(item_hash)
+            self._refs[id] = ref
+            self._store(id, delta)
+            self._reverse_deltas.setdefault(ref, set()).add(id)
+    
+    def _get_delta(self, item_hash):
+        if item_hash in self._ids:
+            id = self._ids[item_hash]
+            delta2 = self._delta_refs[self._refs[id]]
+            res = self._delta_type.from_values(item_hash, delta2.tail,
+                [value + getattr(delta2, k) for k, value in zip(self._delta_type.attr_names, self._load(id))])
+        else:
+            res = self._delta_type.from_element(self._tracker.items[item_hash])
+        assert res.head == item_hash
+        return res
+    
+    def _set_delta(self, item_hash, delta):
+        other_item_hash = delta.tail
+        if other_item_hash not in self._reverse_delta_refs:
+            ref = self._ref_generator.next()
+            assert ref not in self._delta_refs
+            self._delta_refs[ref] = self._delta_type.get_none(other_item_hash)
+            self._reverse_delta_refs[other_item_hash] = ref
+            del ref
+        
+        ref = self._reverse_delta_refs[other_item_hash]
+        ref_delta = self._delta_refs[ref]
+        assert ref_delta.tail == other_item_hash
+        
+        if item_hash in self._ids:
+            id = self._ids[item_hash]
+            prev_ref = self._refs[id]
+            self._reverse_deltas[prev_ref].remove(id)
+            if not self._reverse_deltas[prev_ref] and prev_ref != ref:
+                self._reverse_deltas.pop(prev_ref)
+                x = self._delta_refs.pop(prev_ref)
+                self._reverse_delta_refs.pop(x.tail)
+        else:
+            id = self._new_id(item_hash)
+        self._refs[id] = ref
+        self._store(id, delta - ref_delta)
+        self._reverse_deltas.setdefault(ref, set()).add(id)
+
 class Tracker(object):
-    def __init__(self, items=[], delta_type=AttributeDelta):
+    def __init__(self, items=[], delta_type=AttributeDelta, view_type=TrackerView):
         self.items = {} # hash -> item
         self.reverse = {} # delta.tail -> set of item_hashes
         
@@ -233,11 +468,12 @@ class Tracker(object):
         self.remove_special = variable.Event()
         self.remove_special2 = variable.Event()
         self.removed = variable.Event()
+        self.removed_many = variable.Event() # fired once per remove/remove_many call with all removed items
         
         self.get_nth_parent_hash = DistanceSkipList(self)
         
         self._delta_type = delta_type
-        self._default_view = TrackerView(self, delta_type)
+        self._default_view = view_type(self, delta_type)
         
         for item in items:
             self.add(item)
@@ -276,7 +512,44 @@ class Tracker(object):
         
         self.added.happened(item)
     
+    def get_state(self):
+        '''
+        Returns a picklable snapshot of the structure and cached deltas, which
+        set_state can restore without re-adding every item
+        '''
+        return dict(
+            items=list(self.items),
+            reverse=self.reverse,
+            heads=self.heads,
+            tails=self.tails,
+            view=self._default_view.get_state(),
+            skips=self.get_nth_parent_hash.skips,
+        )
+    
+    def set_state(self, items, state):
+        # items: hash -> item, must include every item in state
+        assert not self.items
+        self.items = dict((item_hash, items[item_hash]) for item_hash in state['items'])
+        self.reverse = state['reverse']
+        self.heads = state['heads']
+        self.tails = state['tails']
+        self._default_view.set_state(state['view'])
+        self.get_nth_parent_hash.skips = state['skips']
+    
     def remove(self, item_hash):
+        self.remove_many([item_hash])
+    
+    def remove_many(self, item_hashes):
+        # items are removed in the order given, so children have to come before their parents
+        items = []
+        try:
+            for item_hash in item_hashes:
+                items.append(self._remove(item_hash))
+        finally:
+            if items:
+                self.removed_many.happened(items)
+    
+    def _remove(self, item_hash):
         assert isinstance(item_hash, (int, long, type(None)))
         if item_hash not in self.items:
             raise KeyError()
@@ -328,6 +601,7 @@ class Tracker(object):
             self.reverse.pop(delta.tail)
         
         self.removed.happened(item)
+        return item
     
     def get_chain(self, start_hash, length):
         assert length <= self.get_height(start_hash)
@@ -355,7 +629,8 @@ class SubsetTracker(Tracker):
             assert self._delta_type.get_head(item) in self._subset_of.items
         Tracker.add(self, item)
     
-    def remove(self, item_hash):
+    def remove_many(self, item_hashes):
         if self._subset_of is not None:
-            assert item_hash in self._subset_of.items
-        Tracker.remove(self, item_hash)
+            item_hashes = list(item_hashes)
+            assert all(item_hash in self._subset_of.items for item_hash in item_hashes)
+        Tracker.remove_many(self, item_hashes)
@@ -1,20 +1,24 @@
-import itertools
+import collections
 
 class LRUDict(object):
     def __init__(self, n):
         self.n = n
-        self.inner = {}
-        self.counter = itertools.count()
+        self.inner = collections.OrderedDict()
     def get(self, key, default=None):
         if key in self.inner:
-            x, value = self.inner[key]
-            self.inner[key] = self.counter.next(), value
+            value = self.inner.pop(key)
+            self.inner[key] = value
             return value
         return default
+    def pop(self, key, default=None):
+        return self.inner.pop(key, default)
+    def clear(self):
+        self.inner.clear()
     def __setitem__(self, key, value):
-        self.inner[key] = self.counter.next(), value
+        self.inner.pop(key, None)
+        self.inner[key] = value
         while len(self.inner) > self.n:
-            self.inner.pop(min(self.inner, key=lambda k: self.inner[k][0]))
+            self.inner.popitem(last=False)
 
 _nothing = object()
 
@@ -9,7 +9,7 @@ from twisted.internet import protocol
 from twisted.python import log
 
 import p2pool
-from p2pool.util import datachunker, variable
+from p2pool.util import variable
 
 class TooLong(Exception):
     pass
@@ -18,44 +18,71 @@ class Protocol(protocol.Protocol):
     def __init__(self, message_prefix, max_payload_length, traffic_happened=variable.Event()):
         self._message_prefix = message_prefix
         self._max_payload_length = max_payload_length
-        self.dataReceived2 = datachunker.DataChunker(self.dataReceiver())
         self.traffic_happened = traffic_happened
+        
+        self._header = struct.Struct('<12sI4s')
+        self._recv_parts = [] # received data that hasn't been framed yet
+        self._recv_len = 0
+        self._recv_wants = len(message_prefix) + self._header.size # bytes needed before framing is worth attempting again
     
     def dataReceived(self, data):
         self.traffic_happened.happened('p2p/in', len(data))
-        self.dataReceived2(data)
+        
+        self._recv_parts.append(data)
+        self._recv_len += len(data)
+        if self._recv_len < self._recv_wants:
+            return
+        
+        buf = ''.join(self._recv_parts) if len(self._recv_parts) > 1 else self._recv_parts[0]
+        pos, self._recv_wants = self._frame(buf)
+        rest = buf[pos:] if pos else buf
+        self._recv_parts = [rest] if rest else []
+        self._recv_len = len(rest)
     
-    def dataReceiver(self):
+    def _frame(self, buf):
+        # handles every complete message in buf, returning how much of buf was consumed and how many bytes are needed to make progress
+        prefix_len = len(self._message_prefix)
+        pos = 0
         while True:
-            start = ''
-            while start != self._message_prefix:
-                start = (start + (yield 1))[-len(self._message_prefix):]
+            start = buf.find(self._message_prefix, pos)
+            if start == -1:
+                pos = max(pos, len(buf) - prefix_len + 1) # keep what could be the beginning of a prefix
+                return pos, prefix_len + self._header.size
+            pos = start
             
-            command = (yield 12).rstrip('\0')
-            length, = struct.unpack('<I', (yield 4))
+            payload_start = pos + prefix_len + self._header.size
+            if len(buf) < payload_start:
+                return pos, payload_start - pos
+            command, length, checksum = self._header.unpack_from(buf, pos + prefix_len)
             if length > self._max_payload_length:
                 print 'length too large'
-                continue
-            checksum = yield 4
-            payload = yield length
-            
-            if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
-                print 'invalid hash for', self.transport.getPeer().host, repr(command), length, checksum.encode('hex'), hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4].encode('hex'), payload.encode('hex')
-                self.badPeerHappened()
+                pos += prefix_len + 16 # skip command and length
                 continue
             
-            type_ = getattr(self, 'message_' + command, None)
-            if type_ is None:
-                if p2pool.DEBUG:
-                    print 'no type for', repr(command)
-                continue
+            if len(buf) < payload_start + length:
+                return pos, payload_start + length - pos
+            pos = payload_start + length
             
-            try:
-                self.packetReceived(command, type_.unpack(payload))
-            except:
-                print 'RECV', command, payload[:100].encode('hex') + ('...' if len(payload) > 100 else '')
-                log.err(None, 'Error handling message: (see RECV line)')
-                self.disconnect()
+            self._payloadReceived(command.rstrip('\0'), checksum, buffer(buf, payload_start, length))
+    
+    def _payloadReceived(self, command, checksum, payload):
+        if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+            print 'invalid hash for', self.transport.getPeer().host, repr(command), len(payload), checksum.encode('hex'), hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4].encode('hex'), str(payload).encode('hex')
+            self.badPeerHappened()
+            return
+        
+        type_ = getattr(self, 'message_' + command, None)
+        if type_ is None:
+            if p2pool.DEBUG:
+                print 'no type for', repr(command)
+            return
+        
+        try:
+            self.packetReceived(command, type_.unpack(payload))
+        except:
+            print 'RECV', command, payload[:100].encode('hex') + ('...' if len(payload) > 100 else '')
+            log.err(None, 'Error handling message: (see RECV line)')
+            self.disconnect()
     
     def packetReceived(self, command, payload2):
         handler = getattr(self, 'handle_' + command, None)
@@ -78,7 +105,7 @@ class Protocol(protocol.Protocol):
     def badPeerHappened(self):
         self.disconnect()
     
-    def sendPacket(self, command, payload2):
+    def packPacket(self, command, payload2):
         if len(command) >= 12:
             raise ValueError('command too long')
         type_ = getattr(self, 'message_' + command, None)
@@ -88,7 +115,13 @@ class Protocol(protocol.Protocol):
         payload = type_.pack(payload2)
         if len(payload) > self._max_payload_length:
             raise TooLong('payload too long')
-        data = self._message_prefix + struct.pack('<12sI', command, len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
+        return self._message_prefix + struct.pack('<12sI', command, len(payload)) + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] + payload
+    
+    def sendPacket(self, command, payload2):
+        self.sendPackedPacket(self.packPacket(command, payload2))
+    
+    def sendPackedPacket(self, data):
+        # data is a whole message from packPacket, possibly shared between connections with the same prefix
         self.traffic_happened.happened('p2p/out', len(data))
         self.transport.write(data)
     
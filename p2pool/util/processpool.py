@@ -0,0 +1,82 @@
+'''
+Runs CPU-heavy functions in a pool of worker processes, returning Deferreds
+'''
+
+import cPickle
+import multiprocessing
+import signal
+import traceback
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+class ProcessError(Exception):
+    pass
+
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # let the parent handle ^C
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) # forked from the reactor, whose handler would keep terminate() from killing us
+
+def _call(data):
+    # arguments and result cross the process boundary pickled by hand, so that
+    # pickling errors are reported instead of multiprocessing dropping the task
+    try:
+        func, args = cPickle.loads(data)
+        return True, cPickle.dumps(func(*args), cPickle.HIGHEST_PROTOCOL)
+    except:
+        return False, traceback.format_exc()
+
+class ProcessPool(object):
+    '''
+    func and args must be picklable. With processes=0 no workers are started
+    and calls are run synchronously in this process.
+    '''
+    
+    def __init__(self, processes):
+        self.processes = processes
+        self._pool = multiprocessing.Pool(processes, _init_worker) if processes else None
+        self._pending = set() # Deferreds of calls that haven't returned yet
+    
+    def __call__(self, func, *args):
+        if self._pool is None:
+            return defer.maybeDeferred(func, *args)
+        
+        try:
+            data = cPickle.dumps((func, args), cPickle.HIGHEST_PROTOCOL)
+        except:
+            return defer.fail(failure.Failure(ProcessError(traceback.format_exc())))
+        
+        df = defer.Deferred()
+        def got_result((success, result)):
+            if df not in self._pending:
+                return # pool was stopped
+            self._pending.remove(df)
+            if success:
+                try:
+                    result = cPickle.loads(result)
+                except:
+                    df.errback(failure.Failure(ProcessError(traceback.format_exc())))
+                else:
+                    df.callback(result)
+            else:
+                df.errback(failure.Failure(ProcessError(result)))
+        try:
+            self._pool.apply_async(_call, (data,), callback=lambda res: reactor.callFromThread(got_result, res))
+        except:
+            return defer.fail(failure.Failure(ProcessError(traceback.format_exc())))
+        self._pending.add(df)
+        return df
+    
+    def map(self, func, args_list):
+        return defer.gatherResults([self(func, *args) for args in args_list], consumeErrors=True)
+    
+    def stop(self):
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        pool.close()
+        pool.terminate()
+        pool.join()
+        pending, self._pending = self._pending, set()
+        for df in pending:
+            df.errback(failure.Failure(ProcessError('process pool stopped')))
@@ -83,3 +83,34 @@ class Variable(object):
     
     def get_not_none(self):
         return self.get_when_satisfies(lambda val: val is not None)
+
+class DictVariable(Variable):
+    '''
+    Variable holding a dict that is changed in place, firing diffed with only
+    the keys that were added and removed. Values of keys that are already
+    present are kept, as with dicts of transactions keyed by their hash.
+    transitioned isn't available, as the old value isn't kept.
+    '''
+    
+    def __init__(self, value):
+        Variable.__init__(self, dict(value))
+        self.transitioned = None
+        self.diffed = Event() # (added, removed), both dicts of key -> value
+    
+    def update(self, added={}, removed=[]):
+        removed_items = {}
+        for key in removed:
+            if key in self.value and key not in added:
+                removed_items[key] = self.value.pop(key)
+        added_items = {}
+        for key, value in added.iteritems():
+            if key not in self.value:
+                self.value[key] = added_items[key] = value
+        if not added_items and not removed_items:
+            return
+        
+        self.changed.happened(self.value)
+        self.diffed.happened(added_items, removed_items)
+    
+    def set(self, value):
+        self.update(value, [key for key in self.value if key not in value])
@@ -123,17 +123,18 @@ def get_web_root(wb, datadir_path, bitcoind_warning_var, stop_event=variable.Eve
         
         global_stale_prop = p2pool_data.get_average_stale_prop(node.tracker, node.best_share_var.value, lookbehind)
         
-        my_unstale_count = sum(1 for share in node.tracker.get_chain(node.best_share_var.value, lookbehind) if share.hash in wb.my_share_hashes)
-        my_orphan_count = sum(1 for share in node.tracker.get_chain(node.best_share_var.value, lookbehind) if share.hash in wb.my_share_hashes and share.share_data['stale_info'] == 'orphan')
-        my_doa_count = sum(1 for share in node.tracker.get_chain(node.best_share_var.value, lookbehind) if share.hash in wb.my_share_hashes and share.share_data['stale_info'] == 'doa')
+        window = node.tracker.get_window(node.best_share_var.value, lookbehind)
+        mine = window.get_mask(wb.my_share_hashes)
+        my_stale_info_counts = window.get_stale_info_counts(mine)
+        my_unstale_count = sum(my_stale_info_counts.itervalues())
+        my_orphan_count = my_stale_info_counts.get('orphan', 0)
+        my_doa_count = my_stale_info_counts.get('doa', 0)
         my_share_count = my_unstale_count + my_orphan_count + my_doa_count
         my_stale_count = my_orphan_count + my_doa_count
         
         my_stale_prop = my_stale_count/my_share_count if my_share_count != 0 else None
         
-        my_work = sum(bitcoin_data.target_to_average_attempts(share.target)
-            for share in node.tracker.get_chain(node.best_share_var.value, lookbehind - 1)
-            if share.hash in wb.my_share_hashes)
+        my_work = sum(window.get_stale_info_attempts(mine, lookbehind - 1).itervalues())
         actual_time = (node.tracker.items[node.best_share_var.value].timestamp -
             node.tracker.items[node.tracker.get_nth_parent_hash(node.best_share_var.value, lookbehind - 1)].timestamp)
         share_att_s = my_work / actual_time
@@ -339,6 +340,11 @@ def get_web_root(wb, datadir_path, bitcoind_warning_var, stop_event=variable.Eve
         address_explorer_url_prefix=node.net.PARENT.ADDRESS_EXPLORER_URL_PREFIX,
     )))
     new_root.putChild('version', WebInterface(lambda: p2pool.__version__))
+    new_root.putChild('weights_cache', WebInterface(lambda: dict(
+        hits=node.tracker.get_cumulative_weights.hits,
+        misses=node.tracker.get_cumulative_weights.misses,
+        derived=node.tracker.get_cumulative_weights.derived,
+    )))
     
     hd_path = os.path.join(datadir_path, 'graph_db')
     hd_data = _atomic_read(hd_path)
@@ -38,7 +38,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
         self.my_share_hashes = set()
         self.my_doa_share_hashes = set()
         
-        self.tracker_view = forest.TrackerView(self.node.tracker, forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
+        self.tracker_view = forest.ArrayTrackerView(self.node.tracker, forest.get_attributedelta_type(dict(forest.AttributeDelta.attrs,
             my_count=lambda share: 1 if share.hash in self.my_share_hashes else 0,
             my_doa_count=lambda share: 1 if share.hash in self.my_doa_share_hashes else 0,
             my_orphan_announce_count=lambda share: 1 if share.hash in self.my_share_hashes and share.share_data['stale_info'] == 'orphan' else 0,
@@ -82,6 +82,17 @@ class WorkerBridge(worker_interface.WorkerBridge):
         # COMBINE WORK
         
         self.current_work = variable.Variable(None)
+        
+        # merkle tree over the gentx and current_work's txs, kept for every get_work and only rehashed where the txs changed
+        self.merkle_tree = bitcoin_data.MerkleTree([None])
+        self.merkle_tree_tx_hashes = []
+        @self.current_work.changed.watch
+        def _(work):
+            tx_hashes = work['transaction_hashes'] if 'transaction_hashes' in work else [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in work['transactions']]
+            if tx_hashes != self.merkle_tree_tx_hashes:
+                self.merkle_tree.update([None] + tx_hashes)
+                self.merkle_tree_tx_hashes = tx_hashes
+        
         def compute_work():
             t = self.node.bitcoind_work.value
             bb = self.node.best_block_header.value
@@ -176,17 +187,18 @@ class WorkerBridge(worker_interface.WorkerBridge):
         if self.merged_work.value:
             tree, size = bitcoin_data.make_auxpow_tree(self.merged_work.value)
             mm_hashes = [self.merged_work.value.get(tree.get(i), dict(hash=0))['hash'] for i in xrange(size)]
+            mm_tree = bitcoin_data.MerkleTree(mm_hashes)
             mm_data = '\xfa\xbemm' + bitcoin_data.aux_pow_coinbase_type.pack(dict(
-                merkle_root=bitcoin_data.merkle_hash(mm_hashes),
+                merkle_root=mm_tree.get_root(),
                 size=size,
                 nonce=0,
             ))
-            mm_later = [(aux_work, mm_hashes.index(aux_work['hash']), mm_hashes) for chain_id, aux_work in self.merged_work.value.iteritems()]
+            mm_later = [(aux_work, mm_tree.get_link(mm_hashes.index(aux_work['hash']))) for chain_id, aux_work in self.merged_work.value.iteritems()]
         else:
             mm_data = ''
             mm_later = []
         
-        tx_hashes = [bitcoin_data.hash256(bitcoin_data.tx_type.pack(tx)) for tx in self.current_work.value['transactions']]
+        tx_hashes = self.merkle_tree_tx_hashes
         tx_map = dict(zip(tx_hashes, self.current_work.value['transactions']))
         
         if self.node.best_share_var.value is None:
@@ -209,7 +221,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
                     share_type = previous_share_type
         
         if True:
-            share_info, gentx, other_transaction_hashes, get_share = share_type.generate_transaction(
+            share_info, gentx, other_transaction_hashes, merkle_link, get_share = share_type.generate_transaction(
                 tracker=self.node.tracker,
                 share_data=dict(
                     previous_share_hash=self.node.best_share_var.value,
@@ -236,12 +248,13 @@ class WorkerBridge(worker_interface.WorkerBridge):
                 net=self.node.net,
                 known_txs=tx_map,
                 base_subsidy=self.node.net.PARENT.SUBSIDY_FUNC(self.current_work.value['height']),
+                merkle_tree=self.merkle_tree,
             )
         
         packed_gentx = bitcoin_data.tx_type.pack(gentx)
         other_transactions = [tx_map[tx_hash] for tx_hash in other_transaction_hashes]
         
-        mm_later = [(dict(aux_work, target=aux_work['target'] if aux_work['target'] != 'p2pool' else share_info['bits'].target), index, hashes) for aux_work, index, hashes in mm_later]
+        mm_later = [(dict(aux_work, target=aux_work['target'] if aux_work['target'] != 'p2pool' else share_info['bits'].target), mm_link) for aux_work, mm_link in mm_later]
         
         if desired_pseudoshare_target is None:
             target = 2**256-1
@@ -252,13 +265,12 @@ class WorkerBridge(worker_interface.WorkerBridge):
         else:
             target = desired_pseudoshare_target
         target = max(target, share_info['bits'].target)
-        for aux_work, index, hashes in mm_later:
+        for aux_work, mm_link in mm_later:
             target = max(target, aux_work['target'])
         target = math.clip(target, self.node.net.PARENT.SANE_TARGET_RANGE)
         
         getwork_time = time.time()
         lp_count = self.new_work_event.times
-        merkle_link = bitcoin_data.calculate_merkle_link([None] + other_transaction_hashes, 0)
         
         print 'New work for worker! Difficulty: %.06f Share difficulty: %.06f Total block value: %.6f %s including %i transactions' % (
             bitcoin_data.target_to_difficulty(target),
@@ -304,7 +316,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
             
             on_time = self.new_work_event.times == lp_count
             
-            for aux_work, index, hashes in mm_later:
+            for aux_work, mm_link in mm_later:
                 try:
                     if pow_hash <= aux_work['target'] or p2pool.DEBUG:
                         df = deferral.retry('Error submitting merged block: (will retry)', 10, 10)(aux_work['merged_proxy'].rpc_getauxblock)(
@@ -315,7 +327,7 @@ class WorkerBridge(worker_interface.WorkerBridge):
                                     block_hash=header_hash,
                                     merkle_link=merkle_link,
                                 ),
-                                merkle_link=bitcoin_data.calculate_merkle_link(hashes, index),
+                                merkle_link=mm_link,
                                 parent_block_header=header,
                             )).encode('hex'),
                         )